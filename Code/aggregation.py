@@ -0,0 +1,89 @@
+"""
+Vectorized weighted group aggregation
+
+Replaces groupby(...).apply(lambda x: weighted average) with one pass of
+np.bincount over sorted group codes for all columns at once
+
+jwb
+"""
+
+import pandas as pd
+import numpy as np
+
+
+#%%
+
+def group_codes(df, by):
+    """
+    Parameters
+    ----------
+    df : dataframe
+    by : list of columns to group by
+
+    Returns
+    -------
+    codes : group number of every row (sorted by the group keys), -1 if any key is missing
+    index : group keys, in the same order as the codes
+    """
+    if len(by) == 1:
+        codes, uniques = pd.factorize(df[by[0]],sort = True)
+        return codes, pd.Index(uniques,name = by[0])
+
+    parts = [pd.factorize(df[x],sort = True) for x in by]
+    missing = np.any([x[0] < 0 for x in parts],axis = 0)
+    combined = np.ravel_multi_index([np.maximum(x[0],0) for x in parts],
+                                    [max(len(x[1]),1) for x in parts])
+    combined[missing] = -1
+
+    groups, codes = np.unique(combined[~missing],return_inverse = True)
+    out = np.full(len(df),-1,dtype = np.int64)
+    out[~missing] = codes
+
+    levels = np.unravel_index(groups,[max(len(x[1]),1) for x in parts])
+    index = pd.MultiIndex.from_arrays([np.asarray(x[1])[lev] for x,lev in zip(parts,levels)],names = by)
+    return out, index
+
+
+def weighted_agg(df, by, cols, weight, skipna = True):
+    """
+    Parameters
+    ----------
+    df : dataframe
+    by : list of columns to group by (rows with a missing key are dropped, as in groupby)
+    cols : list of columns to take weighted means of
+    weight : weight column
+    skipna : if True, missing values are skipped as in pandas
+        (x*w).sum()/w.sum(), so a group with zero total weight is missing.
+        If False, missing values propagate and a zero total weight raises,
+        as in np.average(x, weights = w)
+
+    Returns
+    -------
+    df indexed by the group keys with the weighted mean of each column,
+    the sum of weights (sum_weight) and the number of rows (n)
+    """
+    codes, index = group_codes(df,by)
+    keep = codes >= 0
+    codes = codes[keep]
+    n_groups = len(index)
+
+    w = df[weight].to_numpy(dtype = float)[keep]
+    if skipna:
+        w_sum = np.bincount(codes,weights = np.where(np.isnan(w),0,w),minlength = n_groups)
+    else:
+        w_sum = np.bincount(codes,weights = w,minlength = n_groups)
+        if np.any(w_sum == 0):
+            raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+
+    out = pd.DataFrame(index = index)
+    with np.errstate(divide = 'ignore',invalid = 'ignore'):
+        for col in cols:
+            xw = df[col].to_numpy(dtype = float)[keep] * w
+            if skipna:
+                xw = np.where(np.isnan(xw),0,xw)
+            out[col] = np.bincount(codes,weights = xw,minlength = n_groups) / w_sum
+
+    out['sum_weight'] = w_sum
+    out['n'] = np.bincount(codes,minlength = n_groups)
+
+    return out
@@ -0,0 +1,207 @@
+"""
+Store of stage results, so a rebuild only reruns what is out of date
+
+Every stage of a graph (see Code/scheduler.py) gets a key from the content
+hashes of its input files, the code version of its function, its arguments
+and the keys of the stages it depends on. Results are stored in ARTIFACT_DIR
+with their key, and a stage is only run again if its key changed, so a
+change to one input file reruns that stage and everything downstream of it.
+
+The code version is the hash of the module of the stage function and of all
+Code modules it imports from, directly or through other Code modules (also
+imports inside functions). File hashes are kept in the manifest by
+(modification time, size), so an unchanged file is not read again.
+
+jwb
+"""
+
+import os
+import ast
+import sys
+import json
+import pickle
+import hashlib
+import inspect
+from Code.cache import file_hash
+from Code.scheduler import run_graph, _needed, _order, _deps, _dep_name
+
+ARTIFACT_DIR = 'data/artifacts'
+
+## Code modules imported by each source file, {(path, sha256): [module names]}
+_imports = {}
+
+
+#%%
+
+def run_incremental(graph, targets = None, workers = None, store = ARTIFACT_DIR, setup = None):
+    """
+    Parameters
+    ----------
+    graph : dict of {name: Stage}
+    targets : list of stages to return, the default None returns all of them
+    workers : number of processes, see run_graph
+    store : directory the results are kept in
+    setup : function called before any stage is run (not called at all if
+        everything is up to date)
+
+    Returns
+    -------
+    dict of {name: result} for the targets, the same as run_graph
+    """
+    targets = list(graph) if targets is None else list(targets)
+    order = _order(graph,_needed(graph,targets))
+
+    manifest = _load_manifest(store)
+    known = dict(manifest['files'])
+    keys = stage_keys(graph,order,manifest['files'])
+    stale = [x for x in order if manifest['stages'].get(x) != keys[x]
+             or not os.path.exists(_artifact(store,x))]
+
+    ## Up to date stages are only read back if a target or a stale stage needs them
+    fresh = set(order) - set(stale)
+    load = {x for x in targets if x in fresh}
+    load.update(_dep_name(d) for x in stale for d in _deps(graph[x]) if _dep_name(d) in fresh)
+    results = {x:_load_artifact(store,x) for x in load}
+
+    if stale:
+        if setup is not None:
+            setup()
+        results = run_graph(graph,list(dict.fromkeys(targets + stale)),workers,results)
+        for name in stale:
+            _save_artifact(store,name,results[name])
+            manifest['stages'][name] = keys[name]
+            _save_manifest(store,manifest)
+    elif manifest['files'] != known:
+        ## Only the file hashes changed (e.g. a file was touched)
+        _save_manifest(store,manifest)
+
+    return {x:results[x] for x in targets}
+
+
+def stage_keys(graph, order, files = None):
+    """
+    Parameters
+    ----------
+    graph : dict of {name: Stage}
+    order : stages in dependency order
+    files : dict of known file hashes, {path: [mtime_ns, size, sha256]} (updated)
+
+    Returns
+    -------
+    dict of {name: key} of the stages
+    """
+    files = {} if files is None else files
+    keys = {}
+    for name in order:
+        stage = graph[name]
+        parts = {'name':name,
+                 'code':code_version(stage.fun),
+                 'kwargs':sorted(stage.kwargs.items()),
+                 'inputs':[[x,_input_hash(x,files)] for x in stage.inputs],
+                 'deps':stage.deps,
+                 'dep_keys':[keys[_dep_name(x)] for x in _deps(stage)]}
+        keys[name] = hashlib.sha256(json.dumps(parts,sort_keys = True,default = repr).encode()).hexdigest()
+    return keys
+
+
+def code_version(fun):
+    """
+    Returns
+    -------
+    hash of the source of the module of fun and of every Code module it
+    imports from, directly or through other Code modules
+    """
+    sources = set()
+    todo = [inspect.getsourcefile(sys.modules[fun.__module__])]
+    while todo:
+        path = todo.pop()
+        if path in sources:
+            continue
+        sources.add(path)
+        todo.extend(x for x in map(_module_file,_code_imports(path)) if x is not None)
+    h = hashlib.sha256()
+    for path in sorted(sources):
+        h.update('{}|{}\n'.format(os.path.basename(path),file_hash(path)).encode())
+    return h.hexdigest()
+
+
+def clear_artifacts(store = ARTIFACT_DIR):
+    """
+    Remove all stored results, so the next build reruns everything
+    """
+    if os.path.exists(store):
+        for entry in os.listdir(store):
+            os.remove(os.path.join(store,entry))
+
+
+#%% Storage helpers
+
+def _code_imports(path):
+    key = (path,file_hash(path))
+    if key not in _imports:
+        with open(path,'rb') as f:
+            tree = ast.parse(f.read())
+        names = []
+        for node in ast.walk(tree):
+            if isinstance(node,ast.Import):
+                names += [x.name for x in node.names]
+            elif isinstance(node,ast.ImportFrom) and node.level == 0 and node.module:
+                ## from Code import x can import the module Code.x
+                names += [node.module] + ['{}.{}'.format(node.module,x.name) for x in node.names]
+        _imports[key] = sorted({x for x in names if x.split('.')[0] == 'Code'})
+    return _imports[key]
+
+
+def _module_file(name):
+    ## Found next to this module rather than imported, names of functions or
+    ## constants (from Code.x import y) have no file
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),*name.split('.'))
+    for loc in [path + '.py',os.path.join(path,'__init__.py')]:
+        if os.path.isfile(loc):
+            return loc
+    return None
+
+
+def _input_hash(path, files):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    known = files.get(path)
+    if known is None or known[:2] != [stat.st_mtime_ns,stat.st_size]:
+        files[path] = [stat.st_mtime_ns,stat.st_size,file_hash(path)]
+    return files[path][2]
+
+
+def _artifact(store, name):
+    return os.path.join(store,'{}.pkl'.format(name))
+
+
+def _load_artifact(store, name):
+    with open(_artifact(store,name),'rb') as f:
+        return pickle.load(f)
+
+
+def _save_artifact(store, name, result):
+    if not os.path.exists(store):
+        os.makedirs(store)
+    tmp = _artifact(store,name) + '.tmp'
+    with open(tmp,'wb') as f:
+        pickle.dump(result,f,protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp,_artifact(store,name))
+
+
+def _load_manifest(store):
+    loc = os.path.join(store,'manifest.json')
+    if not os.path.exists(loc):
+        return {'files':{},'stages':{}}
+    with open(loc) as f:
+        return json.load(f)
+
+
+def _save_manifest(store, manifest):
+    if not os.path.exists(store):
+        os.makedirs(store)
+    loc = os.path.join(store,'manifest.json')
+    with open(loc + '.tmp','w') as f:
+        json.dump(manifest,f,indent = 1,sort_keys = True)
+    os.replace(loc + '.tmp',loc)
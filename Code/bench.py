@@ -0,0 +1,549 @@
+"""
+Benchmarks on synthetic data
+
+make_inputs writes synthetic inputs with the same layout as the real ones 
+(Compustat, ATUS, O*NET/BLS, BEA use table, NAICS files and the CFO survey) 
+at the sizes in SCALES, so every build_* can run without licensed data or a
+network. run_benchmarks runs each measure in a fresh process, records wall 
+time, CPU time, peak RSS and the time of each stage, and appends the results 
+(with the git commit) to RESULTS, so compare_results can line up commits.
+import_times times the import of the modules, each in a fresh interpreter.
+
+Run with python -m Code.bench [scale]
+
+jwb
+"""
+
+import os
+import sys
+import json
+import time
+import zipfile
+import platform
+import datetime
+import subprocess
+import multiprocessing
+import pandas as pd
+import numpy as np
+from scipy import sparse
+from Code.aggregation import weighted_agg
+from Code.compustat import WINSOR_LIMITS
+from Code.naics import BLS_GROUPS as NAICS_BLS_GROUPS
+from Code.scheduler import Stage, _needed, _order, _call
+
+try:
+    import resource
+except ImportError:
+    ## Not on Windows, peak RSS is then not reported
+    resource = None
+
+## Sizes of the synthetic inputs
+## (_get_io_table reads the first 413 commodity rows, the size of the BEA table,
+## so io_size above that adds industries only, the io_kernel benchmark uses all of it)
+SCALES = {'small':{'firm_quarters':100_000,'atus_respondents':20_000,'io_size':400,
+                   'occupations':800,'survey_responses':1_000},
+          'medium':{'firm_quarters':1_000_000,'atus_respondents':200_000,'io_size':400,
+                    'occupations':800,'survey_responses':5_000},
+          'large':{'firm_quarters':10_000_000,'atus_respondents':1_000_000,'io_size':1_000,
+                   'occupations':1_000,'survey_responses':20_000}}
+
+BENCH_MEASURES = ['workplace_flex','investment_flex','cust_int','fixed_cost_share','io_kernel']
+BENCH_DIR = 'data/bench'
+RESULTS = 'data/bench/results.jsonl'
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+#%%
+
+def _time(fun, repeat):
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        out = fun()
+        best = min(best,time.perf_counter() - start)
+    return best, out
+
+
+def bench_weighted_agg(n_rows = 1_000_000, n_groups = 1_000, repeat = 3, seed = 0):
+    """
+    Parameters
+    ----------
+    n_rows : number of rows of synthetic data
+    n_groups : number of groups
+    repeat : number of runs (best time is reported)
+    seed : random seed
+
+    Returns
+    -------
+    df of best time (seconds) of the groupby/lambda weighted means used in the
+    build_* functions and of weighted_agg, and the max abs difference
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'group':rng.integers(0,n_groups,n_rows),
+                       'x':rng.random(n_rows),
+                       'w':rng.random(n_rows)})
+    ## Some missing values and a zero-weight group, as in the O*NET and BLS data
+    df.loc[rng.random(n_rows) < 0.05,'x'] = np.nan
+    df.loc[df['group'] == 0,'w'] = 0
+
+    def _lambda_skipna():
+        return df.groupby('group').apply(lambda dfx: (dfx['x']*dfx['w']).sum()/dfx['w'].sum())
+
+    def _lambda_average():
+        return df.dropna(subset = ['x']).loc[df['group'] != 0].groupby('group').apply(
+               lambda dfx: np.average(dfx['x'],weights = dfx['w']))
+
+    def _kernel_skipna():
+        return weighted_agg(df,['group'],['x'],'w')['x']
+
+    def _kernel_average():
+        return weighted_agg(df.dropna(subset = ['x']).loc[df['group'] != 0],
+                            ['group'],['x'],'w',skipna = False)['x']
+
+    out = []
+    for name, old, new in [('skipna',_lambda_skipna,_kernel_skipna),
+                           ('np.average',_lambda_average,_kernel_average)]:
+        old_time, old_out = _time(old,repeat)
+        new_time, new_out = _time(new,repeat)
+        out.append({'case':name,'n_rows':n_rows,'n_groups':n_groups,
+                    'lambda':old_time,'weighted_agg':new_time,
+                    'speedup':old_time/new_time,
+                    'max_abs_diff':np.nanmax(np.abs(old_out.to_numpy() - new_out.to_numpy()))})
+
+    return pd.DataFrame(out)
+
+
+#%% Synthetic inputs
+
+## BLS industries that build_cust_int splits into NAICS4 industries (Code/naics.py), as ints
+BLS_GROUPS = {x:[int(y) for y in group] for x,group in NAICS_BLS_GROUPS.items()}
+
+SECTORS = {11:'11',21:'21',22:'22',23:'23',31:'31-33',32:'31-33',33:'31-33',42:'42',
+           44:'44-45',45:'44-45',48:'48-49',49:'48-49',51:'51',52:'52',53:'53',54:'54',
+           55:'55',56:'56',61:'61',62:'62',71:'71',72:'72',81:'81',92:'92'}
+
+
+def make_inputs(root = BENCH_DIR, scale = 'small', seed = 0):
+    """
+    Parameters
+    ----------
+    root : directory to write to, the inputs are in root/work/data/ (the
+        builds are run from root/work, the survey file is in root/)
+    scale : key of SCALES, or a dict with the same keys
+    seed : random seed
+
+    Returns
+    -------
+    root/work, the directory to run the builds from
+    """
+    sizes = SCALES[scale] if isinstance(scale,str) else scale
+    rng = np.random.default_rng(seed)
+    work = os.path.join(root,'work')
+    for folder in ['ind_data','nondownloadable','workplace_flex/raw',
+                   'customer_interactions','fixed_cost_share']:
+        os.makedirs(os.path.join(work,'data',folder),exist_ok = True)
+
+    naics4 = _make_naics(work,rng)
+    _make_atus(work,rng,naics4,sizes['atus_respondents'])
+    _make_customer_interactions(work,rng,naics4,sizes['occupations'],sizes['io_size'])
+    _make_compustat(work,rng,naics4,sizes['firm_quarters'])
+    _make_investment_flex(root,rng,naics4,sizes['survey_responses'])
+
+    with open(os.path.join(work,'scale.json'),'w') as f:
+        json.dump({'scale':scale,'sizes':sizes,'seed':seed},f)
+    return work
+
+
+def _io_match():
+    return pd.read_csv(os.path.join(REPO_DIR,'Data','nondownloadable','io_naics_match.csv'),dtype = str)
+
+
+def _make_naics(work, rng):
+    """
+    NAICS structure and 2012-2017 conversion (Census), with the 4-digit industries
+    the IO match and the BLS groups use. Returns the 4-digit industries
+    """
+    match = _io_match().drop('input_naics',axis = 1).stack()
+    codes = [int(x) for x in list(_io_match()['input_naics']) + list(match) if x.isdigit() and len(x) == 4]
+    codes += [x for group in BLS_GROUPS.values() for x in group]
+    naics4 = np.array(sorted({x for x in codes if x // 100 in SECTORS}))
+
+    naics6 = np.array([x*100 + k for x in naics4 for k in range(10,10 + 10*rng.integers(1,4),10)])
+    naics3 = np.unique(naics4 // 10)
+    structure = ([[SECTORS[x],'Sector {}T'.format(x)] for x in sorted(SECTORS)] +
+                 [[x,'Subsector {}'.format(x)] for x in naics3] +
+                 [[x,'Industry group {}T'.format(x)] for x in naics4] +
+                 [[x,'Industry {} '.format(x)] for x in naics6])
+    structure = pd.DataFrame(structure).drop_duplicates(subset = [0])
+    rows = [['2017 NAICS structure',None,None],[None,None,None],['Seq. No.','2017 NAICS Code','2017 NAICS Title']]
+    rows += [[i + 1,code,title] for i,(code,title) in enumerate(structure.to_numpy())]
+    pd.DataFrame(rows).to_excel(os.path.join(work,'data/ind_data/2017_naics_structure.xlsx'),
+                                header = False,index = False)
+
+    ## A few 2012 industries changed codes in 2017
+    naics2012 = naics6.copy()
+    changed = rng.random(len(naics6)) < 0.02
+    naics2012[changed] = naics2012[changed] + 1
+    rows = [['2017 to 2012 NAICS',None,None,None],[None,None,None,None],
+            ['2012 NAICS Code','2012 NAICS Title','2017 NAICS Code','2017 NAICS Title']]
+    rows += [[x,'Industry {}'.format(x),y,'Industry {}'.format(y)] for x,y in zip(naics2012,naics6)]
+    pd.DataFrame(rows).to_excel(os.path.join(work,'data/ind_data/2017_to_2012_NAICS.xlsx'),
+                                header = False,index = False)
+
+    ## Census industry to NAICS allocation factors (Soltas), at 4 digits
+    census = np.arange(170,170 + 10*len(naics4),10)[:len(naics4)//2 + 1]
+    rows = []
+    for ind in census:
+        targets = rng.choice(naics4,rng.integers(1,4),replace = False)
+        shares = rng.dirichlet(np.ones(len(targets)))
+        rows += [[x,ind,a,4] for x,a in zip(targets,shares)]
+    pd.DataFrame(rows,columns = ['naics','ind','afactor','naics_digit']).to_csv(
+        os.path.join(work,'data/ind_data/naics_to_ind.tab'),sep = '\t',index = False)
+
+    return naics4
+
+
+def _make_atus(work, rng, naics4, n):
+    """
+    ATUS respondent files (2017, 2018), leave module and IPUMS weights
+    """
+    census = pd.read_csv(os.path.join(work,'data/ind_data/naics_to_ind.tab'),sep = '\t')['ind'].unique()
+    year = np.where(np.arange(n) < n // 2,2017,2018)
+    caseid = year*10**10 + 101*10**4 + np.arange(n)
+    resp = pd.DataFrame({'TUCASEID':caseid,'TUYEAR':year,
+                         'TEIO1ICD':np.where(rng.random(n) < 0.1,-1,rng.choice(census,n)),
+                         'TEIO1OCD':rng.integers(10,9800,n),'TEAGE':rng.integers(15,85,n),
+                         'TRERNWA':rng.integers(0,300000,n)})
+    for y, zip_name in [(2017,'atusresp_2017.zip'),(2018,'atusresp-2018.zip')]:
+        _write_zip(resp.loc[resp['TUYEAR'] == y],os.path.join(work,'data/workplace_flex/raw',zip_name),
+                   'atusresp_{}.dat'.format(y))
+
+    ## The leave module is asked of about half of the respondents
+    lv = resp[['TUCASEID']].sample(frac = 0.5,random_state = int(rng.integers(1 << 31))).sort_values(by = 'TUCASEID')
+    lv['LUJF_10'] = rng.choice([-2,-1,1,2],len(lv),p = [0.2,0.05,0.2,0.55])
+    lv['LEJF_14'] = rng.choice([-1,1,2],len(lv),p = [0.1,0.5,0.4])
+    ## The BLS file has its own final weight, the LVWT the build uses is only in the IPUMS extract
+    lv['LUFINLWGT'] = rng.lognormal(15,0.5,len(lv))
+    _write_zip(lv,os.path.join(work,'data/workplace_flex/raw/lvresp-1718.zip'),'lvresp_1718.dat')
+
+    weights = pd.DataFrame({'YEAR':year,'CASEID':caseid,'PERNUM':1,'LINENO':1,
+                            'WT06':rng.lognormal(15,0.5,n),'LVWT':0.})
+    weights.loc[weights['CASEID'].isin(lv['TUCASEID']),'LVWT'] = lv['LUFINLWGT'].to_numpy()
+    weights.to_csv(os.path.join(work,'data/nondownloadable/atus_00002.csv'),index = False)
+
+
+def _write_zip(df, path, member):
+    with zipfile.ZipFile(path,'w',zipfile.ZIP_DEFLATED) as z:
+        z.writestr(member,df.to_csv(index = False))
+
+
+def _make_customer_interactions(work, rng, naics4, n_occ, io_size):
+    """
+    O*NET work activities (by OES code), BLS OES employment by industry and
+    occupation at each level, the BEA use table and the IO-NAICS match
+    """
+    oes = np.array(['{:02d}-{:04d}'.format(11 + 2*(i % 44),i) for i in range(n_occ)])
+    onet = pd.DataFrame({'oes_2018':np.repeat(oes,rng.integers(1,3,n_occ))})
+    onet['onet_soc_2019'] = onet['oes_2018'] + '.' + onet.groupby('oes_2018').cumcount().map('{:02d}'.format)
+    onet['soc_2018'] = onet['oes_2018']
+    n = len(onet)
+    values = {('Data Value','IM'):rng.uniform(1,5,n),('Data Value','LV'):rng.uniform(0,7,n),
+              ('N','IM'):np.where(rng.random(n) < 0.05,np.nan,rng.integers(10,40,n)),
+              ('N','LV'):rng.integers(10,40,n)}
+    onet_out = pd.DataFrame({(x,' '):onet[x] for x in ['onet_soc_2019','soc_2018','oes_2018']})
+    for key, x in values.items():
+        onet_out[key] = x
+    onet_out.columns = pd.MultiIndex.from_tuples(onet_out.columns)
+    onet_out.to_csv(os.path.join(work,'data/customer_interactions/onet_work_activities.csv'),index = False)
+
+    ## BLS industries: NAICS4 industries in a group are only reported as the group
+    grouped = {x for group in BLS_GROUPS.values() for x in group}
+    bls = {'naics4':['{}00'.format(x) for x in naics4 if x not in grouped] + list(BLS_GROUPS),
+           'naics3':sorted({'{}000'.format(x // 10) for x in naics4}),
+           'naics2':sorted({SECTORS[x // 100] for x in naics4})}
+    for ind, codes in bls.items():
+        k = min(n_occ,200)
+        df = pd.DataFrame({'naics':np.repeat(codes,k),
+                           'occ_code':np.concatenate([rng.choice(oes,k,replace = False) for x in codes])})
+        df['naics_title'] = 'Industry ' + df['naics']
+        df['occ_title'] = 'Occupation ' + df['occ_code']
+        df['occ_group'] = 'detailed'
+        df['tot_emp'] = rng.integers(30,100000,len(df)).astype(str)
+        df.loc[rng.random(len(df)) < 0.05,'tot_emp'] = '**'
+        df.to_csv(os.path.join(work,'data/customer_interactions/bls_data_{}.csv'.format(ind)),index = False)
+
+    _io_match().to_csv(os.path.join(work,'data/nondownloadable/io_naics_match.csv'),index = False)
+
+    ## Detailed IO codes (6 characters), aggregating to the 4-character codes of the match
+    io4 = _io_match()['input_naics'].to_numpy()
+    io6 = ['{}{:02d}'.format(io4[i % len(io4)],i // len(io4)) for i in range(io_size)]
+    use = rng.lognormal(3,2,(io_size,io_size)) * (rng.random((io_size,io_size)) < 0.1)
+    use[use == 0] = np.nan
+    t001 = np.nansum(use,axis = 1)
+    f01000 = rng.lognormal(5,2,io_size) * (rng.random(io_size) < 0.6)
+    header = ['Code','Commodity Description'] + io6 + ['T001','F01000','T019']
+    rows = [[c,'Commodity {}'.format(c)] + list(u) + [t,f,t + f] for c,u,t,f in zip(io6,use,t001,f01000)]
+    rows += [['V00100','Compensation'] + list(rng.lognormal(3,1,io_size)) + [np.nan]*3,
+             ['T005','Total intermediate'] + [np.nan]*(io_size + 3)]
+    sheet = [['Use table, 2012']] + [[]]*4 + [header] + rows
+    _write_sheet(sheet,os.path.join(work,'data/customer_interactions/Use_SUT_Framework_2007_2012_DET.xlsx'),'2012')
+
+
+def _write_sheet(rows, path, sheet_name):
+    """
+    Write rows to an Excel sheet cell by cell, strings as text cells (as the
+    codes are in the BEA files, even those that are all digits) and missing
+    values as empty cells
+    """
+    import openpyxl
+    book = openpyxl.Workbook(write_only = True)
+    sheet = book.create_sheet(sheet_name)
+    for row in rows:
+        sheet.append([None if isinstance(x,float) and np.isnan(x) else
+                      float(x) if isinstance(x,np.floating) else x for x in row])
+    book.save(path)
+
+
+def _make_compustat(work, rng, naics4, n):
+    """
+    Compustat firm-quarter panel as written by get_fixed_cost_share (comp_q_fc.csv)
+    """
+    ## 60 quarters per firm, all within 1995-2019
+    n_firms = -(-n // 60)
+    firm_naics = rng.choice(naics4,n_firms)
+    start = rng.integers(1995,2006,n_firms)
+    gvkey = np.repeat(np.arange(1000,1000 + n_firms),60)[:n]
+    firm = gvkey - 1000
+    quarter = start[firm]*4 + np.arange(n) % 60
+    keep = quarter < 2020*4
+    gvkey, firm, quarter = gvkey[keep], firm[keep], quarter[keep]
+    m = len(gvkey)
+
+    fyearq, fqtr = quarter // 4, quarter % 4 + 1
+    saleq_g = rng.normal(0,0.2,m)
+    ## Firm variable cost shares around 0.7
+    xoprq_g = rng.normal(0.7,0.15,n_firms)[firm]*saleq_g + rng.normal(0,0.1,m)
+    comp_q = pd.DataFrame({'gvkey':gvkey,'fyearq':fyearq,'fqtr':fqtr,
+                           'datadate':pd.to_datetime(pd.DataFrame({'year':fyearq,'month':3*fqtr,'day':1})).dt.strftime('%Y-%m-%d'),
+                           'xoprq':np.exp(rng.normal(4,1,m)),'saleq':np.exp(rng.normal(4.2,1,m)),
+                           'cogsq':np.exp(rng.normal(3.5,1,m)),'xsgaq':np.exp(rng.normal(2.5,1,m)),
+                           'atq':np.exp(rng.normal(6,1.5,m))})
+    comp_q['naics4'] = firm_naics[firm].astype(float)
+    comp_q['naics3'] = (firm_naics[firm] // 10).astype(float)
+    sector = firm_naics[firm] // 100
+    comp_q['naics2'] = pd.Series(sector).replace({32:31,33:31,45:44,49:48}).astype(float).to_numpy()
+    comp_q['yq'] = fyearq*10 + fqtr
+    ## As saved by build_comp_q: lags of the raw values, growth rates winsorized
+    from scipy.stats.mstats import winsorize
+    for var, g in [('xoprq',xoprq_g),('saleq',saleq_g)]:
+        comp_q['{}_l'.format(var)] = comp_q[var]*np.exp(-g)
+        comp_q['{}_g'.format(var)] = np.asarray(winsorize(g,inclusive = (False,False),limits = WINSOR_LIMITS))
+    comp_q.to_csv(os.path.join(work,'data/fixed_cost_share/comp_q_fc.csv'),index = False)
+
+
+def _make_investment_flex(root, rng, naics4, n):
+    """
+    Duke/CFO survey responses on investment flexibility (read from ../ of the build directory)
+    """
+    firm_naics = rng.choice(naics4,n)
+    survey = pd.DataFrame({'q16b_speed_flex':rng.integers(1,6,n).astype(float),
+                           'q16b_startdate_flex':rng.integers(1,6,n).astype(float),
+                           'naics4':firm_naics,'naics3':firm_naics // 10,
+                           'naics2':pd.Series(firm_naics // 100).replace({32:31,33:31,45:44,49:48}).to_numpy()})
+    survey.loc[rng.random(n) < 0.1,'q16b_speed_flex'] = np.nan
+    survey.to_csv(os.path.join(root,'investment_flex_raw.csv'),index = False)
+
+
+#%% Runner
+
+def io_kernel_stages(io_size = 1_000, density = 0.1, seed = 0):
+    """
+    Stages of the indirect customer interactions on a synthetic io_size x io_size use table
+    """
+    from Code.customer_interactions import _get_indirect
+    return {'io_kernel_table':Stage(_synthetic_io_table,(),{'io_size':io_size,'density':density,'seed':seed}),
+            'io_kernel_first_order':Stage(_get_indirect,(('io_kernel_table',0),('io_kernel_table',1))),
+            'io_kernel':Stage(_get_indirect,(('io_kernel_table',0),('io_kernel_table',1),('io_kernel_table',2)),
+                              {'method':'total'})}
+
+
+def _synthetic_io_table(io_size, density, seed):
+    from Code.customer_interactions import IOTable
+    rng = np.random.default_rng(seed)
+    codes = np.array(['{:04d}'.format(i) for i in range(io_size)])
+    use = sparse.random(io_size,io_size,density = density,format = 'csr',random_state = seed)
+    direct = pd.DataFrame({'input_naics':codes,'cust_int':rng.random(io_size)})
+    cons_share = pd.DataFrame({'input_naics':codes,'cons_share':rng.uniform(0.1,1,io_size)})
+    return IOTable(use,codes,codes),direct,cons_share
+
+
+def run_benchmarks(scale = 'small', measures = BENCH_MEASURES, repeat = 2, root = BENCH_DIR,
+                   results = RESULTS, seed = 0, regenerate = False):
+    """
+    Parameters
+    ----------
+    scale : key of SCALES, or a dict with the same keys
+    measures : list of measures to run (and io_kernel, the indirect measure
+        on an io_size x io_size use table)
+    repeat : runs of each measure, the first with an empty Excel/csv cache
+    root : directory of the synthetic inputs (written if missing or regenerate)
+    results : json lines file the results are appended to (None to not store them)
+    seed : random seed of the inputs
+    regenerate : write the inputs again even if they exist
+
+    Returns
+    -------
+    df of wall time, CPU time and peak RSS of each run, and the time of each stage
+    """
+    work = os.path.join(root,'work')
+    info_file = os.path.join(work,'scale.json')
+    current = None
+    if os.path.exists(info_file):
+        with open(info_file) as f:
+            current = json.load(f)
+    if regenerate or current is None or current['sizes'] != (SCALES[scale] if isinstance(scale,str) else scale) \
+            or current['seed'] != seed:
+        print("Writing {} synthetic inputs to {}...".format(scale,root))
+        make_inputs(root,scale,seed)
+    sizes = SCALES[scale] if isinstance(scale,str) else scale
+
+    info = {'commit':_git_commit(),'time':datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'scale':scale if isinstance(scale,str) else 'custom','sizes':sizes,'seed':seed,
+            'python':platform.python_version(),'pandas':pd.__version__,'numpy':np.__version__,
+            'machine':platform.node()}
+
+    ## Fresh process per measure, so peak RSS and cold caches are of that measure only
+    ctx = multiprocessing.get_context('spawn')
+    out = []
+    for measure in measures:
+        with ctx.Pool(1) as pool:
+            runs = pool.apply(_run_measure,(os.path.abspath(work),measure,repeat,sizes['io_size'],seed))
+        for run in runs:
+            out.append(dict(info,measure = measure,**run))
+
+    if results is not None:
+        folder = os.path.dirname(results)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(results,'a') as f:
+            for row in out:
+                f.write(json.dumps(row) + '\n')
+
+    return pd.DataFrame(out)[['measure','run','cache','wall','cpu','peak_rss_mb','stages']]
+
+
+def _run_measure(work, measure, repeat, io_size, seed):
+    """
+    Run one measure repeat times from work (in a fresh process)
+    """
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0,REPO_DIR)
+    os.chdir(work)
+    from Code.cache import clear_cache, clear_memo
+    from Code.pipeline import measure_stages
+
+    graph = io_kernel_stages(io_size,seed = seed) if measure == 'io_kernel' else measure_stages()
+    clear_cache()
+
+    runs = []
+    for run in range(repeat):
+        clear_memo()
+        wall, cpu = time.perf_counter(), time.process_time()
+        stages = _timed_run(graph,list(graph) if measure == 'io_kernel' else [measure])
+        runs.append({'run':run,'cache':'cold' if run == 0 else 'warm',
+                     'wall':time.perf_counter() - wall,'cpu':time.process_time() - cpu,
+                     'stages':stages})
+
+    ## Peak over all the runs (the first, cold run reads the most)
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+    for run in runs:
+        run['peak_rss_mb'] = peak
+    return runs
+
+
+def _timed_run(graph, targets):
+    """
+    Run the stages the targets need one after another, returns {stage: seconds}
+    """
+    results = {}
+    times = {}
+    for name in _order(graph,_needed(graph,targets)):
+        start = time.perf_counter()
+        results[name] = _call(graph[name],results)
+        times[name] = time.perf_counter() - start
+    return times
+
+
+IMPORT_MODULES = ['Code.cli','Code.pipeline','Code.enrich','Code.crosswalk','Code.download_data']
+HEAVY_MODULES = ['statsmodels','scipy.stats','scipy.sparse','pyarrow','wrds','requests','pyDataverse']
+
+
+def import_times(modules = IMPORT_MODULES, repeat = 3):
+    """
+    Parameters
+    ----------
+    modules : modules to import
+    repeat : imports of each module, each in a fresh interpreter
+
+    Returns
+    -------
+    df of the (fastest) import time of each module and which of HEAVY_MODULES
+    it loads (missing if the import fails, e.g. wrds not installed)
+    """
+    code = ("import sys, time, json; t = time.perf_counter(); import {}; "
+            "print(json.dumps([time.perf_counter() - t,[x for x in {} if x in sys.modules]]))")
+    out = []
+    for module in modules:
+        times, loaded = [], None
+        for _ in range(repeat):
+            run = subprocess.run([sys.executable,'-c',code.format(module,HEAVY_MODULES)],
+                                 cwd = REPO_DIR,capture_output = True,text = True)
+            if run.returncode != 0:
+                break
+            seconds, loaded = json.loads(run.stdout.strip().splitlines()[-1])
+            times.append(seconds)
+        out.append({'module':module,'seconds':min(times) if times else np.nan,
+                    'loads':', '.join(loaded) if loaded is not None else None})
+    return pd.DataFrame(out)
+
+
+def compare_results(results = RESULTS, value = 'wall', cache = 'warm'):
+    """
+    Parameters
+    ----------
+    results : json lines file written by run_benchmarks
+    value : wall, cpu or peak_rss_mb
+    cache : runs to compare, cold or warm
+
+    Returns
+    -------
+    df of the best value by scale and measure (rows) and commit (columns, oldest first)
+    """
+    with open(results) as f:
+        df = pd.DataFrame([json.loads(x) for x in f if x.strip()])
+    df = df.loc[df['cache'] == cache]
+    commits = df.groupby('commit')['time'].min().sort_values().index
+    out = df.pivot_table(index = ['scale','measure'],columns = 'commit',values = value,aggfunc = 'min')
+    return out.reindex(commits,axis = 1)
+
+
+def _git_commit():
+    try:
+        commit = subprocess.run(['git','rev-parse','--short','HEAD'],cwd = REPO_DIR,capture_output = True,
+                                text = True,check = True).stdout.strip()
+        dirty = subprocess.run(['git','status','--porcelain','--untracked-files=no'],cwd = REPO_DIR,
+                               capture_output = True,text = True,check = True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    print(bench_weighted_agg())
+    print(import_times())
+    pd.set_option('display.width',200)
+    print(run_benchmarks(sys.argv[1] if len(sys.argv) > 1 else 'small'))
@@ -0,0 +1,337 @@
+"""
+Caches of parsed inputs
+
+Each Excel workbook/sheet (or other parsed file) is parsed once and stored as a feather file in data/cache/,
+keyed by the content hash of the source file, the sheet and the parse options.
+If the source file changes the key changes, so the next read is a clean miss
+and the stale entry is removed. Least recently used entries are evicted once
+there are more than MAX_ENTRIES (only the entries, other files in the
+directory are never removed). Entries are written to a unique temporary file
+and moved into place, and an entry removed by another process in the meantime
+is a miss, so processes can share the cache.
+
+memoize keeps intermediate tables in memory for the rest of the run, keyed on the
+function arguments and the identity (path, modification time, size) of its
+source files, so a changed source file is picked up without a restart.
+
+jwb
+"""
+
+import os
+import re
+import glob
+import json
+import tempfile
+import pickle
+import base64
+import copy
+import hashlib
+import datetime
+import functools
+import pandas as pd
+import numpy as np
+
+CACHE_DIR = 'data/cache'
+MAX_ENTRIES = 32
+
+## Bump if the stored format changes, so old entries are not read back
+FORMAT_VERSION = 1
+
+## content hashes by (path, mtime, size), so a file is only hashed once per run
+_hashes = {}
+
+## in-process memo, {(function, args): (source file ids, result)}
+_memo = {}
+
+## pyarrow, imported on first use ([None] if it is not installed)
+_pyarrow = []
+
+## Names of the entries (source key-content hash), other files in the cache
+## directory are left alone
+_ENTRY = re.compile(r'[0-9a-f]{16}-[0-9a-f]{16}\.(feather|pkl)$')
+
+
+#%%
+
+def file_hash(path):
+    """
+    Parameters
+    ----------
+    path : file to hash
+
+    Returns
+    -------
+    sha256 hex digest of the file contents
+    """
+    key = _file_id(path)
+    if key not in _hashes:
+        h = hashlib.sha256()
+        with open(path,'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20),b''):
+                h.update(chunk)
+        _hashes[key] = h.hexdigest()
+    return _hashes[key]
+
+
+def read_excel_cached(path, sheet_name = 0, cache_dir = CACHE_DIR, max_entries = MAX_ENTRIES, **kwargs):
+    """
+    Parameters
+    ----------
+    path : excel file to read
+    sheet_name : sheet to read (single sheet only)
+    cache_dir : directory to keep the cache in
+    max_entries : number of cached sheets to keep
+    **kwargs : passed on to pd.read_excel
+
+    Returns
+    -------
+    df : same as pd.read_excel(path, sheet_name = sheet_name, **kwargs)
+    """
+    return read_cached(path,pd.read_excel,dict(sheet_name = sheet_name,**kwargs),cache_dir,max_entries)
+
+
+def read_csv_cached(path, cache_dir = CACHE_DIR, max_entries = MAX_ENTRIES, **kwargs):
+    """
+    Same as read_excel_cached, for pd.read_csv(path, **kwargs)
+    """
+    return read_cached(path,pd.read_csv,kwargs,cache_dir,max_entries)
+
+
+def read_cached(path, parse, options, cache_dir = CACHE_DIR, max_entries = MAX_ENTRIES):
+    """
+    Parameters
+    ----------
+    path : source file
+    parse : function returning a df from parse(path, **options), must be 
+        importable (module level) so its name identifies it
+    options : dict of keyword arguments of parse (json-serializable, or with a stable repr)
+    cache_dir : directory to keep the cache in
+    max_entries : number of cached tables to keep
+
+    Returns
+    -------
+    df : parse(path, **options), from the cache if the source hasn't changed
+    """
+    options_key = json.dumps(options,sort_keys = True,default = repr)
+    source = hashlib.sha256('{}|{}.{}|{}|{}'.format(
+             os.path.abspath(path),parse.__module__,parse.__qualname__,
+             options_key,FORMAT_VERSION).encode()).hexdigest()[:16]
+    key = os.path.join(cache_dir,'{}-{}'.format(source,file_hash(path)[:16]))
+
+    for loc in [key + '.feather',key + '.pkl']:
+        if os.path.exists(loc) and (loc.endswith('.pkl') or _arrow() is not None):
+            try:
+                os.utime(loc)
+                return _read_entry(loc)
+            except FileNotFoundError:
+                ## Evicted by another process in the meantime
+                pass
+
+    df = parse(path,**options)
+
+    os.makedirs(cache_dir,exist_ok = True)
+    ## Source changed: drop entries of the same file/parser/options with the old hash
+    for stale in _entries(cache_dir,source):
+        if not stale.startswith(key + '.'):
+            _remove(stale)
+    _write_entry(df,key)
+    _evict(cache_dir,max_entries)
+
+    return df
+
+
+def clear_cache(cache_dir = CACHE_DIR):
+    """
+    Remove all cached sheets
+    """
+    for entry in _entries(cache_dir):
+        _remove(entry)
+    _hashes.clear()
+
+
+def memoize(files):
+    """
+    Parameters
+    ----------
+    files : list of source files the function reads, or a function of the
+        call arguments returning that list
+
+    Returns
+    -------
+    decorator that memoizes the function in-process. Results are returned as
+    copies, so callers can modify them. The memo of one function is cleared
+    with fun.cache_clear(), all memos with clear_memo()
+    """
+    def decorator(fun):
+        name = '{}.{}'.format(fun.__module__,fun.__qualname__)
+
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            sources = files(*args,**kwargs) if callable(files) else files
+            ids = tuple(_file_id(x) for x in sources)
+            key = (name,args,tuple(sorted(kwargs.items())))
+            if key not in _memo or _memo[key][0] != ids:
+                _memo[key] = (ids,fun(*args,**kwargs))
+            return copy.deepcopy(_memo[key][1])
+
+        wrapper.cache_clear = lambda: clear_memo(name)
+        return wrapper
+    return decorator
+
+
+def clear_memo(name = None):
+    """
+    Parameters
+    ----------
+    name : 'module.function' to clear, the default None clears everything
+    """
+    for key in [x for x in _memo if name is None or x[0] == name]:
+        del _memo[key]
+
+
+def _arrow():
+    """
+    Returns
+    -------
+    pyarrow (with pyarrow.feather loaded), None if it is not installed
+    """
+    if not _pyarrow:
+        try:
+            import pyarrow
+            import pyarrow.feather
+            _pyarrow.append(pyarrow)
+        except ImportError:
+            _pyarrow.append(None)
+    return _pyarrow[0]
+
+
+def _file_id(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path),stat.st_mtime_ns,stat.st_size)
+
+
+#%% Storage helpers
+
+def _entries(cache_dir, source = None):
+    entries = glob.glob(os.path.join(cache_dir,(source or '*') + '-*'))
+    return [x for x in entries if _ENTRY.match(os.path.basename(x))]
+
+
+def _remove(path):
+    ## Other processes sharing the cache may have removed it already
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _evict(cache_dir, max_entries):
+    entries = sorted(_entries(cache_dir),key = _mtime,reverse = True)
+    for entry in entries[max_entries:]:
+        _remove(entry)
+
+
+def _write_entry(df, key):
+    loc = key + '.pkl'
+    pa = _arrow()
+    if pa is not None:
+        try:
+            table = _to_table(df)
+            loc = key + '.feather'
+        except (_Unsupported,pa.ArrowException):
+            ## Not representable as columns, keep as a pickle instead
+            table = None
+    ## Unique per writer, so processes parsing the same file don't write to the same file
+    fd, tmp = tempfile.mkstemp(suffix = '.tmp',prefix = os.path.basename(loc) + '.',
+                               dir = os.path.dirname(loc))
+    os.close(fd)
+    try:
+        if loc.endswith('.pkl'):
+            df.to_pickle(tmp)
+        else:
+            pa.feather.write_feather(table,tmp)
+        os.replace(tmp,loc)
+    except BaseException:
+        _remove(tmp)
+        raise
+
+
+def _read_entry(loc):
+    if loc.endswith('.pkl'):
+        return pd.read_pickle(loc)
+    return _from_table(_arrow().feather.read_table(loc))
+
+
+class _Unsupported(Exception):
+    pass
+
+
+## Excel object columns mix strings, numbers and dates, which arrow can't store in one
+## column, so they are stored as strings with a type tag per cell
+_PARSE = {1:str, 2:int, 3:float, 4:pd.Timestamp, 5:lambda x: x == 'True'}
+
+
+def _kind(x):
+    if x is None or (isinstance(x,float) and np.isnan(x)):
+        return 0
+    if isinstance(x,(bool,np.bool_)):
+        return 5
+    if isinstance(x,str):
+        return 1
+    if isinstance(x,(int,np.integer)):
+        return 2
+    if isinstance(x,(float,np.floating)):
+        return 3
+    if isinstance(x,datetime.datetime):
+        return 4
+    raise _Unsupported(type(x))
+
+
+def _to_table(df):
+    cols = {}
+    for i in range(df.shape[1]):
+        s = df.iloc[:,i]
+        name = 'c{}'.format(i)
+        if s.dtype == object:
+            kinds = np.array([_kind(x) for x in s],dtype = np.int8)
+            cols[name] = pd.Series([str(x) if k else None for x,k in zip(s,kinds)],dtype = object)
+            cols[name + '_kind'] = kinds
+        else:
+            cols[name] = s.reset_index(drop = True)
+
+    meta = {b'columns':base64.b64encode(pickle.dumps(df.columns)),
+            b'index':base64.b64encode(pickle.dumps(df.index))}
+    table = _arrow().Table.from_pandas(pd.DataFrame(cols),preserve_index = False)
+    return table.replace_schema_metadata(meta)
+
+
+def _from_table(table):
+    meta = table.schema.metadata
+    stored = table.to_pandas()
+    columns = pickle.loads(base64.b64decode(meta[b'columns']))
+    index = pickle.loads(base64.b64decode(meta[b'index']))
+
+    data = {}
+    for i in range(len(columns)):
+        name = 'c{}'.format(i)
+        if name + '_kind' in stored:
+            kinds = stored[name + '_kind'].to_numpy()
+            text = stored[name].to_numpy()
+            values = np.full(len(kinds),np.nan,dtype = object)
+            for k, parse in _PARSE.items():
+                hit = np.flatnonzero(kinds == k)
+                values[hit] = [parse(x) for x in text[hit]]
+            data[i] = values
+        else:
+            data[i] = stored[name].to_numpy()
+
+    df = pd.DataFrame(data,index = index)
+    df.columns = columns
+    return df
@@ -0,0 +1,156 @@
+"""
+Command line entry point
+
+    python -m Code.cli build [--measures cust_int ...] [--level 4 3 2] [--workers N] [--no-store] [--trace]
+                             [--partitions] [--csv-only]
+    python -m Code.cli grid grid.json [--measures ...] [--workers N] [--out data/grid.csv]
+    python -m Code.cli download [workplace_flex customer_interactions fixed_cost_share industry_data] [--refresh]
+    python -m Code.cli bench [small|medium|large] [--measures ...] [--repeat 2] [--imports]
+
+Each command only imports the modules it needs, so building the measures
+from downloaded data does not need wrds or pyDataverse (only download does),
+and --help doesn't import pandas at all.
+
+jwb
+"""
+
+import os
+import sys
+import argparse
+
+## Same as Code.pipeline.MEASURES and Code.bench.BENCH_MEASURES, kept here so
+## parsing the arguments doesn't import them
+MEASURES = ['workplace_flex','investment_flex','cust_int','fixed_cost_share']
+BENCH_MEASURES = MEASURES + ['io_kernel']
+DOWNLOADS = ['workplace_flex','customer_interactions','fixed_cost_share','industry_data']
+OUT_DIR = 'Out_Data'
+GRID_OUT = 'data/grid.csv'
+
+
+#%%
+
+def main(argv = None):
+    """
+    Parameters
+    ----------
+    argv : list of arguments, the default None uses sys.argv[1:]
+    """
+    args = _parser().parse_args(argv)
+    return args.run(args)
+
+
+def build(args):
+    from Code.pipeline import build_measures, measure_stages
+    from Code.artifacts import ARTIFACT_DIR
+    from Code.instrument import enable_trace, write_trace
+    from Code.output import write_measures
+
+    if args.trace:
+        enable_trace()
+    ## All levels are built in one run of each measure
+    measures = build_measures(args.measures,args.workers,args.indirect_method,
+                              None if args.no_store else ARTIFACT_DIR,args.level)
+    if args.trace:
+        write_trace()
+
+    for name, dfs in measures.items():
+        for level in args.level:
+            ind = 'naics{}'.format(level)
+            print("{} ({}): {}".format(name,ind,"no data, not saved" if dfs is None else "{} industries".format(len(dfs[ind]))))
+    ## All levels in one file, coarser levels fall back to the measures built at them
+    files = write_measures(measures,args.out,graph = measure_stages(args.indirect_method,args.level),
+                           columnar = not args.csv_only,partitions = args.partitions)
+    print("Saved {}".format(', '.join(files)))
+
+
+def grid(args):
+    import json
+    from Code.grid import run_grid
+
+    with open(args.grid) as f:
+        specs = json.load(f)
+    results = run_grid(specs,args.measures,args.workers)
+    if os.path.dirname(args.out) and not os.path.exists(os.path.dirname(args.out)):
+        os.makedirs(os.path.dirname(args.out))
+    results.to_csv(args.out,index = False)
+    print("{} specifications, {} values saved to {}".format(results['spec'].nunique(),len(results),args.out))
+
+
+def download(args):
+    import Code.download_data as download_data
+
+    ## Everything if no data is named
+    for name in args.data or DOWNLOADS:
+        fun = getattr(download_data,'get_{}'.format(name))
+        ## Compustat has no manifest, changed partitions are pulled again anyway
+        if args.refresh and name != 'fixed_cost_share':
+            fun(refresh = True)
+        else:
+            fun()
+
+
+def bench(args):
+    import pandas as pd
+    from Code.bench import run_benchmarks, import_times
+
+    pd.set_option('display.width',200)
+    if args.imports:
+        print(import_times())
+    print(run_benchmarks(args.scale,args.measures,args.repeat))
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog = 'python -m Code.cli',
+                                     description = 'Build the industry flexibility measures')
+    commands = parser.add_subparsers(dest = 'command',required = True)
+
+    build_parser = commands.add_parser('build',help = 'build the measures and save them as csv')
+    build_parser.add_argument('--measures',nargs = '+',choices = MEASURES,default = MEASURES)
+    build_parser.add_argument('--level',type = int,nargs = '+',choices = [2,3,4,5,6],default = [4],
+                              help = 'naics levels, built in one run (workplace_flex: 2-6, others: 2-4)')
+    build_parser.add_argument('--workers',type = int,default = None,help = 'processes, default all cores')
+    build_parser.add_argument('--indirect-method',default = 'first_order',choices = ['first_order','total'])
+    build_parser.add_argument('--no-store',action = 'store_true',
+                              help = 'rebuild everything (default only rebuilds what is out of date)')
+    build_parser.add_argument('--trace',action = 'store_true',help = 'write stage times to data/trace.json')
+    build_parser.add_argument('--out',default = OUT_DIR,help = 'folder to save the measures in')
+    build_parser.add_argument('--partitions',action = 'store_true',
+                              help = 'also save each naics level to its own parquet file')
+    build_parser.add_argument('--csv-only',action = 'store_true',
+                              help = 'only save the csv per measure, not the parquet file of all measures')
+    build_parser.set_defaults(run = build)
+
+    grid_parser = commands.add_parser('grid',help = 'build the measures under a grid of specifications')
+    grid_parser.add_argument('grid',help = 'json file with a dict of {setting: [values]} or a list of '
+                             'specifications, settings are those of Code.grid.SPEC_DEFAULTS')
+    grid_parser.add_argument('--measures',nargs = '+',choices = MEASURES,default = MEASURES)
+    grid_parser.add_argument('--workers',type = int,default = None,help = 'processes, default all cores')
+    grid_parser.add_argument('--out',default = GRID_OUT,help = 'csv to save the results in')
+    grid_parser.set_defaults(run = grid)
+
+    download_parser = commands.add_parser('download',help = 'download the raw data')
+    ## Checked by type rather than choices, argparse checks choices against an empty list
+    download_parser.add_argument('data',nargs = '*',type = _download_name,default = None,
+                                 help = 'data to download ({}), default all of it'.format(', '.join(DOWNLOADS)))
+    download_parser.add_argument('--refresh',action = 'store_true',
+                                 help = 'replace the manifest entries of the files, if a source was updated')
+    download_parser.set_defaults(run = download)
+
+    bench_parser = commands.add_parser('bench',help = 'benchmark the measures on synthetic data')
+    bench_parser.add_argument('scale',nargs = '?',default = 'small',choices = ['small','medium','large'])
+    bench_parser.add_argument('--measures',nargs = '+',choices = BENCH_MEASURES,default = BENCH_MEASURES)
+    bench_parser.add_argument('--repeat',type = int,default = 2)
+    bench_parser.add_argument('--imports',action = 'store_true',help = 'also time the imports of the modules')
+    bench_parser.set_defaults(run = bench)
+
+    return parser
+
+
+def _download_name(name):
+    if name not in DOWNLOADS:
+        raise argparse.ArgumentTypeError("invalid choice: '{}' (choose from {})".format(name,', '.join(DOWNLOADS)))
+    return name
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,471 @@
+"""
+Partitioned, incremental Compustat pull for the fixed cost share measure
+
+comp.fundq is pulled in fiscal-year partitions (fyearq ranges), in parallel over
+a small pool of connections, and each partition is kept in FUNDQ_DIR. A cheap
+per-year fingerprint (row count, last datadate, sums of the variables) is
+queried first, so a rerun only fetches partitions that are new or changed.
+Growth rates are kept per partition too, and only recomputed for changed
+partitions and the partition after each one (whose first quarter lags into it).
+
+Any connection with raw_sql (wrds.Connection) or a DB-API connection read with
+pd.read_sql works, e.g. sqlite3 (with check_same_thread = False) with a
+database attached as comp that has the same comp.fundq/comp.company tables.
+
+jwb
+"""
+
+import os
+import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import numpy as np
+from Code.instrument import traced, stage
+from Code.naics import parse_naics, naics_prefix, merge_sectors
+
+FUNDQ_DIR = 'data/fixed_cost_share/fundq'
+FIRST_YEAR = 1995
+LAST_YEAR = 2019
+YEARS_PER_PARTITION = 5
+
+## Bump if the stored partitions or growth rates change, so they are rebuilt
+FORMAT_VERSION = 1
+GROWTH_VERSION = 2
+
+FUNDQ_VARS = ['gvkey','fyearq','fqtr','datadate','xoprq','saleq','cogsq','xsgaq','atq']
+GROWTH_VARS = ['xoprq','saleq']
+
+## Panel saved by get_fixed_cost_share, and the winsorization of its growth rates (each tail)
+COMP_Q_FILE = 'data/fixed_cost_share/comp_q_fc.csv'
+WINSOR_LIMITS = (0.01,0.01)
+
+FUNDQ_FILTER = """
+where consol = 'C' and indfmt = 'INDL' and datafmt = 'STD' and popsrc = 'D'
+and fyearq>={start} and fyearq<={end}
+"""
+
+FUNDQ_QUERY = """
+select distinct gvkey, fyearq, fqtr, datadate, xoprq, saleq, cogsq,
+xsgaq, atq
+from comp.fundq
+""" + FUNDQ_FILTER
+
+FINGERPRINT_QUERY = """
+select fyearq, count(*) as n, max(datadate) as datadate, sum(xoprq) as xoprq,
+sum(saleq) as saleq, sum(cogsq) as cogsq, sum(xsgaq) as xsgaq, sum(atq) as atq
+from comp.fundq
+""" + FUNDQ_FILTER + """
+group by fyearq
+"""
+
+COMPANY_QUERY = """
+select distinct gvkey, naics, conm
+from comp.company
+"""
+
+## need to replace some Compustat NAICS code,
+## see here https://tax.wv.gov/Documents/TaxForms/TrendAndPercentGoodTables.NAICS-codes.pdf
+## Also, see sample company names of replaced naics code
+## dictionary = {old_naics:2017_naics}
+NAICS_REPLACE = {2331: 2372, 2332: 2361, 2333: 2362, 2341: 2373, 2349: 2379,
+                 2351: 2382, 2352: 2383, 2353: 2382, 2354: 2381, 2356: 2381,
+                 2359: 2389, 4211: 4231, 4212: 4232, 4213: 4233, 4214: 4234,
+                 4215: 4235, 4216: 4236, 4217: 4237, 4218: 4238, 4219: 4239,
+                 4221: 4241, 4222: 4242, 4223: 4243, 4224: 4244, 4225: 4245,
+                 4226: 4246, 4227: 4247, 4228: 4248, 4229: 4249, 4521: 4522,
+                 4529: 4523, 5131: 5151, 5132: 5152, 5133: 5173, 5141: 5182,
+                 5142: 5182, 5161: 5191, 5171: 5173, 5172: 5173, 5175: 5152,
+                 5181: 5191, 7221: 7225, 7222: 7225, 234: 237, 235: 238, 421:
+                 423, 422: 424, 513: 515}
+
+## NAICS_REPLACE as an array indexed by code (codes not in it map to themselves)
+_NAICS_REPLACE = np.arange(10000)
+_NAICS_REPLACE[list(NAICS_REPLACE)] = list(NAICS_REPLACE.values())
+
+
+#%%
+
+@traced
+def build_comp_q(connect, first_year = FIRST_YEAR, last_year = LAST_YEAR,
+                 years_per_partition = YEARS_PER_PARTITION, workers = 4, folder = FUNDQ_DIR):
+    """
+    Parameters
+    ----------
+    connect : function returning a new database connection
+    first_year, last_year : fiscal years (fyearq) to pull
+    years_per_partition : fiscal years in each partition
+    workers : number of connections/partitions pulled at the same time
+    folder : directory to keep the partitions in
+
+    Returns
+    -------
+    comp_q : Compustat firm-quarter panel with industry codes and winsorized
+        log changes of operating costs and sales (xoprq_g, saleq_g), as
+        saved to data/fixed_cost_share/comp_q_fc.csv
+    """
+    partitions = fyear_partitions(first_year,last_year,years_per_partition)
+
+    pool = _ConnectionPool(connect,workers)
+    try:
+        changed = pull_fundq(pool,partitions,folder)
+        ind_codes = _industry_codes(pool.raw_sql(COMPANY_QUERY))
+    finally:
+        pool.close()
+
+    growth = update_growth(partitions,changed,folder)
+
+    ## merge on ind codes
+    comp_q = growth.merge(ind_codes[['gvkey','naics4','naics3','naics2']])
+    comp_q = comp_q.dropna(subset = ['naics4','naics3','naics2'],how = 'any')
+
+    ## Drop where missing
+    g_vars = ['{}_g'.format(var) for var in GROWTH_VARS]
+    comp_q = comp_q.dropna(subset = g_vars,how = 'any')
+
+    ## Winsorize vars
+    from scipy.stats.mstats import winsorize
+    with stage('winsorize',len(comp_q)):
+        for var in g_vars:
+            comp_q[var] = winsorize(comp_q[var],inclusive = (False,False),limits = WINSOR_LIMITS,nan_policy = 'omit')
+
+    out_vars = FUNDQ_VARS + ['naics4','naics3','naics2','yq']
+    for var in GROWTH_VARS:
+        out_vars += ['{}_l'.format(var),'{}_g'.format(var)]
+
+    return comp_q.sort_values(by = ['gvkey','yq'],kind = 'mergesort').reindex(out_vars,axis = 1).reset_index(drop = True)
+
+
+def fyear_partitions(first_year = FIRST_YEAR, last_year = LAST_YEAR, years_per_partition = YEARS_PER_PARTITION):
+    """
+    Returns
+    -------
+    list of (start, end) fiscal year ranges covering first_year to last_year
+    """
+    return [(start,min(start + years_per_partition - 1,last_year))
+            for start in range(first_year,last_year + 1,years_per_partition)]
+
+
+@traced
+def pull_fundq(pool, partitions, folder = FUNDQ_DIR):
+    """
+    Parameters
+    ----------
+    pool : _ConnectionPool
+    partitions : list of (start, end) fiscal year ranges
+    folder : directory to keep the partitions in
+
+    Returns
+    -------
+    list of partitions that were (re)fetched
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    manifest = _load_manifest(folder)
+
+    ## One cheap aggregate query says which partitions changed on the server
+    start, end = partitions[0][0], partitions[-1][1]
+    prints = pool.raw_sql(FINGERPRINT_QUERY.format(start = start,end = end))
+    prints = {name:_fingerprint(prints,part) for name,part in
+              zip([_partition_name(x) for x in partitions],partitions)}
+
+    todo = [part for part in partitions
+            if manifest.get(_partition_name(part),{}).get('fingerprint') != prints[_partition_name(part)]
+            or not os.path.exists(_fundq_file(folder,part))]
+
+    def _pull(part):
+        fundq = pool.raw_sql(FUNDQ_QUERY.format(start = part[0],end = part[1]))
+        fundq = _clean_fundq(fundq)
+        tmp = _fundq_file(folder,part) + '.tmp'
+        fundq.to_pickle(tmp)
+        os.replace(tmp,_fundq_file(folder,part))
+        return part
+
+    for part in pool.map(_pull,todo):
+        entry = manifest.setdefault(_partition_name(part),{})
+        entry['fingerprint'] = prints[_partition_name(part)]
+        ## Growth rates of this partition have to be recomputed
+        entry.pop('growth',None)
+        _save_manifest(folder,manifest)
+
+    return todo
+
+
+@traced
+def update_growth(partitions, changed = None, folder = FUNDQ_DIR):
+    """
+    Parameters
+    ----------
+    partitions : list of (start, end) fiscal year ranges, in order
+    changed : partitions whose raw data changed (None if none did)
+    folder : directory the partitions are kept in
+
+    Returns
+    -------
+    panel of all partitions with log changes of GROWTH_VARS (not yet winsorized)
+    """
+    changed = changed or []
+    manifest = _load_manifest(folder)
+
+    out = []
+    for i, part in enumerate(partitions):
+        name = _partition_name(part)
+        prev = partitions[i - 1] if i > 0 else None
+        ## The first quarter of a partition lags into the previous one
+        stale = (part in changed or (prev is not None and prev in changed)
+                 or manifest.get(name,{}).get('growth') != _growth_key(prev)
+                 or not os.path.exists(_growth_file(folder,part)))
+        if stale:
+            growth = _partition_growth(folder,part,prev)
+            tmp = _growth_file(folder,part) + '.tmp'
+            growth.to_pickle(tmp)
+            os.replace(tmp,_growth_file(folder,part))
+            manifest.setdefault(name,{})['growth'] = _growth_key(prev)
+            _save_manifest(folder,manifest)
+        else:
+            growth = pd.read_pickle(_growth_file(folder,part))
+        out.append(growth)
+
+    return pd.concat(out,ignore_index = True)
+
+
+#%% Cleaning and growth rates
+
+@traced
+def log_growth(panel, variables, firm = 'gvkey', time = 'yq'):
+    """
+    Parameters
+    ----------
+    panel : firm-quarter panel
+    variables : list of variables to take log changes of
+    firm : firm identifier
+    time : fiscal quarter as year*10 + quarter (yq)
+
+    Returns
+    -------
+    panel sorted by firm and time with the lag ({var}_l) and log change ({var}_g)
+    of every variable, missing unless the previous row is the same firm in
+    the previous quarter
+
+    The panel is sorted once and the lags are shifted arrays, the consecutive
+    quarter check is done on quarter numbers (year*4 + quarter)
+    """
+    order = np.lexsort((panel[time].to_numpy(),panel[firm].to_numpy()))
+    panel = panel.iloc[order].reset_index(drop = True)
+
+    ids = panel[firm].to_numpy()
+    yq = panel[time].to_numpy().astype(np.int64)
+    quarter = (yq // 10)*4 + yq % 10
+    ## Previous row is the same firm, one quarter earlier
+    consecutive = np.zeros(len(panel),dtype = bool)
+    consecutive[1:] = (ids[1:] == ids[:-1]) & (quarter[1:] - quarter[:-1] == 1)
+
+    with np.errstate(divide = 'ignore',invalid = 'ignore'):
+        for var in variables:
+            x = panel[var].to_numpy(dtype = float)
+            lag = np.full(len(x),np.nan)
+            lag[1:] = x[:-1]
+            lag[~consecutive] = np.nan
+            panel['{}_l'.format(var)] = lag
+            panel['{}_g'.format(var)] = np.log(x) - np.log(lag)
+
+    return panel
+
+
+@traced
+def comp_q_growth(limits = WINSOR_LIMITS, variables = GROWTH_VARS + ['cogsq'], path = COMP_Q_FILE):
+    """
+    Parameters
+    ----------
+    limits : winsorization of each tail of the growth rates, None for none
+    variables : variables to take log changes of ({var}_g)
+    path : panel saved by get_fixed_cost_share (comp_q_fc.csv)
+
+    Returns
+    -------
+    the saved panel with the growth rates recomputed before winsorizing and
+    winsorized at limits, so the fixed cost share can be estimated with other
+    limits or variables (e.g. cogsq_g) without pulling Compustat again
+
+    Variables with a saved lag ({var}_l) get the same growth rates as
+    build_comp_q (so the default limits give the saved ones back). Others are
+    lagged within the saved panel, so they are missing after a quarter that
+    build_comp_q dropped, as are non-positive values
+    """
+    with stage('read_comp_q') as s:
+        comp_q = pd.read_csv(path)
+        s.rows_out = len(comp_q)
+
+    lagged = [x for x in variables if '{}_l'.format(x) in comp_q]
+    comp_q = log_growth(comp_q,[x for x in variables if x not in lagged])
+    with np.errstate(divide = 'ignore',invalid = 'ignore'):
+        for var in lagged:
+            comp_q['{}_g'.format(var)] = np.log(comp_q[var]) - np.log(comp_q['{}_l'.format(var)])
+
+    from scipy.stats.mstats import winsorize
+    with stage('winsorize',len(comp_q)):
+        for var in ['{}_g'.format(x) for x in variables]:
+            x = comp_q[var].to_numpy(dtype = float)
+            valid = np.isfinite(x)
+            if limits is not None and valid.any():
+                ## Only the non-missing values (nan_policy = 'omit' counts missing values in the upper tail)
+                x[valid] = winsorize(x[valid],inclusive = (False,False),limits = limits)
+            comp_q[var] = np.where(valid,x,np.nan)
+
+    return comp_q
+
+
+def normalize_naics(naics):
+    """
+    Parameters
+    ----------
+    naics : array or series of Compustat naics codes of any length (numbers or strings)
+
+    Returns
+    -------
+    array of the 2017 naics4 codes (first 4 digits, or fewer for shorter codes),
+    with the legacy codes in NAICS_REPLACE replaced, nan if missing
+    """
+    codes = naics_prefix(parse_naics(naics,errors = 'coerce'),4)
+    return np.where(codes > 0,_NAICS_REPLACE[np.maximum(codes,0)],np.nan)
+
+
+def _clean_fundq(fundq):
+    fundq = fundq.fillna(value = np.nan)
+    ## drop missing
+    fundq = fundq.dropna(subset = ['gvkey','fyearq','fqtr','atq','saleq','xoprq'],how = 'any')
+    fundq['gvkey'] = fundq['gvkey'].astype(int)
+
+    ## require non-negative sales, assets, operating costs
+    for var in ['atq','saleq','xoprq']:
+        fundq = fundq.loc[fundq[var]>0]
+
+    fundq['yq'] = fundq['fyearq'].astype(int)*10 + fundq['fqtr'].astype(int)
+
+    return fundq.sort_values(by = ['gvkey','fyearq'],kind = 'mergesort').reset_index(drop = True)
+
+
+def _partition_growth(folder, part, prev):
+    fundq = pd.read_pickle(_fundq_file(folder,part))
+    if prev is not None:
+        ## Last fiscal year of the previous partition, for the lags
+        prev_fundq = pd.read_pickle(_fundq_file(folder,prev))
+        fundq = pd.concat([prev_fundq.loc[prev_fundq['fyearq'] == prev[1]],fundq],ignore_index = True)
+
+    fundq = log_growth(fundq,GROWTH_VARS)
+
+    return fundq.loc[fundq['fyearq'] >= part[0]].reset_index(drop = True)
+
+
+def _industry_codes(ind_codes):
+    ind_codes = ind_codes.sort_values(by = ['gvkey']).reset_index(drop=True)
+
+    ind_codes['naics'] = pd.to_numeric(ind_codes['naics'])
+
+    ## naics4, replaced to match 2017 naics
+    ind_codes['naics4'] = normalize_naics(ind_codes['naics'])
+    ## Drop 9999, not relevant
+    ind_codes = ind_codes.loc[ind_codes['naics4']!=9999]
+    ## Get naics3 and naics2
+    codes = parse_naics(ind_codes['naics4'])
+    ind_codes['naics3'] = np.where(codes > 0,naics_prefix(codes,3),np.nan)
+
+    ## NAICS2 doesn't separate 31-33, 44-45, etc., change back at end
+    ind_codes['naics2'] = np.where(codes > 0,merge_sectors(naics_prefix(codes,2)),np.nan)
+
+    ind_codes['gvkey'] = ind_codes['gvkey'].astype(int)
+
+    return ind_codes
+
+
+#%% Partition bookkeeping
+
+def _partition_name(part):
+    return 'fundq_{}_{}'.format(*part)
+
+
+def _fundq_file(folder, part):
+    return os.path.join(folder,'{}.pkl'.format(_partition_name(part)))
+
+
+def _growth_file(folder, part):
+    return os.path.join(folder,'growth_{}_{}.pkl'.format(*part))
+
+
+def _growth_key(prev):
+    ## Growth rates depend on the code version and on which partition the lags come from
+    return '{}|{}'.format(GROWTH_VERSION,None if prev is None else _partition_name(prev))
+
+
+def _fingerprint(prints, part):
+    rows = prints.loc[(prints['fyearq'].astype(int) >= part[0]) & (prints['fyearq'].astype(int) <= part[1])]
+    rows = rows.sort_values(by = 'fyearq')
+    out = {'version':FORMAT_VERSION}
+    for _, row in rows.iterrows():
+        ## Round the sums, so the summation order on the server doesn't matter
+        out[str(int(row['fyearq']))] = [str(row['datadate'])] + [
+            None if pd.isnull(row[x]) else float('{:.10g}'.format(row[x]))
+            for x in ['n','xoprq','saleq','cogsq','xsgaq','atq']]
+    return out
+
+
+def _load_manifest(folder):
+    loc = os.path.join(folder,'manifest.json')
+    if not os.path.exists(loc):
+        return {}
+    with open(loc) as f:
+        return json.load(f)
+
+
+def _save_manifest(folder, manifest):
+    loc = os.path.join(folder,'manifest.json')
+    with open(loc + '.tmp','w') as f:
+        json.dump(manifest,f,indent = 1,sort_keys = True)
+    os.replace(loc + '.tmp',loc)
+
+
+class _ConnectionPool:
+    """
+    Small pool of database connections shared by threads. Connections are
+    opened as they are needed (at most size of them) and closed by close()
+    """
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = max(int(size),1)
+        self.idle = queue.LifoQueue()
+        self.opened = []
+
+    def _open(self):
+        db = self.connect()
+        self.opened.append(db)
+        return db
+
+    def _get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def raw_sql(self, sql):
+        db = self._get()
+        try:
+            if hasattr(db,'raw_sql'):
+                return db.raw_sql(sql)
+            return pd.read_sql(sql,db)
+        finally:
+            self.idle.put(db)
+
+    def map(self, fun, items):
+        items = list(items)
+        if not items:
+            return []
+        ## Open the connections here rather than in the threads (wrds may prompt for a login)
+        while len(self.opened) < min(self.size,len(items)):
+            self.idle.put(self._open())
+        with ThreadPoolExecutor(max_workers = min(self.size,len(items))) as pool:
+            return list(pool.map(fun,items))
+
+    def close(self):
+        for db in self.opened:
+            db.close()
+        self.opened = []
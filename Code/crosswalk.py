@@ -0,0 +1,276 @@
+"""
+Weighted crosswalks between NAICS vintages and Census (IND) industry codes
+
+A crosswalk is a sparse matrix with one row per target code and one column
+per source code, with rows summing to one, so converting a measure (all its
+columns at once) is one sparse matrix product: each target code gets the
+weighted mean of the source codes that map to it.
+
+NAICS vintages are linked by the Census concordances (6-digit industries)
+between consecutive vintages in CONCORDANCE_FILES. A 6-digit industry split
+over several industries of the other vintage has equal weight on each, and
+the weights are summed to the level of the crosswalk. Vintages further apart
+are the product of the crosswalks in between (e.g. 2002 -> 2007 -> 2012).
+Census IND codes map to 2012 NAICS with the Soltas allocation factors (afactor).
+
+jwb
+"""
+
+import re
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from Code.cache import read_excel_cached, memoize
+from Code.measure_store import naics_column, value_columns
+from Code.naics import naics_prefix
+
+VINTAGES = [2002,2007,2012,2017,2022]
+
+## Concordances between consecutive vintages (downloaded by get_industry_data)
+CONCORDANCE_FILES = {(2002,2007):'data/ind_data/2002_to_2007_NAICS.xls',
+                     (2007,2012):'data/ind_data/2007_to_2012_NAICS.xls',
+                     (2012,2017):'data/ind_data/2017_to_2012_NAICS.xlsx',
+                     (2017,2022):'data/ind_data/2017_to_2022_NAICS.xlsx'}
+
+## Soltas Census IND to NAICS allocation factors, and their NAICS vintage
+IND_FILE = 'data/ind_data/naics_to_ind.tab'
+IND_VINTAGE = 2012
+
+
+#%%
+
+class Crosswalk:
+    """
+    Parameters
+    ----------
+    source : array of source codes
+    target : array of target codes
+    matrix : sparse matrix (target x source), rows are normalized to sum to one
+    names : (source, target) names of the code columns
+    """
+
+    def __init__(self, source, target, matrix, names = ('source','target')):
+        self.source = np.asarray(source)
+        self.target = np.asarray(target)
+        self.names = tuple(names)
+        matrix = sparse.csr_matrix(matrix,dtype = float)
+        total = np.asarray(matrix.sum(axis = 1)).ravel()
+        with np.errstate(divide = 'ignore'):
+            self.matrix = sparse.diags(np.where(total > 0,1/total,0)) @ matrix
+
+    @classmethod
+    def from_pairs(cls, pairs, source, target, weight = 'weight'):
+        """
+        Parameters
+        ----------
+        pairs : df of source code, target code and weight (pairs can repeat, weights are summed)
+        source, target, weight : columns of pairs
+        """
+        pairs = pairs.loc[~pd.isnull(pairs[source]) & ~pd.isnull(pairs[target])]
+        src_codes, src = np.unique(pairs[source].to_numpy(),return_inverse = True)
+        tgt_codes, tgt = np.unique(pairs[target].to_numpy(),return_inverse = True)
+        matrix = sparse.coo_matrix((pairs[weight].to_numpy(dtype = float),(tgt,src)),
+                                   shape = (len(tgt_codes),len(src_codes)))
+        return cls(src_codes,tgt_codes,matrix,(source,target))
+
+    def then(self, other):
+        """
+        Returns
+        -------
+        Crosswalk from the source of self to the target of other (source codes of
+        other that are not targets of self get no weight)
+        """
+        pos = pd.Index(other.source).get_indexer(self.target)
+        keep = np.flatnonzero(pos >= 0)
+        link = sparse.csr_matrix((np.ones(len(keep)),(pos[keep],keep)),shape = (len(other.source),len(self.target)))
+        return Crosswalk(self.source,other.target,other.matrix @ link @ self.matrix,
+                         (self.names[0],other.names[1]))
+
+    def pairs(self):
+        """
+        Returns
+        -------
+        df of the source code, target code and (normalized) weight of every link
+        """
+        coo = self.matrix.tocoo()
+        return pd.DataFrame({self.names[0]:self.source[coo.col],self.names[1]:self.target[coo.row],
+                             'weight':coo.data}).sort_values(list(self.names)).reset_index(drop = True)
+
+    def convert(self, df, code, cols, skipna = True):
+        """
+        Parameters
+        ----------
+        df : df with a (unique) source code column
+        code : source code column
+        cols : columns to convert
+        skipna : if True, a target code gets the weighted mean of its non-missing
+            sources (weights normalized over those). If False, a missing source
+            makes the target missing
+
+        Returns
+        -------
+        df of the target codes (named as self.names[1]) with the converted columns,
+        only targets with at least one source in df
+        """
+        if df[code].duplicated().any():
+            raise Exception("{} has duplicate codes, aggregate them first".format(code))
+        pos = pd.Index(df[code]).get_indexer(self.source)
+        found = pos >= 0
+        values = np.full((len(self.source),len(cols)),np.nan)
+        values[found] = df[cols].to_numpy(dtype = float)[pos[found]]
+
+        present = np.asarray(self.matrix @ found.astype(float)).ravel() > 0
+        if skipna:
+            weight = self.matrix @ (~np.isnan(values)).astype(float)
+            with np.errstate(divide = 'ignore',invalid = 'ignore'):
+                out = (self.matrix @ np.nan_to_num(values)) / weight
+            out[weight == 0] = np.nan
+        else:
+            ## Sources not in df get no weight, missing values of sources in df propagate
+            weight = (self.matrix @ found.astype(float))[:,None]
+            with np.errstate(divide = 'ignore',invalid = 'ignore'):
+                out = (self.matrix @ np.where(found[:,None],values,0)) / weight
+
+        out = pd.DataFrame(out[present],columns = cols)
+        out.insert(0,self.names[1],self.target[present])
+        return out
+
+
+def naics_crosswalk(source = 2012, target = 2017, level = 4):
+    """
+    Parameters
+    ----------
+    source, target : NAICS vintages (one of VINTAGES)
+    level : naics level of the codes
+
+    Returns
+    -------
+    Crosswalk from naics{source} to naics{target} codes at the level
+    """
+    return _naics_crosswalk(source,target,level)
+
+
+def ind_crosswalk(level = 4, vintage = 2017):
+    """
+    Parameters
+    ----------
+    level : naics level of the targets
+    vintage : NAICS vintage of the targets
+
+    Returns
+    -------
+    Crosswalk from Census IND codes (ind) to naics{vintage} codes, weighted by
+    the Soltas allocation factors
+    """
+    return _ind_crosswalk(level,vintage)
+
+
+def convert_vintage(df, source = 2017, target = 2012, skipna = True):
+    """
+    Parameters
+    ----------
+    df : output of a build_* function (one naics column, e.g. naics4, and the measures)
+    source : NAICS vintage of the codes of df (the measures are built on 2017 NAICS)
+    target : NAICS vintage to convert to
+
+    Returns
+    -------
+    df with the same columns, the codes in the target vintage and the measures
+    converted with naics_crosswalk (titles are dropped)
+    """
+    ind = naics_column(df)
+    cols = value_columns(df)
+    if source == target:
+        return df[[ind] + cols].copy()
+    out = naics_crosswalk(source,target,int(ind[-1])).convert(df,ind,cols,skipna)
+    return out.rename(columns = {'naics{}'.format(target):ind})
+
+
+def concordance_pairs(source = 2012, target = 2017, level = 4):
+    """
+    Parameters
+    ----------
+    source, target : consecutive NAICS vintages (either order)
+    level : naics level of the codes
+
+    Returns
+    -------
+    df of naics{source}, naics{target} and the share (weight) of the source
+    industry that goes to each target, from the 6-digit concordance
+    """
+    if (source,target) in CONCORDANCE_FILES:
+        path = CONCORDANCE_FILES[(source,target)]
+    elif (target,source) in CONCORDANCE_FILES:
+        path = CONCORDANCE_FILES[(target,source)]
+    else:
+        raise Exception("no concordance between {} and {} NAICS, see CONCORDANCE_FILES".format(source,target))
+
+    sheet = read_excel_cached(path,header = None)
+    pairs = pd.DataFrame({x:_concordance_column(sheet,x) for x in [source,target]}).dropna().astype(np.int64)
+    pairs = pairs.drop_duplicates()
+
+    ## 6-digit industries split over several industries have equal weight on each
+    pairs['weight'] = 1/pairs.groupby(source)[target].transform('size')
+    for year in [source,target]:
+        pairs[year] = naics_prefix(pairs[year],level)
+    pairs = pairs.groupby([source,target],as_index = False)['weight'].sum()
+    pairs['weight'] = pairs['weight']/pairs.groupby(source)['weight'].transform('sum')
+    pairs.columns = ['naics{}'.format(source),'naics{}'.format(target),'weight']
+
+    return pairs
+
+
+#%% Helpers
+
+def _vintage_path(source, target):
+    """
+    Consecutive vintages from source to target
+    """
+    for year in [source,target]:
+        if year not in VINTAGES:
+            raise Exception("NAICS vintage {} not one of {}".format(year,VINTAGES))
+    i, j = VINTAGES.index(source), VINTAGES.index(target)
+    path = VINTAGES[i:j + 1] if i <= j else VINTAGES[j:i + 1][::-1]
+    return list(zip(path[:-1],path[1:]))
+
+
+def _path_files(source, target, level = 4):
+    return [CONCORDANCE_FILES[tuple(sorted(x))] for x in _vintage_path(source,target)]
+
+
+@memoize(_path_files)
+def _naics_crosswalk(source, target, level = 4):
+    steps = _vintage_path(source,target)
+    if not steps:
+        raise Exception("source and target vintage are the same")
+    crosswalk = None
+    for a, b in steps:
+        step = Crosswalk.from_pairs(concordance_pairs(a,b,level),'naics{}'.format(a),'naics{}'.format(b))
+        crosswalk = step if crosswalk is None else crosswalk.then(step)
+    return crosswalk
+
+
+@memoize(lambda level = 4, vintage = 2017: [IND_FILE] + (_path_files(IND_VINTAGE,vintage)
+                                                        if vintage != IND_VINTAGE else []))
+def _ind_crosswalk(level = 4, vintage = 2017):
+    naics_to_ind = pd.read_csv(IND_FILE,sep = "\t")
+    naics_to_ind = naics_to_ind.loc[naics_to_ind['naics_digit'] == level]
+    crosswalk = Crosswalk.from_pairs(naics_to_ind,'ind','naics','afactor')
+    crosswalk.names = ('ind','naics{}'.format(IND_VINTAGE))
+    if vintage != IND_VINTAGE:
+        crosswalk = crosswalk.then(naics_crosswalk(IND_VINTAGE,vintage,level))
+    return crosswalk
+
+
+def _concordance_column(sheet, year):
+    """
+    6-digit codes of a vintage in a concordance sheet, from the column with a
+    '{year} NAICS Code' header (header row can be any of the first rows)
+    """
+    pattern = re.compile(r'{}\s.*naics.*code'.format(year),re.IGNORECASE)
+    for row in range(min(len(sheet),10)):
+        cols = [i for i,x in enumerate(sheet.iloc[row]) if isinstance(x,str) and pattern.search(x)]
+        if cols:
+            codes = pd.to_numeric(sheet.iloc[row + 1:,cols[0]],errors = 'coerce')
+            return codes.where(codes.between(10**5,10**6 - 1)).reset_index(drop = True)
+    raise Exception("no {} NAICS code column in the concordance".format(year))
@@ -1,39 +1,83 @@
 import pandas as pd
 import numpy as np
 import copy
-from Code.helper import get_naics_descr, get_naics_12_17
+from collections import namedtuple
+from Code.helper import get_naics_descr, get_naics_12_17, NAICS_FILES
+from Code.naics import (LEVELS, naics_hierarchy, fallback_lookup, expand_bls_groups, parse_naics, naics_prefix,
+                        naics_levels)
+from Code.cache import read_excel_cached, memoize
+from Code.aggregation import weighted_agg
+from Code.scheduler import Stage, run_graph
+from Code.instrument import traced
+
+
+## Commodity x industry use table, with the IO codes of its rows and columns
+IOTable = namedtuple('IOTable',['use','commodities','industries'])
+
+IO_USE_FILE = 'data/customer_interactions/Use_SUT_Framework_2007_2012_DET.xlsx'
 
     
 #%% Main function
 
-def build_cust_int():
-    
-    ## Aggregate customer interactions to the NAICS level
-    # print("Aggregating customer interactions to NAICS level...",end = "\n\n")
-    naics4 = _aggregate_to_naics('naics4')
-    naics3 = _aggregate_to_naics('naics3')
-    naics2 = _aggregate_to_naics('naics2')
-    naics2['naics2'] = naics2['naics2'].str.split('-').str[0].astype(int)
-    
-    ## Build the matching between Input-Output codes and NAICS
-    # print("Building matches between IO codes and NAICS...",end = "\n\n")
-    naics_matches,naics_matches_hold = _build_io_naics4_match()
-    
-    ## Get direct customer interactions at the IO level
-    # print("Aggregating direct customer interactions at IO level...",end = "\n\n")
-    direct = _get_direct_cust_int(naics_matches,naics4,naics3,naics2)
-    
-    ## Get the IO tables and consumption share to create the indirect measure
-    # print("Computing indirect customer interactions using IO tables...",end = "\n\n")
-    io_out,cons_share = _get_io_table()
-    
-    indirect = _get_indirect(io_out,direct)
-    
-    ## Map back to NAICS4
-    # print("Mapping IO customer interactions measures back to NAICS4...",end = "\n\n")
-    final_cust_int = _map_back_to_naics(naics_matches_hold,naics4,indirect,cons_share)
+@traced
+def build_cust_int(indirect_method = 'first_order', workers = 1, level = 4, scale = 'IM'):
+    """
+    Parameters
+    ----------
+    indirect_method : TYPE, str
+        DESCRIPTION. 'first_order' (default) weights the direct measure of direct 
+        customer industries, 'total' propagates through the whole downstream chain
+    workers : TYPE, int
+        DESCRIPTION. number of processes to run independent stages in. The default is 1.
+    level : TYPE, int or list
+        DESCRIPTION. naics level (4, 3 or 2), or a list of levels which are all
+        built from the same IO tables. The default is 4.
+    scale : TYPE, str
+        DESCRIPTION. O*NET scale of the customer interaction activities, 'IM'
+        (importance, default) or 'LV' (level)
+
+    Returns
+    -------
+    final_cust_int : df
+        DESCRIPTION. naics4 level direct, indirect and total customer interactions,
+        a dict of {level: df} if level is a list
+
+    """
     
-    return final_cust_int
+    return run_graph(cust_int_stages(indirect_method,level,scale),['cust_int'],workers)['cust_int']
+
+
+def cust_int_stages(indirect_method = 'first_order', level = 4, scale = 'IM'):
+    """
+    Stages of build_cust_int as a dependency graph (see Code/scheduler.py)
+    """
+    return {
+        ## Aggregate customer interactions to the NAICS level
+        'onet_oes':Stage(_aggregate_to_oes,(),{'var':scale,'rename':'importance'},
+                         ['data/customer_interactions/onet_work_activities.csv']),
+        'cust_int_naics4':Stage(_aggregate_to_naics,{'onet_final':'onet_oes'},{'ind':'naics4'},
+                                ['data/customer_interactions/bls_data_naics4.csv']),
+        'cust_int_naics3':Stage(_aggregate_to_naics,{'onet_final':'onet_oes'},{'ind':'naics3'},
+                                ['data/customer_interactions/bls_data_naics3.csv']),
+        'cust_int_naics2':Stage(_aggregate_to_naics,{'onet_final':'onet_oes'},{'ind':'naics2'},
+                                ['data/customer_interactions/bls_data_naics2.csv']),
+        
+        ## Build the matching between Input-Output codes and NAICS
+        'io_match':Stage(_build_io_naics4_match,inputs = ['data/nondownloadable/io_naics_match.csv']),
+        
+        ## Get direct customer interactions at the IO level
+        'direct':Stage(_get_direct_cust_int,(('io_match',0),'cust_int_naics4',
+                                             'cust_int_naics3','cust_int_naics2')),
+        
+        ## Get the IO tables and consumption share to create the indirect measure
+        'io_table':Stage(_get_io_table,inputs = [IO_USE_FILE]),
+        'indirect':Stage(_get_indirect,(('io_table',0),'direct',('io_table',1)),
+                         {'method':indirect_method}),
+        
+        ## Map back to NAICS4 (and the coarser levels asked for)
+        'cust_int':Stage(_map_back_to_naics,(('io_match',1),'cust_int_naics4',
+                                             'indirect',('io_table',1),'cust_int_naics3','cust_int_naics2'),
+                         {'level':level},inputs = NAICS_FILES)}
 
 
 #%% Helper functions for final
@@ -41,10 +85,12 @@ def build_cust_int():
 ###################################################
 ## CLEAN ONET DATA
 ###################################################
+@traced
+@memoize(['data/customer_interactions/onet_work_activities.csv'])
 def _aggregate_to_oes(var,rename):
 
     """
-    Aggregate onet data to OES level
+    Aggregate onet data to OES level (built once per run for each scale)
     """    
     onet_out = pd.read_csv('data/customer_interactions/onet_work_activities.csv',header = [0,1])
 
@@ -54,8 +100,8 @@ def _aggregate_to_oes(var,rename):
     df['missing_N'] = (pd.isnull(df['N']))**1
     df['missing_N'] = df.groupby(['oes_2018'])['missing_N'].transform('max')
     df.loc[df['missing_N'] == 1,'N'] = 1
-    out = df.groupby("oes_2018").apply(lambda dfx: (dfx["Data Value"] * dfx["N"]).sum() / dfx["N"].sum()).reset_index().\
-            rename(columns = {0:rename})
+    out = weighted_agg(df,['oes_2018'],['Data Value'],'N')[['Data Value']].reset_index().\
+            rename(columns = {'Data Value':rename})
     df.loc[df['missing_N'] == 1,'N'] = np.nan
     df = df[['oes_2018','N']].drop_duplicates().groupby('oes_2018')['N'].sum().reset_index().replace({0:np.nan})
     out = out.merge(df,on = ['oes_2018'])
@@ -73,58 +119,27 @@ def _aggregate_to_oes(var,rename):
 ###################################################
 ## CLEAN BLS AND MATCH TO ONET
 ###################################################
-def _aggregate_to_naics(ind = 'naics4'):
+@traced
+def _aggregate_to_naics(ind = 'naics4', onet_final = None):
 
     ## oesm18in4 is split into different industry levels, this is the mapping from naics code to file name
-    onet_final = _aggregate_to_oes('IM','importance')
+    if onet_final is None:
+        onet_final = _aggregate_to_oes('IM','importance')
 
     ## load in BLS data
-    bls_data = pd.read_csv('data/customer_interactions/bls_data_{}.csv'.format(ind),dtype={'naics':str})
+    bls_data = _load_bls_data(ind)
 
     if ind == 'naics4':
         
         ## Need to fix a few industries to match to NAICS4, as BLS industries do not match perfectly:
-        inds = {'3250A1':['3251','3252','3253','3259'],
-                '3250A2':['3255','3256'],
-                '3320A1':['3321','3322','3325','3326','3329'],
-                '3320A2':['3323','3324'],
-                '3330A1':['3331','3332','3334','3339'],
-                '3370A1':['3371','3372'],
-                '4230A1':['4231','4232','4233','4234','4235','4236','4237','4238','4239'],
-                '4240A1':['4244','4248'],
-                '4240A2':['4242','4246'],
-                '4240A3':['4241','4247','4249'],
-                '4450A1':['4451','4452'],
-                '4530A1':['4532','4533'],
-                '5220A1':['5221','5223'],
-                '5320A1':['5322','5323','5324'],
-                '327000':['3271','3272','3273','3274','3279'],
-                '115100':['1151','1113','1119','1111','1112'],
-                '452000':['4521','4522','4523','4529'],
-                '484000':['4841','4842'],
-                '517000':['5171','5172','5173','5174','5175','5176','5177','5178','5179'],
-                '523000':['5231','5232','5239'],
-                '531000':['5311','5312','5313']}
-            
-        for big_naics in list(inds.keys()):
-            other_naics = inds[big_naics]
-            new_bls = bls_data.loc[bls_data['naics'] == big_naics]
-            for other in other_naics:
-                hold = copy.deepcopy(new_bls)
-                hold.loc[hold['naics'] == big_naics,'naics'] = other
-                if other == other_naics[0]:
-                    out = hold
-                else:
-                    out = pd.concat([out,hold])
-            bls_data = pd.concat([bls_data.loc[bls_data['naics']!=big_naics],out]).sort_values(by = ['naics','occ_code'])
-                
-            bls_data[ind] = bls_data['naics'].astype(str).str[0:4].astype(int)
+        bls_data = expand_bls_groups(bls_data)
+        bls_data[ind] = naics_prefix(parse_naics(bls_data['naics']),4)
 
-        
     elif ind == 'naics3':
-        bls_data[ind] = bls_data['naics'].astype(str).str[0:3].astype(int)
+        bls_data[ind] = naics_prefix(parse_naics(bls_data['naics']),3)
     else:
-        bls_data[ind] = bls_data['naics']
+        ## NAICS2 sectors like 31-33 are kept as the first sector
+        bls_data[ind] = parse_naics(bls_data['naics'])
         
     ## clean BLS data, we are taking weighted-averages by number of employees
     bls_data = bls_data[[ind,'tot_emp','occ_code','occ_title']]
@@ -136,17 +151,25 @@ def _aggregate_to_naics(ind = 'naics4'):
     bls_data = bls_data.merge(onet_final,on = 'oes_2018').sort_values(by = [ind,'oes_2018'])
     
     
-    customer_interactions_ind = bls_data.groupby([ind]).\
-                apply(lambda dfx: (dfx["importance"]*dfx["tot_emp"]).sum()/dfx["tot_emp"].sum()).\
-                reset_index().rename(columns = {0:'cust_int'})
+    customer_interactions_ind = weighted_agg(bls_data,[ind],['importance'],'tot_emp')[['importance']].\
+                reset_index().rename(columns = {'importance':'cust_int'})
     
     return customer_interactions_ind
 
 
+@traced
+@memoize(lambda ind: ['data/customer_interactions/bls_data_{}.csv'.format(ind)])
+def _load_bls_data(ind):
+    """
+    Load BLS OES employment by industry and occupation (once per run for each level)
+    """
+    return pd.read_csv('data/customer_interactions/bls_data_{}.csv'.format(ind),dtype={'naics':str})
+
+
 ## Functions to build IO tables and matches to NAICS4
 def _build_io_4_digit():
 
-    io_raw = pd.read_excel('data/customer_interactions/Use_SUT_Framework_2007_2012_DET.xlsx',
+    io_raw = read_excel_cached(IO_USE_FILE,
                           sheet_name = '2012',skiprows = np.arange(5))
     io_raw.drop(io_raw.tail(3).index,inplace=True)
 
@@ -183,6 +206,7 @@ def _build_io_4_digit():
     
     return final
 
+@traced
 def _build_io_naics4_match():
     
     io_naics = pd.read_csv("data/nondownloadable/io_naics_match.csv")
@@ -210,8 +234,8 @@ def _build_io_naics4_match():
     intermed['naics'] = intermed['naics4'].astype(int)
 
     
-    intermed.loc[intermed['naics'].astype(str).str[-1] == '0',
-                 'naics'] = intermed['naics'].astype(str).str[0:3].astype(int)
+    tens = intermed['naics'].to_numpy() % 10 == 0
+    intermed.loc[tens,'naics'] = naics_prefix(intermed.loc[tens,'naics'],3)
 
     add_on = intermed.loc[intermed['input_naics'] =='517A'].drop_duplicates(subset = 'input_naics')
     add_on['naics'] = 5173
@@ -240,8 +264,11 @@ def _build_io_naics4_match():
     return final,final_revert
 
 
+@traced
 def _get_io_table():
-    io = pd.read_excel("data/customer_interactions/Use_SUT_Framework_2007_2012_DET.xlsx",
+    from scipy import sparse
+    
+    io = read_excel_cached(IO_USE_FILE,
                        sheet_name = "2012")
     
     io.columns = io.iloc[4,:]
@@ -275,41 +302,35 @@ def _get_io_table():
     io.Code = io.Code.map({str(x):x for x in io.Code.unique()})
     
     col_list = [x for x in io.columns if x not in ['input_naics', 'Code', 'Commodity Description']]
-    io_2 = io.groupby(['input_naics'])[col_list].sum()
-    
-    io_2 = io_2.T.reset_index().rename(columns = {'index':'output_naics'})
-    
-    col_list = [x for x in io_2.columns if x not in ['input_naics', 'Code', 'Commodity Description']]
-    
-    io_2['output_naics'] = io_2['output_naics'].str[0:4]
-    
-    io_3 = io_2.groupby(['output_naics'])[col_list].sum()
     
-    io_3_cols = [x for x in io_3.columns]
-    io_3 = io_3.reset_index()
-    io_4 = pd.melt(io_3,id_vars = 'output_naics',
-                   value_vars = io_3_cols,var_name = 'input_naics')
+    ## Commodity x industry use matrix, with both commodities and industries 
+    ## aggregated to 4-character IO codes. Unlike the groupby sum this replaced,
+    ## the industries with alphanumeric codes (423A, 531H, ...) are kept
+    commodities, rows = np.unique(io['input_naics'].to_numpy(dtype = str),return_inverse = True)
+    industries, cols = np.unique(np.array([x[0:4] for x in col_list]),return_inverse = True)
     
-    io_4 = io_4.sort_values(by = ['output_naics','input_naics'])
+    agg_rows = sparse.csr_matrix((np.ones(len(rows)),(rows,np.arange(len(rows)))),
+                                 shape = (len(commodities),len(rows)))
+    agg_cols = sparse.csr_matrix((np.ones(len(cols)),(np.arange(len(cols)),cols)),
+                                 shape = (len(cols),len(industries)))
     
-    # io_4.loc[io_4['input_naics'] == io_4['output_naics'],'value'] = np.nan
-    io_4 = io_4.dropna(subset = ['value'])
+    values = sparse.csr_matrix(io[col_list].astype(float).fillna(0).to_numpy())
+    use = (agg_rows @ values @ agg_cols).tocsr()
+    use.eliminate_zeros()
 
-
-    return io_4,cons_share
+    return IOTable(use,commodities,industries),cons_share
 
 
+@traced
 def _get_direct_cust_int(naics_matches,naics4,naics3,naics2):
-    match = naics_matches.merge(naics4,left_on = 'naics',right_on = 'naics4',how = 'left').\
-            rename(columns = {'cust_int':'cust_int_naics4'}).\
-            merge(naics3,left_on = 'naics',right_on = 'naics3',how = 'left').\
-            rename(columns = {'cust_int':'cust_int_naics3'}).\
-            merge(naics2,left_on = 'naics',right_on = 'naics2',how = 'left').\
-            rename(columns = {'cust_int':'cust_int_naics2'})
-
-    for ind in ['naics4','naics3','naics2']:
-        match.loc[match['naics'] == match[ind],'cust_int'] =\
-                  match['cust_int_{}'.format(ind)]
+    aggregates = {ind:df.set_index(ind)[['cust_int']] for ind,df in zip(LEVELS,[naics4,naics3,naics2])}
+    
+    ## IO codes match to naics at different levels, only use the level of the matched code
+    hierarchy = naics_hierarchy(naics_matches['naics'])
+    direct, _ = fallback_lookup(hierarchy,aggregates,fallback = False)
+    
+    match = naics_matches[['input_naics','naics']]
+    match['cust_int'] = direct['cust_int']
            
     match = match[['input_naics','naics','cust_int']]
     
@@ -319,29 +340,89 @@ def _get_direct_cust_int(naics_matches,naics4,naics3,naics2):
     #                        divide(io_match['cust_int'].max()-io_match['cust_int'].min())
     return io_match
 
-def _get_indirect(io_out,direct):
-    np.seterr(divide='ignore', invalid='ignore')
-    
-    ## Merge with direct measure to create indirect measure
-    io_out = io_out.merge(direct.rename(columns = {'input_naics':'output_naics'}),on = 'output_naics')
-  
-    totals = io_out.groupby('input_naics')['value'].sum().reset_index()
+@traced
+def _get_indirect(io_out,direct,cons_share = None,method = 'first_order',tol = 1e-12,max_iter = 10000):
+    """
     
-    indirect = io_out.groupby(['input_naics']).\
-            apply(lambda dfx: (dfx["cust_int"]*dfx["value"]).sum()/dfx["value"].sum()).\
-            reset_index().rename(columns = {0:'cust_int_indirect'}).\
-            merge(totals,on = 'input_naics')
 
-            
-            
+    Parameters
+    ----------
+    io_out : IOTable, commodity x industry use matrix
+    direct : direct customer interactions by IO code
+    cons_share : consumption share by IO code, needed for method 'total'
+    method : 'first_order' uses the customer interactions of the direct customers,
+        'total' propagates through the whole downstream chain
+    tol, max_iter : convergence of the 'total' solution
+
+    Returns
+    -------
+    indirect customer interactions and total linkages (value) by IO code
+    
+    With S the share of each commodity's intermediate use going to each industry, 
+    first order is S d. For 'total', each customer industry j passes on its own 
+    total measure s_j d_j + (1 - s_j) x_j, where s_j is its consumption share, so
+    x = S (s d) + S (1 - s) x, which is solved by iterating down the chain 
+    (x_k+1 = b + A x_k, the Neumann series of the Leontief-type inverse)
+    """
+    from scipy import sparse
+    
+    ## Only customer industries with a direct measure count (missing measure counts as 0)
+    pos = pd.Index(direct['input_naics']).get_indexer(io_out.industries)
+    valid = pos >= 0
+    cust_int = np.where(valid,direct['cust_int'].to_numpy()[np.maximum(pos,0)],0)
+    cust_int = np.nan_to_num(cust_int)
+    
+    use = io_out.use @ sparse.diags(valid*1.)
+    totals = np.asarray(use.sum(axis=1)).ravel()
+    with np.errstate(divide = 'ignore'):
+        shares = sparse.diags(np.where(totals != 0,1/totals,0)) @ use
+    
+    if method == 'first_order':
+        cust_int_indirect = shares @ cust_int
+        
+    elif method == 'total':
+        if cons_share is None:
+            raise Exception("cons_share is needed for the total indirect measure")
+        ## Customer industries that aren't commodities pass nothing on
+        s = cons_share.set_index('input_naics')['cons_share'].reindex(io_out.industries)
+        s = s.fillna(1).to_numpy()
+        ## Industry j's own indirect measure is that of commodity j
+        to_commodity = pd.Index(io_out.commodities).get_indexer(io_out.industries)
+        has_commodity = to_commodity >= 0
+        link = sparse.csr_matrix((np.ones(has_commodity.sum()),
+                                  (np.flatnonzero(has_commodity),to_commodity[has_commodity])),
+                                 shape = (len(io_out.industries),len(io_out.commodities)))
+        
+        A = (shares @ sparse.diags(1 - s) @ link).tocsr()
+        b = shares @ (s*cust_int)
+        cust_int_indirect = b
+        for i in range(max_iter):
+            step = b + A @ cust_int_indirect
+            converged = np.max(np.abs(step - cust_int_indirect),initial = 0) < tol
+            cust_int_indirect = step
+            if converged:
+                break
+        else:
+            raise Exception("Total indirect customer interactions did not converge")
+        
+    else:
+        raise Exception("Incorrect indirect method, must be first_order or total")
+    
+    indirect = pd.DataFrame({'input_naics':io_out.commodities,
+                             'cust_int_indirect':cust_int_indirect,
+                             'value':totals})
+    
     indirect.loc[indirect['value'] == 0,'cust_int_indirect'] = 0
            
     return indirect
 
 
 
-def _map_back_to_naics(naics_matches_hold,naics4,indirect,cons_share):
-    np.seterr(divide='ignore', invalid='ignore')
+@traced
+def _map_back_to_naics(naics_matches_hold,naics4,indirect,cons_share,naics3 = None,naics2 = None,level = 4):
+    inds, many = naics_levels(level)
+    if any(x not in LEVELS for x in inds):
+        raise Exception("Industry code must be NAICS level")
 
     indirect = indirect.merge(cons_share,on = 'input_naics')
 
@@ -351,55 +432,75 @@ def _map_back_to_naics(naics_matches_hold,naics4,indirect,cons_share):
     
     naics_out['naics'] = naics_out['naics'].astype(int)
     
-    naics_out['naics4'] = naics_out['naics'].astype(str).str[0:4].astype(int)
-    naics_out['naics3'] = naics_out['naics'].astype(str).str[0:3].astype(int)
-    naics_out['naics2'] = naics_out['naics'].astype(str).str[0:2].astype(int)
+    ## IO-matched codes are a mix of 4, 3 and 2-digit naics, which never collide, 
+    ## so the same table is used at every level. Codes matched to several IO
+    ## industries use the first match, except 7225 (below)
+    naics_all = naics_out.set_index('naics')[['cust_int_indirect','value','cons_share']].rename(
+                columns = {'value':'total_linkage'})
+    naics_out = naics_all.loc[~naics_all.index.duplicated()]
     
-    naics4['naics3'] = naics4['naics4'].astype(str).str[0:3].astype(int)
-    naics4['naics2'] = naics4['naics4'].astype(str).str[0:2].astype(int)
-    
-    
-    final = copy.deepcopy(naics4)
-    for ind in ['naics4','naics3','naics2']:
-        final = final.merge(naics_out[['naics','cust_int_indirect','value','cons_share']],left_on = ind,right_on = 'naics',how = 'left').\
-                rename(columns = {'cust_int_indirect':'cust_int_indirect_{}'.format(ind),
-                                  'value':'total_linkage_{}'.format(ind),
-                                   'cons_share':'cons_share_{}'.format(ind)})
+    ## Use naics4 if available, else naics3, else naics2
+    hierarchy = naics_hierarchy(naics4['naics4'])
+    linked, source = fallback_lookup(hierarchy,{ind:naics_out for ind in LEVELS})
         
-        final = final[[x for x in final if x not in ['naics']]]
-    
-    for var in ['cust_int_indirect','total_linkage','cons_share']:
-        final[var] = final['{}_naics4'.format(var)]
-        final.loc[pd.isnull(final[var]),var] = final["{}_naics3".format(var)]
-        final.loc[pd.isnull(final[var]),var] = final["{}_naics2".format(var)]
+    final = pd.concat([naics4[['naics4','cust_int']],linked],axis=1)
+    
+    ## Need to fix one duplicate ind: 7225 averages all of its matches (at the
+    ## level it was found at), weighted by their total linkage
+    is_7225 = (final['naics4'] == 7225).to_numpy()
+    found = source['cust_int_indirect'].to_numpy()[is_7225]
+    if len(found) and found[0] > 0:
+        code = hierarchy['naics{}'.format(found[0])].to_numpy()[is_7225][0]
+        final_7225 = naics_all.loc[naics_all.index == code]
         
-    final = final[['naics4','cust_int','cust_int_indirect','total_linkage','cons_share']]
-    
-    ## Need to fix one duplicate ind
-    final_7225 =  final.loc[final['naics4'] == 7225]
-    
-    final_7225_cust_int_ind = (final_7225["cust_int_indirect"]*final_7225['total_linkage']).sum()/(final_7225['total_linkage'].sum())
-    final_7225_linkage = final_7225['total_linkage'].sum()
-    final_7225_cons_share = final_7225['cons_share'].mean()
-    final.loc[final['naics4'] == 7225,'cust_int_indirect'] = final_7225_cust_int_ind
-    final.loc[final['naics4'] == 7225,'total_linkage'] = final_7225_linkage
-    final.loc[final['naics4'] == 7225,'cons_share'] = final_7225_cons_share
+        with np.errstate(divide = 'ignore',invalid = 'ignore'):
+            final_7225_cust_int_ind = (final_7225["cust_int_indirect"]*final_7225['total_linkage']).sum()/(final_7225['total_linkage'].sum())
+        final_7225_linkage = final_7225['total_linkage'].sum()
+        final_7225_cons_share = final_7225['cons_share'].mean()
+        final.loc[is_7225,'cust_int_indirect'] = final_7225_cust_int_ind
+        final.loc[is_7225,'total_linkage'] = final_7225_linkage
+        final.loc[is_7225,'cons_share'] = final_7225_cons_share
 
     final = final.drop_duplicates(subset = ['naics4'])
     
-    naics_desc = get_naics_descr(level = 4)
-
-    final = final.merge(naics_desc,on = 'naics4',how = 'left')
-    
     ## rename cust_int to be more clear
     final = final.rename(columns = {"cust_int":"cust_int_direct"})
     
+    direct = {'naics4':naics4,'naics3':naics3,'naics2':naics2}
+    out = {ind:_cust_int_level(final,direct[ind],ind) for ind in inds}
+    
+    return out if many else out[inds[0]]
+
+
+def _cust_int_level(final,direct,ind):
+    """
+    Customer interactions at a level from the naics4 ones (final). Coarser 
+    levels have the direct measure of the BLS industries at that level, and 
+    the indirect measure (weighted by total linkage, as for 7225 above) and 
+    the consumption share (mean) of the naics4 industries in them
+    """
+    level = int(ind[-1])
+    if level != 4:
+        if direct is None:
+            raise Exception("the direct measure at {} is needed".format(ind))
+        final = final.assign(**{ind:naics_hierarchy(final['naics4'],[ind])[ind].to_numpy()})
+        linked = final.dropna(subset = ['cust_int_indirect','total_linkage'])
+        linked = linked.assign(weighted = linked['cust_int_indirect']*linked['total_linkage'])
+        linked = linked.groupby(ind).agg(weighted = ('weighted','sum'),total_linkage = ('total_linkage','sum'),
+                                         cons_share = ('cons_share','mean'))
+        linked['cust_int_indirect'] = linked['weighted'].divide(linked['total_linkage'])
+        final = direct[[ind,'cust_int']].rename(columns = {'cust_int':'cust_int_direct'}).merge(
+                linked[['cust_int_indirect','cons_share']].reset_index(),on = ind,how = 'left')
+    
+    naics_desc = get_naics_descr(level = level)
+
+    final = final.merge(naics_desc,on = ind,how = 'left')
+    
     final['cust_int_tot'] = final['cust_int_direct'] * final['cons_share'] + final['cust_int_indirect'] * (1-final['cons_share'])
     
-    final = final.reindex(['naics4','naics4_title',
+    final = final.reindex([ind,'{}_title'.format(ind),
                            'cust_int_tot','cust_int_direct',
                            'cust_int_indirect','cons_share'],axis=1)
 
     return final
 
-
@@ -0,0 +1,171 @@
+"""
+Concurrent, resumable, streaming downloads of the raw data
+
+Files are streamed to disk in chunks as <dest>.part, resumed with an HTTP Range
+request if a partial file is left over, and moved into place once complete.
+The size and sha256 of every download are recorded in a manifest, and later
+downloads of the same file are verified against it. If a source is updated on
+purpose, its entry is replaced with refresh, and known checksums (e.g.
+published ones) can be given with expected instead of trusting the first
+download.
+
+jwb
+"""
+
+import os
+import json
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from Code.cache import file_hash
+
+MANIFEST = 'data/download_manifest.json'
+CHUNK_SIZE = 1 << 20
+
+RawFile = namedtuple('RawFile',['url','dest'])
+
+_manifest_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    pass
+
+
+#%%
+
+def download_files(files, workers = 4, manifest = MANIFEST, retries = 3,
+                   chunk_size = CHUNK_SIZE, timeout = 60, backoff = 1.,
+                   refresh = False, expected = None):
+    """
+    Parameters
+    ----------
+    files : list of RawFile(url, dest)
+    workers : number of files downloaded at the same time
+    manifest : json file of sizes/hashes to verify against (None to skip)
+    refresh : True (or a list of dests) to not verify against the manifest
+        and replace the entries with the new downloads, when a source changed
+    expected : dict of {dest: {'size', 'sha256'}} to verify against instead
+        of the manifest (either key can be left out), recorded in the
+        manifest once verified
+    retries : number of retries of each file, resuming where it stopped (a
+        file that doesn't match the manifest is only downloaded again once)
+    chunk_size : bytes written at a time
+    timeout : seconds to wait for the server
+    backoff : seconds to wait before the first retry (doubles after each)
+
+    Returns
+    -------
+    dict of {dest: {'url', 'size', 'sha256'}} of the downloaded files
+    """
+    entries = _load_manifest(manifest)
+    refresh = [x.dest for x in files] if refresh is True else refresh or []
+    expected = expected or {}
+
+    def _one(raw):
+        check = expected.get(raw.dest,None if raw.dest in refresh else entries.get(raw.dest))
+        info = _download(raw,check,retries,chunk_size,timeout,backoff)
+        with _manifest_lock:
+            entries[raw.dest] = info
+            _save_manifest(manifest,entries)
+        return info
+
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = [(raw.dest,pool.submit(_one,raw)) for raw in files]
+        return {dest:future.result() for dest,future in futures}
+
+
+def verify_file(dest, expected):
+    """
+    Parameters
+    ----------
+    dest : downloaded file
+    expected : manifest entry ({'size', 'sha256'}) or None
+
+    Returns
+    -------
+    {'size', 'sha256'} of dest, raises DownloadError if it doesn't match expected
+    """
+    info = {'size':os.path.getsize(dest),'sha256':file_hash(dest)}
+    if expected is not None:
+        for key in ['size','sha256']:
+            if expected.get(key) is not None and expected[key] != info[key]:
+                raise DownloadError("{} of {} does not match manifest ({} vs {})".format(
+                                    key,dest,info[key],expected[key]))
+    return info
+
+
+#%% Download helpers
+
+def _download(raw, expected, retries, chunk_size, timeout, backoff):
+    import requests
+    folder = os.path.dirname(raw.dest)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder,exist_ok = True)
+
+    part = raw.dest + '.part'
+    mismatched = False
+    for attempt in range(retries + 1):
+        try:
+            _stream(raw.url,part,chunk_size,timeout)
+            info = verify_file(part,expected)
+            os.replace(part,raw.dest)
+            info['url'] = raw.url
+            return info
+        except DownloadError as e:
+            ## Bad content, start again from scratch rather than resuming. Only
+            ## once, if it doesn't match again the source itself has changed
+            if os.path.exists(part):
+                os.remove(part)
+            if mismatched or attempt == retries:
+                raise DownloadError("{} (if the source was updated, download it again with refresh, "
+                                    "or python -m Code.cli download --refresh)".format(e))
+            mismatched = True
+        except (requests.RequestException,IOError) as e:
+            if attempt == retries:
+                raise DownloadError("Failed to download {}: {}".format(raw.url,e))
+        time.sleep(backoff * 2**attempt)
+
+
+def _stream(url, part, chunk_size, timeout):
+    import requests
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Range':'bytes={}-'.format(offset)} if offset else {}
+
+    with requests.get(url,headers = headers,stream = True,timeout = timeout) as resp:
+        ## Partial file is already complete
+        if offset and resp.status_code == 416:
+            return
+        resp.raise_for_status()
+
+        ## If the server ignored the range request (200), start again
+        resumed = offset and resp.status_code == 206
+        written = offset if resumed else 0
+        ## Content-Length is of the encoded body if the server compresses it
+        length = None if resp.headers.get('Content-Encoding') else resp.headers.get('Content-Length')
+
+        with open(part,'ab' if resumed else 'wb') as out:
+            for chunk in resp.iter_content(chunk_size = chunk_size):
+                out.write(chunk)
+                written += len(chunk)
+
+    if length is not None and written != int(length) + (offset if resumed else 0):
+        raise IOError("Incomplete download of {} ({} bytes)".format(url,written))
+
+
+def _load_manifest(manifest):
+    if manifest is None or not os.path.exists(manifest):
+        return {}
+    with open(manifest) as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest, entries):
+    if manifest is None:
+        return
+    folder = os.path.dirname(manifest)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder,exist_ok = True)
+    with open(manifest + '.tmp','w') as f:
+        json.dump(entries,f,indent = 1,sort_keys = True)
+    os.replace(manifest + '.tmp',manifest)
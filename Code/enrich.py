@@ -0,0 +1,202 @@
+"""
+Attach the industry measures to a (large) firm panel, in chunks
+
+The panel (csv or parquet) is read in chunks of rows. The naics codes of each
+chunk are cleaned the same way as for the fixed cost share measure
+(see normalize_naics in Code/compustat.py), the measures are looked up in a
+MeasureStore (with the 4 -> 3 -> 2 digit fallback) and the chunk is written
+to the output file right away. Writing is done in a separate thread while
+the next chunk is read, with at most two chunks waiting, so memory stays at
+a few chunks whatever the size of the panel.
+
+jwb
+"""
+
+import os
+import gzip
+import queue
+import threading
+import pandas as pd
+from Code.compustat import normalize_naics
+from Code.measure_store import load_measure_store
+from Code.instrument import stage
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+ENRICH_COLUMNS = ['workfromhome','flex_speed','cust_int_tot','fc_ind']
+CHUNKSIZE = 1000000
+
+PARQUET = ('.parquet','.pq')
+
+
+#%%
+
+def enrich_panel(source, dest, naics = 'naics', columns = ENRICH_COLUMNS, store = None,
+                 chunksize = CHUNKSIZE, fallback = True, levels = False, **kwargs):
+    """
+    Parameters
+    ----------
+    source : firm panel, csv (can be compressed) or parquet (.parquet/.pq)
+    dest : output file, parquet by its extension, csv otherwise
+    naics : column of the panel with the (Compustat) naics codes
+    columns : measure columns to attach
+    store : MeasureStore to take the measures from, the default None loads
+        the saved measures in Out_Data/
+    chunksize : rows per chunk
+    fallback : use coarser naics levels for codes without a value, see MeasureStore.lookup
+    levels : also attach the naics level each value came from ({column}_level)
+    **kwargs : passed on to pd.read_csv for a csv panel (e.g. dtype, usecols)
+
+    Returns
+    -------
+    number of rows written
+    """
+    store = load_measure_store() if store is None else store
+    if os.path.dirname(dest) and not os.path.exists(os.path.dirname(dest)):
+        os.makedirs(os.path.dirname(dest))
+
+    ## Chunks are written by a separate thread (pandas/arrow writers release the
+    ## GIL for the actual I/O), at most two chunks are kept waiting
+    writer = _ChunkWriter(dest)
+    rows = 0
+    try:
+        for chunk in read_chunks(source,chunksize,**kwargs):
+            with stage('enrich_chunk',len(chunk)) as s:
+                chunk = enrich_chunk(chunk,store,naics,columns,fallback,levels)
+                s.rows_out = len(chunk)
+            writer.put(chunk)
+            rows += len(chunk)
+    except BaseException:
+        writer.close(discard = True)
+        raise
+    writer.close()
+
+    return rows
+
+
+def enrich_chunk(chunk, store, naics = 'naics', columns = ENRICH_COLUMNS, fallback = True, levels = False):
+    """
+    Parameters
+    ----------
+    chunk : df with a naics column
+    store, naics, columns, fallback, levels : see enrich_panel
+
+    Returns
+    -------
+    chunk with the measure columns added (and {column}_level if levels)
+    """
+    if naics not in chunk:
+        raise Exception("{} not a column of the panel".format(naics))
+    values, source = store.lookup(normalize_naics(chunk[naics]),columns,fallback)
+    chunk = chunk.copy()
+    for col in columns:
+        chunk[col] = values[col].to_numpy()
+        if levels:
+            chunk['{}_level'.format(col)] = source[col].to_numpy()
+    return chunk
+
+
+def read_chunks(path, chunksize = CHUNKSIZE, **kwargs):
+    """
+    Returns
+    -------
+    generator of dfs of (at most) chunksize rows of a csv or parquet file,
+    kwargs are passed on to pd.read_csv
+    """
+    if path.lower().endswith(PARQUET):
+        if pq is None:
+            raise Exception("reading parquet files requires pyarrow")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size = chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path,chunksize = chunksize,**kwargs)
+
+
+#%% Writer
+
+class _ChunkWriter:
+    """
+    Appends chunks to a csv or parquet file from a background thread. Chunks
+    of a parquet file must have the types of the first one, those of a csv
+    can differ (pd.read_csv infers them per chunk)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.lower().endswith(PARQUET)
+        if self.parquet and pq is None:
+            raise Exception("writing parquet files requires pyarrow")
+        self.tmp = path + '.tmp'
+        self.queue = queue.Queue(maxsize = 2)
+        self.error = None
+        self.thread = threading.Thread(target = self._run,daemon = True)
+        self.thread.start()
+
+    def put(self, chunk):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(chunk)
+
+    def close(self, discard = False):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None or discard:
+            if os.path.exists(self.tmp):
+                os.remove(self.tmp)
+            if discard:
+                return
+            raise self.error
+        ## Only replace the output once everything is written
+        os.replace(self.tmp,self.path)
+
+    def _run(self):
+        writer = None
+        first = True
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    break
+                if not self.parquet:
+                    if writer is None:
+                        writer = _csv_file(self.tmp,self.path)
+                    chunk.to_csv(writer,header = first,index = False)
+                    first = False
+                    continue
+                table = pa.Table.from_pandas(chunk,preserve_index = False)
+                if writer is None:
+                    schema = table.schema
+                    writer = pq.ParquetWriter(self.tmp,schema)
+                elif table.schema != schema:
+                    ## Same types as the first chunk (e.g. a column that is all missing in a chunk)
+                    try:
+                        table = table.cast(schema)
+                    except pa.ArrowException:
+                        raise Exception("column types of the panel differ between chunks "
+                                        "({} vs {}), set them with dtype".format(table.schema.types,schema.types))
+                writer.write_table(table)
+                first = False
+        except Exception as e:
+            ## Keep taking chunks, so the reading thread doesn't block
+            self.error = e
+            while self.queue.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                writer.close()
+        if first and self.error is None:
+            ## Empty panel
+            if self.parquet:
+                pq.write_table(pa.table({}),self.tmp)
+            else:
+                pd.DataFrame().to_csv(self.tmp,index = False)
+
+
+def _csv_file(tmp, path):
+    if path.lower().endswith('.gz'):
+        return gzip.open(tmp,'wt',newline = '')
+    return open(tmp,'w',newline = '')
@@ -5,73 +5,394 @@ jwb
 """
 
 
+import os
+import warnings
 import pandas as pd
-import statsmodels.api as sm 
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from Code.helper import get_naics_descr, get_naics_12_17
+from Code.instrument import traced, stage
+from Code.naics import naics_digits, naics_levels, LEVELS
 
-def build_fixed_cost_share(ind = 'naics4'):
+STATS = ['n','sx','sy','sxx','sxy','syy']
+
+@traced
+def build_fixed_cost_share(ind = 'naics4', bootstrap = 0, alpha = 0.05, seed = 0, workers = None,
+                           yvar = 'xoprq_g', comp_q = None):
+    """
+    Parameters
+    ----------
+    ind : industry level, or a list of levels (e.g. ['naics4','naics3','naics2']),
+        which are all built from one read of the data and one pass over it
+    bootstrap : number of firm-clustered bootstrap replications (0 for none)
+    alpha : the percentile confidence intervals are (1 - alpha)
+    seed : seed of the bootstrap
+    workers : number of processes running the bootstrap, the default None uses all cores
+    yvar : growth rate of the costs regressed on sales growth (saleq_g)
+    comp_q : panel to use (e.g. from comp_q_growth, with other growth rates or
+        winsorization), the default None reads comp_q_fc.csv
+
+    Returns
+    -------
+    fixed cost share by industry (fc_ind), with bootstrap standard errors
+    (fc_ind_se) and confidence intervals (fc_ind_lo, fc_ind_hi) if bootstrap > 0.
+    A dict of {level: df} if ind is a list
+    """
+    inds, many = naics_levels(ind)
+    if any(x not in LEVELS for x in inds):
+        raise Exception("Industry code must be NAICS level")
+    
+    if comp_q is None:
+        with stage('read_comp_q') as s:
+            comp_q = pd.read_csv("data/fixed_cost_share/comp_q_fc.csv")
+            s.rows_out = len(comp_q)
     
-    comp_q = pd.read_csv("data/fixed_cost_share/comp_q_fc.csv")
+    ## Every level is a sum over the sufficient statistics of one pass over the data
+    reg_results = _regress_all_levels(comp_q,inds,yvar)
+    
+    out = {}
+    for ind in inds:
+        naics_desc = get_naics_descr(int(ind[-1]))
+        
+        fc_ind = reg_results[ind][[ind,'fc_ind','n','r2']]
+        out_vars = [ind,'{}_title'.format(ind),'fc_ind']
+        
+        if bootstrap > 0:
+            fc_ind = fc_ind.merge(bootstrap_fc_ind(comp_q,ind,bootstrap,alpha,seed,workers,yvar = yvar),
+                                  on = ind,how = 'left')
+            out_vars += ['fc_ind_se','fc_ind_lo','fc_ind_hi']
+        
+        ## Integer codes (the compustat codes are floats as some are missing)
+        fc_ind[ind] = fc_ind[ind].astype(np.int64)
+        fc_ind = fc_ind.merge(naics_desc, on = ind,how = 'left')
+        
+        fc_ind = fc_ind.reindex(out_vars,axis=1)
+        
+        if ind == 'naics2':
+            fc_ind['naics2'] = fc_ind['naics2'].astype(int).replace({31:"31-33",44:"44-45",48:"48-49"}).astype(str)
+        out[ind] = fc_ind
+        
+    return out if many else out[inds[0]]
+
+
+@traced
+def build_fixed_cost_share_panel(ind = 'naics4', freq = 'year', window = 5):
+    """
+    Parameters
+    ----------
+    ind : industry level
+    freq : 'year' (fiscal year, fyearq) or 'quarter' (yq)
+    window : length of the rolling window, in years or quarters
+
+    Returns
+    -------
+    industry x period panel of fixed cost shares (fc_ind) estimated over the
+    window ending in each period, with the number of observations (n)
+    """
+    with stage('read_comp_q') as s:
+        comp_q = pd.read_csv("data/fixed_cost_share/comp_q_fc.csv")
+        s.rows_out = len(comp_q)
     
     level = int(ind[-1])
     naics_desc = get_naics_descr(level)
     
-    fc_ind = _regress_by_ind(comp_q,ind)
+    fc_panel = _rolling_regress(comp_q,ind,freq,window)
     
-    fc_ind = fc_ind.merge(naics_desc, on = ind,how = 'left')
+    fc_panel[ind] = fc_panel[ind].astype(np.int64)
+    fc_panel = fc_panel.merge(naics_desc, on = ind,how = 'left')
     
-    fc_ind = fc_ind.reindex([ind,'{}_title'.format(ind),'fc_ind'],axis=1)
+    period = 'fyearq' if freq == 'year' else 'yq'
+    fc_panel = fc_panel.reindex([ind,'{}_title'.format(ind),period,'fc_ind','n'],axis=1)
     
     if ind == 'naics2':
-        fc_ind['naics2'] = fc_ind['naics2'].astype(int).replace({31:"31-33",44:"44-45",48:"48-49"}).astype(str)
+        fc_panel['naics2'] = fc_panel['naics2'].astype(int).replace({31:"31-33",44:"44-45",48:"48-49"}).astype(str)
         
-    return fc_ind
+    return fc_panel
 
 
 #%%
 
 
-def _regress(data, yvar, xvars):
+def _regress_by_ind(reg_data,ind = 'naics4',yvar = 'xoprq_g',Xvar = ['saleq_g']):
+    """
+    
+
+    Parameters
+    ----------
+    reg_data : dataframe to run regs on
+    ind : industry level to run regressions at
+    
+    Returns
+    -------
+    regression coefficients by industry (dataframe), with number of 
+    observations (n) and R-squared (r2) of each industry regression
+    """
+    if (ind!="naics4") & (ind!="naics3") & (ind!="naics2"):
+        raise Exception("Industry code must be NAICS level")
+
+    reg_results = _regress_all_levels(reg_data,[ind],yvar,Xvar)[ind]
+    
+    return reg_results[[ind,'fc_ind','n','r2']]
+
+
+def _sufficient_stats(data, keys, yvar, xvar):
     """
     
 
     Parameters
     ----------
     data : data to run regs on
+    keys : column(s) to group by
     yvar : dep. var
-    xvars : indep. var(s)
+    xvar : indep. var (single regressor)
 
     Returns
     -------
-    regression coefficients 
+    per-group sums n, sx, sy, sxx, sxy, syy (dataframe indexed by keys), 
+    which are all that is needed for a univariate OLS with intercept
     """
-    Y = data[yvar]
-    X = data[xvars]
-    X['intercept'] = 1.
-    result = sm.OLS(Y, X).fit()
-    return result.params
+    x = data[xvar].to_numpy(dtype = float)
+    y = data[yvar].to_numpy(dtype = float)
+    
+    ## Only use obs where both x and y are non-missing. Unlike sm.OLS (whose default
+    ## missing='none' gives nan for an industry with any missing obs), an industry
+    ## with some missing growth rates still gets a regression on the others
+    valid = ~(np.isnan(x) | np.isnan(y))
+    x = np.where(valid,x,0.)
+    y = np.where(valid,y,0.)
+    
+    sums = pd.DataFrame({'n':valid*1.,'sx':x,'sy':y,
+                         'sxx':x*x,'sxy':x*y,'syy':y*y},index = data.index)
+    
+    keys = [keys] if isinstance(keys,str) else keys
+    
+    return sums.groupby([data[k] for k in keys]).sum()
 
-def _regress_by_ind(reg_data,ind = 'naics4',yvar = 'xoprq_g',Xvar = ['saleq_g']):
+
+def _ols_from_stats(stats):
+    """
+    
+
+    Parameters
+    ----------
+    stats : output of _sufficient_stats (or sums of it)
+
+    Returns
+    -------
+    slope, intercept, n and r2 for every row of stats (dataframe)
+    """
+    n = stats['n']
+    out = pd.DataFrame(index = stats.index)
+    ## Groups with too few obs give nan (0/0), not a warning
+    with np.errstate(divide = 'ignore',invalid = 'ignore'):
+        ## Centered (co)variances
+        cxx = stats['sxx'] - stats['sx']**2/n
+        cxy = stats['sxy'] - stats['sx']*stats['sy']/n
+        cyy = stats['syy'] - stats['sy']**2/n
+        
+        out['slope'] = cxy/cxx
+        out['intercept'] = (stats['sy'] - out['slope']*stats['sx'])/n
+        out['r2'] = cxy**2/(cxx*cyy)
+    out['n'] = n.astype(int)
+    return out[['slope','intercept','n','r2']]
+
+
+@traced
+def _regress_all_levels(reg_data,levels = tuple(LEVELS),
+                        yvar = 'xoprq_g',Xvar = ['saleq_g']):
     """
     
 
     Parameters
     ----------
     reg_data : dataframe to run regs on
-    ind : industry level to run regressions at
+    levels : industry levels to run regressions at
+    yvar : dep. var
+    Xvar : indep. var (list with a single regressor)
+
+    Returns
+    -------
+    dictionary of regression results by industry (dataframe) for each level
+    
+    Closed-form univariate OLS: the panel is reduced to sufficient statistics
+    once at the finest combination of industry codes, and every level is then
+    a sum over those (few hundred) cells rather than a regression per industry
+    """
+    if len(Xvar) != 1:
+        raise Exception("Closed-form regressions only support a single regressor")
+    
+    stats = _sufficient_stats(reg_data,levels,yvar,Xvar[0]).reset_index()
+    
+    out = {}
+    for ind in levels:
+        ## Make sure we are only focusing on the correct industry level
+        level_stats = stats.loc[naics_digits(stats[ind]) == int(ind[-1])]
+        level_stats = level_stats.groupby(ind)[['n','sx','sy','sxx','sxy','syy']].sum()
+        
+        reg_results = _ols_from_stats(level_stats).rename(columns = {'slope':"vc_ind"})
+        reg_results['fc_ind'] = 1 - reg_results['vc_ind']
+        out[ind] = reg_results[['fc_ind','vc_ind','intercept','n','r2']].reset_index()
+        
+    return out
+
+
+#%% Firm-clustered bootstrap
+
+@traced
+def bootstrap_fc_ind(reg_data, ind = 'naics4', n_boot = 1000, alpha = 0.05, seed = 0,
+                     workers = None, batch_size = 250, yvar = 'xoprq_g', xvar = 'saleq_g'):
+    """
     
+
+    Parameters
+    ----------
+    reg_data : dataframe to run regs on (with gvkey)
+    ind : industry level
+    n_boot : number of bootstrap replications
+    alpha : the percentile confidence intervals are (1 - alpha)
+    seed : seed of the bootstrap, the results don't depend on workers
+    workers : number of processes, the default None uses all cores
+    batch_size : replications per batch (each batch has its own seed)
+    yvar : dep. var
+    xvar : indep. var
+
     Returns
     -------
-    regression coefficients by industry (dataframe)
+    bootstrap standard error (fc_ind_se) and percentile confidence interval
+    (fc_ind_lo, fc_ind_hi) of fc_ind by industry (dataframe)
+    
+    Firms are resampled with replacement within each industry. Each firm is
+    reduced to its sufficient statistics once, so a replication is a weighted
+    sum of those (weights = number of times each firm is drawn) rather than a
+    regression on the resampled panel
     """
-    if (ind!="naics4") & (ind!="naics3") & (ind!="naics2"):
-        raise Exception("Industry code must be NAICS level")
+    stats = _sufficient_stats(reg_data,[ind,'gvkey'],yvar,xvar).reset_index()
     ## Make sure we are only focusing on the correct industry level
-    reg_data = reg_data.loc[reg_data[ind].astype(int).astype(str).str.len() == int(ind[-1])]
+    stats = stats.loc[naics_digits(stats[ind]) == int(ind[-1])]
+    
+    industries = np.unique(stats[ind].to_numpy())
+    codes = np.searchsorted(industries,stats[ind].to_numpy())
+    firm_stats = [stats.loc[codes == i,STATS].to_numpy() for i in range(len(industries))]
+    
+    sizes = [batch_size]*(n_boot // batch_size) + ([n_boot % batch_size] if n_boot % batch_size else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    
+    workers = os.cpu_count() if workers is None else workers
+    if workers == 1:
+        slopes = [_bootstrap_batch(firm_stats,size,x) for size,x in zip(sizes,seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            slopes = list(pool.map(_bootstrap_batch,[firm_stats]*len(sizes),sizes,seeds))
+    
+    fc = 1 - np.vstack(slopes)
+    
+    with np.errstate(invalid = 'ignore'), warnings.catch_warnings():
+        ## Industries with a single firm have no variation
+        warnings.simplefilter('ignore',RuntimeWarning)
+        out = pd.DataFrame({ind:industries,
+                            'fc_ind_se':np.nanstd(fc,axis = 0,ddof = 1),
+                            'fc_ind_lo':np.nanpercentile(fc,100*alpha/2,axis = 0),
+                            'fc_ind_hi':np.nanpercentile(fc,100*(1 - alpha/2),axis = 0)})
+    return out
+
+
+def _bootstrap_batch(firm_stats, size, seed):
+    """
+    
 
-    ## Run _regress at industry level
-    reg_results = reg_data.groupby([ind]).apply(_regress, yvar, Xvar)
-    reg_results = reg_results.rename(columns = {Xvar[0]:"vc_ind"})
-    reg_results['fc_ind'] = 1 - reg_results['vc_ind']
-    return reg_results[['fc_ind']].reset_index()
+    Parameters
+    ----------
+    firm_stats : list of (firms x STATS) arrays, one per industry
+    size : number of replications
+    seed : np.random.SeedSequence of the batch
+
+    Returns
+    -------
+    (size x industries) array of bootstrap slopes
+    """
+    rng = np.random.default_rng(seed)
+    
+    ## Sufficient statistics of every replication and industry
+    totals = np.empty((size,len(firm_stats),len(STATS)))
+    for i, x in enumerate(firm_stats):
+        k = len(x)
+        draws = rng.multinomial(k,np.full(k,1/k),size = size)
+        totals[:,i,:] = draws @ x
+    
+    n, sx, sy, sxx, sxy = [totals[...,j] for j in range(5)]
+    with np.errstate(divide = 'ignore',invalid = 'ignore'):
+        return (sxy - sx*sy/n)/(sxx - sx**2/n)
 
+
+#%% Rolling windows
+
+@traced
+def _rolling_regress(reg_data, ind = 'naics4', freq = 'year', window = 5,
+                     yvar = 'xoprq_g', xvar = 'saleq_g'):
+    """
+    
+
+    Parameters
+    ----------
+    reg_data : dataframe to run regs on
+    ind : industry level
+    freq : 'year' (fyearq) or 'quarter' (yq)
+    window : length of the rolling window, in periods
+    yvar : dep. var
+    xvar : indep. var
+
+    Returns
+    -------
+    regression results by industry and period (end of the window), for
+    every period with a full window of data before it
+    
+    The panel is reduced to sufficient statistics by industry and period once.
+    The window sums are then updated as the window slides, adding the
+    statistics of the period coming in and subtracting the one going out
+    """
+    if freq == 'year':
+        period = reg_data['fyearq'].astype(int)
+    elif freq == 'quarter':
+        yq = reg_data['yq'].astype(int)
+        period = (yq // 10)*4 + yq % 10 - 1
+    else:
+        raise Exception("freq must be year or quarter")
+    
+    data = reg_data.assign(period = period)
+    stats = _sufficient_stats(data,[ind,'period'],yvar,xvar).reset_index()
+    ## Make sure we are only focusing on the correct industry level
+    stats = stats.loc[naics_digits(stats[ind]) == int(ind[-1])]
+    
+    ## Dense industry x period array of statistics (periods without data are zero)
+    industries = np.unique(stats[ind].to_numpy())
+    first = stats['period'].min()
+    periods = np.arange(first,stats['period'].max() + 1)
+    cells = np.zeros((len(periods),len(industries),len(STATS)))
+    cells[stats['period'].to_numpy() - first,np.searchsorted(industries,stats[ind].to_numpy())] = stats[STATS].to_numpy()
+    
+    running = np.zeros((len(industries),len(STATS)))
+    out = []
+    for t in range(len(periods)):
+        running += cells[t]
+        if t >= window:
+            running -= cells[t - window]
+        if t >= window - 1:
+            out.append(pd.DataFrame(running.copy(),columns = STATS).assign(
+                       **{ind:industries,'period':periods[t]}))
+    
+    if not out:
+        raise Exception("No full window of {} periods in the data".format(window))
+    
+    out = pd.concat(out,ignore_index = True)
+    out = out.loc[out['n'] > 0]
+    
+    reg_results = _ols_from_stats(out)
+    reg_results['fc_ind'] = 1 - reg_results['slope']
+    reg_results[ind] = out[ind]
+    
+    if freq == 'year':
+        reg_results['fyearq'] = out['period']
+    else:
+        reg_results['yq'] = (out['period'] // 4)*10 + out['period'] % 4 + 1
+    
+    return reg_results.drop(['slope','intercept','r2'],axis = 1).reset_index(drop = True)
@@ -0,0 +1,173 @@
+"""
+Build the measures under a grid of specifications in one parallel run
+
+A grid is a dict of {setting: list of values}, every combination of which is
+a specification, or a list of specifications (dicts of settings). Settings
+are those of measure_stages (see SPEC_DEFAULTS), e.g.
+
+    run_grid({'weight':['lvwt','wt06'],'scale':['IM','LV'],
+              'yvar':['xoprq_g','cogsq_g'],'limits':['saved',None,(0.05,0.05)]})
+
+where limits 'saved' (SAVED_LIMITS) are the growth rates as saved, winsorized
+at 1%, and None no winsorization.
+
+The dependency graphs of all specifications are merged into one graph in
+which stages with the same function, arguments and dependencies are a single
+stage, so whatever specifications share is built once (the IO tables for
+both O*NET scales, the Compustat growth rates for every yvar, workplace_flex
+for every setting it doesn't depend on) and the rest runs in parallel over
+the process pool of run_graph. The result is one long table of every value
+of every measure under every specification.
+
+jwb
+"""
+
+import json
+import itertools
+import pandas as pd
+from Code.scheduler import run_graph, _needed, _order
+from Code.pipeline import measure_stages, load_reference_data, MEASURES, MEASURE_LEVELS, SAVED_LIMITS
+from Code.measure_store import naics_column, value_columns
+from Code.naics import naics_levels, parse_naics
+
+## Settings of a specification (arguments of measure_stages) and their defaults
+SPEC_DEFAULTS = {'indirect_method':'first_order','level':4,'weight':'lvwt','scale':'IM',
+                 'yvar':'xoprq_g','limits':SAVED_LIMITS}
+
+
+#%%
+
+def run_grid(grid, measures = MEASURES, workers = None):
+    """
+    Parameters
+    ----------
+    grid : dict of {setting: list of values} (all combinations are run), or
+        a list of dicts of settings, settings not given are SPEC_DEFAULTS
+    measures : measures to build under every specification
+    workers : number of processes, the default None uses all cores
+
+    Returns
+    -------
+    df with one row per specification (spec, and a column per setting of
+    the grid other than level), measure, naics level, naics code and measure column
+    (variable), with its value. Measures without data (investment_flex)
+    have no rows
+    """
+    specs = grid_specs(grid)
+    ## The naics level of each value is in the level column
+    settings = [x for x in dict.fromkeys(x for spec in specs for x in spec) if x != 'level']
+    specs = [dict(SPEC_DEFAULTS,**spec) for spec in specs]
+
+    levels = set()
+    for spec in specs:
+        spec_levels = [int(x[-1]) for x in naics_levels(spec['level'])[0]]
+        unsupported = [x for x in measures if not set(spec_levels) <= set(MEASURE_LEVELS[x])]
+        if unsupported:
+            raise Exception("{} can't be built at naics{}, see MEASURE_LEVELS".format(unsupported,spec_levels))
+        levels.update(spec_levels)
+
+    graph, names = merge_graphs([measure_stages(**spec) for spec in specs],measures)
+
+    ## As in build_measures, worker processes forked from this one inherit the reference tables
+    load_reference_data(sorted(levels))
+    results = run_graph(graph,list(dict.fromkeys(x for spec in names for x in spec.values())),workers)
+
+    out = []
+    for i, (spec, spec_names) in enumerate(zip(specs,names)):
+        for measure in measures:
+            values = tidy_measure(results[spec_names[measure]])
+            if values is None:
+                continue
+            values.insert(0,'measure',measure)
+            for x in reversed(settings):
+                values.insert(0,x,[spec[x]]*len(values))
+            values.insert(0,'spec',i)
+            out.append(values)
+    if not out:
+        raise Exception("no measure was built, see the data of {}".format(measures))
+
+    return pd.concat(out,ignore_index = True)
+
+
+def grid_specs(grid):
+    """
+    Returns
+    -------
+    list of specifications (dicts of settings) of a grid, see run_grid
+    """
+    if isinstance(grid,dict):
+        settings = list(grid)
+        specs = [dict(zip(settings,x)) for x in itertools.product(*[grid[x] for x in settings])]
+    else:
+        specs = [dict(x) for x in grid]
+    ## Lists (e.g. limits read from json) as tuples, so the results can be grouped by them
+    specs = [{x:tuple(y) if isinstance(y,list) else y for x,y in spec.items()} for spec in specs]
+    unknown = sorted({x for spec in specs for x in spec} - set(SPEC_DEFAULTS))
+    if unknown:
+        raise Exception("{} are not settings of a specification, see SPEC_DEFAULTS".format(unknown))
+    if not specs:
+        raise Exception("the grid has no specifications")
+    return specs
+
+
+def merge_graphs(graphs, targets):
+    """
+    Parameters
+    ----------
+    graphs : list of dependency graphs (dicts of {name: Stage})
+    targets : stages needed from every graph
+
+    Returns
+    -------
+    graph : dict of {name: Stage}
+        the stages the targets need in all graphs, stages with the same
+        function, keyword arguments and (merged) dependencies only once.
+        Different versions of a stage are named name, name#1, name#2...
+    names : list of {target: name in graph}, one per graph
+    """
+    graph, stages, names = {}, {}, []
+    for spec_graph in graphs:
+        renamed = {}
+        for name in _order(spec_graph,_needed(spec_graph,targets)):
+            stage = spec_graph[name]
+            stage = stage._replace(deps = _rename_deps(stage.deps,renamed))
+            key = json.dumps([stage.fun.__module__,stage.fun.__qualname__,sorted(stage.kwargs.items()),
+                              stage.deps],sort_keys = True,default = repr)
+            if key not in stages:
+                versions = sum(x.split('#')[0] == name for x in graph)
+                stages[key] = name if versions == 0 else '{}#{}'.format(name,versions)
+                graph[stages[key]] = stage
+            renamed[name] = stages[key]
+        names.append({x:renamed[x] for x in targets})
+    return graph, names
+
+
+def tidy_measure(result):
+    """
+    Parameters
+    ----------
+    result : output of a build_* function, a df or a dict of {level: df}
+
+    Returns
+    -------
+    df of level, naics, variable and value (None if result is None)
+    """
+    if result is None:
+        return None
+    out = []
+    for df in (result.values() if isinstance(result,dict) else [result]):
+        ind = naics_column(df)
+        values = df[[ind] + value_columns(df)].melt(id_vars = ind,var_name = 'variable',value_name = 'value')
+        values.insert(0,'naics',parse_naics(values.pop(ind)))
+        values.insert(0,'level',int(ind[-1]))
+        out.append(values)
+    return pd.concat(out,ignore_index = True)
+
+
+#%% Helpers
+
+def _rename_deps(deps, renamed):
+    rename = lambda x: (renamed[x[0]],x[1]) if isinstance(x,tuple) else renamed[x]
+    if isinstance(deps,dict):
+        return {k:rename(x) for k,x in deps.items()}
+    return tuple(rename(x) for x in deps)
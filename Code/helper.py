@@ -1,5 +1,11 @@
 import pandas as pd
+from Code.cache import read_excel_cached, memoize
+from Code.naics import parse_naics, naics_digits
 
+## NAICS descriptions and 2012-2017 conversions read below
+NAICS_FILES = ['data/ind_data/2017_naics_structure.xlsx','data/ind_data/2017_to_2012_NAICS.xlsx']
+
+@memoize(['data/ind_data/2017_naics_structure.xlsx'])
 def get_naics_descr(level = 4):
     """
     Parameters
@@ -17,7 +23,7 @@ def get_naics_descr(level = 4):
     ind_var = 'naics{}'.format(level)
     title_var = 'naics{}_title'.format(level)
     
-    naics = pd.read_excel('data/ind_data/2017_naics_structure.xlsx',skiprows = [0],header=1)
+    naics = read_excel_cached('data/ind_data/2017_naics_structure.xlsx',skiprows = [0],header=1)
     naics = naics.rename(columns = {'2017 NAICS Code':ind_var,
                                                                 '2017 NAICS Title':title_var})
     
@@ -29,10 +35,10 @@ def get_naics_descr(level = 4):
     
     naics[title_var] = naics[title_var].str.strip() 
     
-    naics = naics.loc[naics[ind_var].astype(str).str.len() == level].\
-                        loc[~pd.isnull(naics[ind_var])][[ind_var,title_var]]
+    codes = parse_naics(naics[ind_var],errors = 'coerce')
+    naics = naics.loc[naics_digits(codes) == level][[ind_var,title_var]]
     naics[title_var] = naics[title_var].str.rstrip('T')
-    naics[ind_var] =  naics[ind_var].astype(int)
+    naics[ind_var] = codes[naics_digits(codes) == level]
     naics = naics.reindex([ind_var,title_var],axis=1)
     
     return naics
@@ -40,6 +46,7 @@ def get_naics_descr(level = 4):
         
 
  
+@memoize(['data/ind_data/2017_to_2012_NAICS.xlsx'])
 def get_naics_12_17(level=4):
     """
     Parameters
@@ -50,20 +57,18 @@ def get_naics_12_17(level=4):
     Returns
     -------
     naics_12_17 : df
-        DESCRIPTION. naics 2012 and naics 2017 matches (unique)
+        DESCRIPTION. naics 2012 and naics 2017 matches (unique), each 2012 industry
+        goes to the 2017 industry most of it maps to (the lower code on ties).
+        See Code/crosswalk.py for the weighted (many-to-many) conversion
 
     """
 
-    import pandas as pd
+    from Code.crosswalk import concordance_pairs
 
-    naics_12_17 = pd.read_excel(
-        "data/ind_data/2017_to_2012_NAICS.xlsx",usecols = "A:D",skiprows = [0,1])
-    
-    naics_12_17.columns = ['naics2012','naics2012_title','naics2017','naics2017_title']
-    
-    for var in ['naics2012','naics2017']:
-        naics_12_17[var] = naics_12_17[var].astype(str).str[0:level].astype(int)
+    naics_12_17 = concordance_pairs(2012,2017,level)
+
+    naics_12_17 = naics_12_17.sort_values(by = ['naics2012','weight'],ascending = [True,False],kind = 'mergesort')
     
-    naics_12_17 = naics_12_17.drop_duplicates(subset = ['naics2012'])[['naics2012','naics2017']]
+    naics_12_17 = naics_12_17.drop_duplicates(subset = ['naics2012'])[['naics2012','naics2017']].reset_index(drop = True)
   
     return naics_12_17
@@ -0,0 +1,223 @@
+"""
+Per-stage timing and memory instrumentation of the builds
+
+Stages are marked with the traced decorator or the stage context manager.
+Nothing is recorded until enable_trace() is called, and while disabled both
+are a single check of a module-level variable, so they can stay in the code.
+
+Each record has the stage name, its parent stage, wall and CPU time, the
+peak memory allocated during the stage above what was allocated at its start
+(tracemalloc, if memory = True) and the number of rows going in and out.
+write_trace() saves the records as json.
+
+jwb
+"""
+
+import os
+import json
+import time
+import functools
+import datetime
+import tracemalloc
+import pandas as pd
+
+TRACE_FILE = 'data/trace.json'
+
+## Records of this process, None while tracing is disabled
+_trace = None
+_memory = False
+_stack = []
+
+
+#%%
+
+def enable_trace(memory = True):
+    """
+    Parameters
+    ----------
+    memory : record peak memory of each stage with tracemalloc
+        (which slows down allocation-heavy code)
+    """
+    global _trace, _memory
+    _trace = []
+    _memory = memory
+    _stack.clear()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable_trace():
+    """
+    Returns
+    -------
+    list of the records, tracing is off afterwards
+    """
+    global _trace, _memory
+    records, _trace = _trace, None
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _memory = False
+    _stack.clear()
+    return records or []
+
+
+def trace_enabled():
+    return _trace is not None
+
+
+def trace_records():
+    """
+    Returns
+    -------
+    df of the records so far (one row per stage)
+    """
+    return pd.DataFrame(_trace or [])
+
+
+def write_trace(path = TRACE_FILE, records = None):
+    """
+    Parameters
+    ----------
+    path : json file to write
+    records : records to write, the default None writes those of the current trace
+    """
+    records = _trace if records is None else records
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(path,'w') as f:
+        json.dump({'written':datetime.datetime.now().isoformat(timespec = 'seconds'),
+                   'stages':records or []},f,indent = 1)
+
+
+class _NullStage:
+    """
+    Returned by stage() while tracing is disabled
+    """
+    rows_in = None
+    rows_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, name, rows_in):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        self.parent = _stack[-1].name if _stack else None
+        self.depth = len(_stack)
+        self.peak_seen = 0
+        if _memory:
+            current, peak = tracemalloc.get_traced_memory()
+            ## Keep the peak of the enclosing stage so far, reset_peak() clears it
+            if _stack:
+                _stack[-1].peak_seen = max(_stack[-1].peak_seen,peak)
+            self.mem_start = current
+            tracemalloc.reset_peak()
+        _stack.append(self)
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        _stack.pop()
+        mem = None
+        if _memory:
+            peak = max(tracemalloc.get_traced_memory()[1],self.peak_seen)
+            mem = (peak - self.mem_start) / 2**20
+            ## The peak of this stage is also one of the enclosing stage
+            if _stack:
+                _stack[-1].peak_seen = max(_stack[-1].peak_seen,peak)
+        if _trace is not None:
+            _trace.append({'stage':self.name,'parent':self.parent,'depth':self.depth,
+                           'pid':os.getpid(),'wall':wall,'cpu':cpu,'mem_peak_mb':mem,
+                           'rows_in':self.rows_in,'rows_out':self.rows_out,
+                           'error':None if exc[0] is None else exc[0].__name__})
+        return False
+
+
+def stage(name, rows_in = None):
+    """
+    Parameters
+    ----------
+    name : name of the stage
+    rows_in : number of rows going in (rows out can be set on the returned
+        object, as in: with stage('merge', len(df)) as s: ... s.rows_out = len(out))
+
+    Returns
+    -------
+    context manager recording the stage (does nothing if tracing is disabled)
+    """
+    if _trace is None:
+        return _NULL_STAGE
+    return _Stage(name,rows_in)
+
+
+def traced(fun = None, name = None):
+    """
+    Decorator recording every call of a function as a stage, with the rows of
+    its dataframe arguments as rows in and the rows of its result (or of the
+    first dataframe in it) as rows out. Used as @traced or @traced(name = ...)
+    """
+    if fun is None:
+        return functools.partial(traced,name = name)
+    label = name or fun.__name__
+
+    @functools.wraps(fun)
+    def wrapper(*args, **kwargs):
+        if _trace is None:
+            return fun(*args,**kwargs)
+        with _Stage(label,_rows(list(args) + list(kwargs.values()))) as s:
+            out = fun(*args,**kwargs)
+            s.rows_out = _rows([out] if isinstance(out,pd.DataFrame) else
+                               [x for x in out if isinstance(x,pd.DataFrame)][:1]
+                               if isinstance(out,tuple) else [])
+        return out
+    return wrapper
+
+
+def call_traced(name, memory, fun, *args, **kwargs):
+    """
+    Run fun as stage name in a worker process with tracing on, returns
+    (result, records) so the records can be added to the trace of the parent process
+    """
+    enable_trace(memory)
+    try:
+        with _Stage(name,None):
+            out = fun(*args,**kwargs)
+    finally:
+        records = disable_trace()
+    return out, records
+
+
+def memory_enabled():
+    return _memory
+
+
+def add_records(records):
+    """
+    Add records of a worker process (from call_traced) to the current trace
+    """
+    if _trace is not None:
+        parent = _stack[-1] if _stack else None
+        for x in records:
+            if x['parent'] is None and parent is not None:
+                x['parent'] = parent.name
+            x['depth'] += len(_stack)
+        _trace.extend(records)
+
+
+def _rows(values):
+    rows = [len(x) for x in values if isinstance(x,(pd.DataFrame,pd.Series))]
+    return sum(rows) if rows else None
@@ -0,0 +1,247 @@
+"""
+In-memory store of the industry measures for lookups by NAICS code
+
+The measures (columns of the build_* outputs) are kept in dense arrays
+indexed directly by the integer NAICS code, one array per level and column,
+so looking up the codes of a large panel is a single indexing operation per
+level. Codes of any length (2-6 digits) are truncated to the finest stored
+level, and codes without a value fall back to coarser levels (4 -> 3 -> 2).
+Coarser levels not built directly are the (unweighted) means of the finer
+level below them.
+
+The fallback is resolved once for every possible code when the store is
+built, so a lookup is one indexing operation per column.
+
+jwb
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from Code.naics import naics_hierarchy, parse_naics, naics_digits, LEVELS
+
+OUT_DIR = 'Out_Data'
+
+## Outputs of runfile.py, file name is the measure name
+OUT_MEASURES = ['workplace_flex','investment_flex','cust_int','fixed_cost_share']
+
+
+#%%
+
+class MeasureStore:
+    """
+    Parameters
+    ----------
+    measures : dict of {measure: df}, or list of dfs, as returned by the build_*
+        functions (one naics column, e.g. naics4, and the measure columns).
+        A measure built at several levels is a dict of {level: df} (as
+        returned by build_measures with several levels) or a list of dfs
+    levels : levels kept in the store, finest first
+    aggregate : fill levels (and columns) that were not given from the finer
+        level below them. If False, only the given levels are used
+    """
+
+    def __init__(self, measures, levels = LEVELS, aggregate = True):
+        self.levels = list(levels)
+        dfs = [x for x in (measures.values() if isinstance(measures,dict) else measures) if x is not None]
+        dfs = [df for x in dfs for df in level_dfs(x).values()]
+
+        self.columns = []
+        for df in dfs:
+            self.columns += [x for x in value_columns(df) if x not in self.columns]
+
+        ## {level: array of (columns, 10**digits + 1)}, the last slot is always
+        ## missing so code -1 (no parent at that level) indexes to nan
+        self.arrays = {ind:np.full((len(self.columns),10**int(ind[-1]) + 1),np.nan) for ind in self.levels}
+        for df in dfs:
+            ind = naics_column(df)
+            if ind not in self.arrays:
+                raise Exception("{} is not one of the store levels {}".format(ind,self.levels))
+            codes = naics_codes(df[ind],int(ind[-1]))
+            for col in value_columns(df):
+                mean = _mean_by_code(codes,df[col],self.arrays[ind].shape[1])
+                self.arrays[ind][self.columns.index(col)][~np.isnan(mean)] = mean[~np.isnan(mean)]
+
+        ## Values that were given (not means of the finer level), {level: bool array}
+        self.built = {ind:~np.isnan(x) for ind,x in self.arrays.items()}
+        if aggregate:
+            for finer, coarser in zip(self.levels[:-1],self.levels[1:]):
+                missing = np.isnan(self.arrays[coarser])
+                derived = self._aggregate(finer,coarser)
+                self.arrays[coarser][missing] = derived[missing]
+
+        ## All levels side by side ({level: offset} of each), with every code's
+        ## value after the fallback to coarser levels, and the level it came from
+        self.offsets = dict(zip(self.levels,np.cumsum([0] + [self.arrays[x].shape[1] for x in self.levels[:-1]])))
+        self.values = np.hstack([self.arrays[x] for x in self.levels])
+        self.source = np.hstack([np.where(np.isnan(self.arrays[x]),0,int(x[-1])) for x in self.levels]).astype(np.int8)
+        self.raw_source = self.source.copy()
+        self.raw_values = self.values.copy()
+        ## Coarsest level first, so each level falls back to an already resolved one
+        for finer, coarser in reversed(list(zip(self.levels[:-1],self.levels[1:]))):
+            codes = np.arange(self.arrays[finer].shape[1] - 1)
+            parents = naics_hierarchy(codes,[coarser])[coarser].to_numpy()
+            own = self.offsets[finer] + codes
+            parent = self.offsets[coarser] + np.where(parents >= 0,parents,self.arrays[coarser].shape[1] - 1)
+            fill = np.isnan(self.values[:,own])
+            self.values[:,own] = np.where(fill,self.values[:,parent],self.values[:,own])
+            self.source[:,own] = np.where(fill,self.source[:,parent],self.source[:,own])
+
+    def _aggregate(self, finer, coarser):
+        codes = np.flatnonzero(~np.all(np.isnan(self.arrays[finer][:,:-1]),axis = 0))
+        parents = naics_hierarchy(codes,[coarser])[coarser].to_numpy()
+        size = self.arrays[coarser].shape[1]
+        return np.vstack([_mean_by_code(parents,x[codes],size) for x in self.arrays[finer]])
+
+    def lookup(self, naics, columns = None, fallback = True):
+        """
+        Parameters
+        ----------
+        naics : array or series of naics codes of any (mixed) length, ints,
+            floats or strings. Missing or invalid codes are not found
+        columns : measure columns to return, the default None returns all of them
+        fallback : if False, only the finest stored level of each code is used
+
+        Returns
+        -------
+        values : df
+            one column per measure column, nan if not found
+        source : df
+            naics level (4, 3, 2) each value came from, 0 if not found
+        """
+        columns = self.columns if columns is None else list(columns)
+        unknown = [x for x in columns if x not in self.columns]
+        if unknown:
+            raise Exception("{} not in the store".format(unknown))
+
+        index = naics.index if isinstance(naics,pd.Series) else None
+        hierarchy = naics_hierarchy(parse_naics(naics,errors = 'coerce'),self.levels)
+
+        ## Position of each code at its finest stored level, -1 (always missing) if none
+        pos = np.full(len(hierarchy),-1,dtype = np.int64)
+        for ind in reversed(self.levels):
+            code = hierarchy[ind].to_numpy()
+            pos = np.where(code >= 0,self.offsets[ind] + code,pos)
+
+        values = self.values if fallback else self.raw_values
+        source = self.source if fallback else self.raw_source
+        rows = [self.columns.index(x) for x in columns]
+        return (pd.DataFrame({x:values[j][pos] for x,j in zip(columns,rows)},index = index),
+                pd.DataFrame({x:source[j][pos] for x,j in zip(columns,rows)},index = index))
+
+    def table(self, level = 'naics4'):
+        """
+        Returns
+        -------
+        df of all stored values at a level, one row per code with any value
+        """
+        array = self.arrays[level][:,:-1]
+        codes = np.flatnonzero(~np.all(np.isnan(array),axis = 0))
+        df = pd.DataFrame(array[:,codes].T,columns = self.columns)
+        df.insert(0,level,codes)
+        return df
+
+
+def load_measure_store(folder = OUT_DIR, measures = OUT_MEASURES, **kwargs):
+    """
+    Parameters
+    ----------
+    folder : folder with the saved measures ({measure}.csv, and
+        {measure}_naics3.csv etc. for the other levels it was built at, see
+        write_measures in Code/output.py)
+    measures : measures to load
+    **kwargs : passed on to MeasureStore
+
+    Returns
+    -------
+    MeasureStore of the saved measures, at every level they were saved at
+    (so coarser values are the built ones, as in measures.parquet)
+    """
+    levels = kwargs.get('levels',LEVELS)
+    dfs = {}
+    for measure in measures:
+        paths = [os.path.join(folder,'{}{}.csv'.format(measure,'' if x == 'naics4' else '_' + x)) for x in levels]
+        dfs[measure] = [pd.read_csv(x) for x in paths if os.path.exists(x)]
+        if not dfs[measure]:
+            raise Exception("{} not found in {}".format(measure,folder))
+    return MeasureStore(dfs,**kwargs)
+
+
+def level_dfs(dfs):
+    """
+    Parameters
+    ----------
+    dfs : one measure, as a df, a dict of {level: df} or a list of dfs
+
+    Returns
+    -------
+    dict of {level: df} (e.g. {'naics4': df}), None's are skipped
+    """
+    dfs = list(dfs.values()) if isinstance(dfs,dict) else dfs if isinstance(dfs,(list,tuple)) else [dfs]
+    out = {}
+    for df in dfs:
+        if df is not None:
+            if naics_column(df) in out:
+                raise Exception("two tables at {} for the same measure".format(naics_column(df)))
+            out[naics_column(df)] = df
+    return out
+
+
+def naics_column(df):
+    """
+    Returns
+    -------
+    name of the one naics code column of a measure df (naics2 to naics6)
+    """
+    cols = [x for x in df.columns if x[:5] == 'naics' and x[5:].isdigit()]
+    if len(cols) != 1:
+        raise Exception("expected one naics code column (naics2 to naics6), found {}".format(cols))
+    return cols[0]
+
+
+def value_columns(df):
+    """
+    Returns
+    -------
+    list of the measure columns of a df (numeric columns other than the
+    naics code and its title)
+    """
+    ind = naics_column(df)
+    return [x for x in df.columns if x != ind and x != ind + '_title' and pd.api.types.is_numeric_dtype(df[x])]
+
+
+def naics_codes(naics, level):
+    """
+    Parameters
+    ----------
+    naics : naics column of a measure df at level (digits), saved csv's can
+        have the codes as floats
+
+    Returns
+    -------
+    array of the integer codes, raises an Exception if any is not a code of that level
+    """
+    codes = parse_naics(naics,errors = 'coerce')
+    valid = naics_digits(codes) == level
+    if not valid.all():
+        raise Exception("naics{} has codes that are not {}-digit integers: {}".format(
+                        level,level,list(pd.unique(np.asarray(naics)[~valid]))[:5]))
+    if level == 2:
+        ## Stored under the first sector, as naics_hierarchy maps them
+        codes = naics_hierarchy(codes,['naics2'])['naics2'].to_numpy()
+    return codes
+
+
+#%% Helpers
+
+def _mean_by_code(codes, values, size):
+    """
+    Mean of the non-missing values of each code, in an array of length size
+    (nan for codes without values)
+    """
+    values = np.asarray(values,dtype = float)
+    keep = ~np.isnan(values) & (codes >= 0)
+    total = np.bincount(codes[keep],values[keep],minlength = size)
+    count = np.bincount(codes[keep],minlength = size)
+    with np.errstate(invalid = 'ignore'):
+        return np.where(count > 0,total / np.maximum(count,1),np.nan)
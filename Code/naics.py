@@ -0,0 +1,268 @@
+"""
+Shared NAICS hierarchy and 4 -> 3 -> 2 digit fallback lookups
+
+NAICS codes are kept as integer arrays (-1 for missing), and levels, prefixes,
+parents and merged sectors are taken arithmetically, without converting the
+codes to strings.
+
+jwb
+"""
+
+import pandas as pd
+import numpy as np
+
+## NAICS2 doesn't separate 31-33, 44-45, etc., these are mapped to the first sector
+SECTOR_MERGE = {32:31, 33:31, 41:42, 45:44, 49:48, 92:91}
+
+## Merged sectors as an array indexed by 2-digit code
+_SECTORS = np.arange(100)
+_SECTORS[list(SECTOR_MERGE)] = list(SECTOR_MERGE.values())
+
+## 10, 100, ..., to count digits
+_POWERS = 10**np.arange(1,19,dtype = np.int64)
+
+LEVELS = ['naics4','naics3','naics2']
+
+## BLS OES industries that group several NAICS4 industries, and the industries
+## each one is given to (as the BLS industries do not match NAICS4 perfectly)
+BLS_GROUPS = {'3250A1':['3251','3252','3253','3259'],
+              '3250A2':['3255','3256'],
+              '3320A1':['3321','3322','3325','3326','3329'],
+              '3320A2':['3323','3324'],
+              '3330A1':['3331','3332','3334','3339'],
+              '3370A1':['3371','3372'],
+              '4230A1':['4231','4232','4233','4234','4235','4236','4237','4238','4239'],
+              '4240A1':['4244','4248'],
+              '4240A2':['4242','4246'],
+              '4240A3':['4241','4247','4249'],
+              '4450A1':['4451','4452'],
+              '4530A1':['4532','4533'],
+              '5220A1':['5221','5223'],
+              '5320A1':['5322','5323','5324'],
+              '327000':['3271','3272','3273','3274','3279'],
+              '115100':['1151','1113','1119','1111','1112'],
+              '452000':['4521','4522','4523','4529'],
+              '484000':['4841','4842'],
+              '517000':['5171','5172','5173','5174','5175','5176','5177','5178','5179'],
+              '523000':['5231','5232','5239'],
+              '531000':['5311','5312','5313']}
+
+
+#%%
+
+def merge_sectors(naics2):
+    """
+    Parameters
+    ----------
+    naics2 : array or series of 2-digit naics codes
+
+    Returns
+    -------
+    codes with merged sectors replaced by their first sector (e.g. 32 -> 31)
+    """
+    naics2 = np.asarray(naics2)
+    return np.where((naics2 >= 0) & (naics2 < 100),_SECTORS[np.clip(np.nan_to_num(naics2),0,99).astype(np.int64)],naics2)
+
+
+def parse_naics(naics, errors = 'raise'):
+    """
+    Parameters
+    ----------
+    naics : array or series of naics codes, as ints, floats (e.g. 1111.0) or
+        strings (e.g. '1111', sector ranges like '31-33' are read as 31)
+    errors : 'raise' for codes that aren't integers, 'coerce' makes them missing
+
+    Returns
+    -------
+    int64 array of the codes, -1 where missing
+    """
+    values = pd.Series(np.asarray(naics))
+    if values.dtype == object:
+        ## Parsed in a copy, values shares memory with the caller's codes
+        values = values.copy()
+        text = values.loc[values.map(type) == str]
+        values.loc[text.index] = text.str.split('-').str[0].str.strip()
+    codes = pd.to_numeric(values,errors = 'coerce').to_numpy(dtype = float)
+    bad = (np.isnan(codes) & ~pd.isnull(values).to_numpy()) | (codes != np.round(codes)) & ~np.isnan(codes)
+    if errors == 'raise' and bad.any():
+        raise Exception("not naics codes: {}".format(list(pd.unique(values[bad]))[:5]))
+    codes[bad] = np.nan
+    return np.where(np.isnan(codes) | (codes < 0),-1,codes).astype(np.int64)
+
+
+def naics_digits(naics):
+    """
+    Returns
+    -------
+    number of digits of every (integer) code, 0 if missing (negative)
+    """
+    naics = np.asarray(naics).astype(np.int64)
+    return np.where(naics > 0,np.searchsorted(_POWERS,naics,side = 'right') + 1,0)
+
+
+def naics_prefix(naics, level):
+    """
+    Parameters
+    ----------
+    naics : array of integer naics codes, which can be of mixed length
+    level : number of digits
+
+    Returns
+    -------
+    first level digits of every code (codes that are shorter are kept as is,
+    missing stay -1)
+    """
+    naics = np.asarray(naics).astype(np.int64)
+    prefix = naics // 10**np.maximum(naics_digits(naics) - level,0)
+    return np.where(naics > 0,prefix,-1)
+
+
+def naics_parent(naics):
+    """
+    Returns
+    -------
+    parent of every code one level up (-1 for sectors and missing codes),
+    merged sectors for 3-digit codes (e.g. 321 -> 31)
+    """
+    naics = np.asarray(naics).astype(np.int64)
+    digits = naics_digits(naics)
+    parent = np.where(digits > 2,naics // 10,-1)
+    return np.where(digits == 3,merge_sectors(parent),parent)
+
+
+def naics_children(parents, naics):
+    """
+    Parameters
+    ----------
+    parents : array of integer naics codes
+    naics : array of integer naics codes to look for children in
+
+    Returns
+    -------
+    df of parent and naics, one row for every code in naics whose parent is in parents
+    """
+    naics = np.unique(np.asarray(naics).astype(np.int64))
+    parent = naics_parent(naics)
+    keep = np.isin(parent,np.asarray(parents).astype(np.int64)) & (parent >= 0)
+    return pd.DataFrame({'parent':parent[keep],'naics':naics[keep]}).sort_values(['parent','naics']).reset_index(drop = True)
+
+
+def expand_bls_groups(df, naics = 'naics', groups = BLS_GROUPS):
+    """
+    Parameters
+    ----------
+    df : df with BLS industry codes (strings)
+    naics : industry code column
+    groups : dictionary of {grouped industry: list of industries it is given to}
+
+    Returns
+    -------
+    df with every row of a grouped industry repeated once for each of its
+    industries (with that code), all other rows unchanged, in the same order
+    """
+    table = pd.DataFrame([[x,y] for x in groups for y in groups[x]],columns = [naics,'_expanded'])
+    table[naics] = table[naics].astype(df[naics].dtype)
+    df = df.merge(table,on = naics,how = 'left')
+    df[naics] = df['_expanded'].fillna(df[naics])
+    return df.drop('_expanded',axis = 1)
+
+
+def naics_levels(level):
+    """
+    Parameters
+    ----------
+    level : naics level as digits (4) or name ('naics4'), or a list of them
+
+    Returns
+    -------
+    list of level names (e.g. ['naics4','naics3']), and whether level was a
+    list (the build_* functions then return a dict of {name: df})
+    """
+    many = isinstance(level,(list,tuple,set))
+    names = []
+    for x in (level if many else [level]):
+        name = 'naics{}'.format(x) if isinstance(x,(int,np.integer)) else str(x)
+        if name[:5] != 'naics' or name[5:] not in ['2','3','4','5','6']:
+            raise Exception("{} is not a naics level (2 to 6 digits)".format(x))
+        if name not in names:
+            names.append(name)
+    if not names:
+        raise Exception("no naics levels given")
+    return names, many
+
+
+def naics_hierarchy(naics, levels = LEVELS):
+    """
+    Parameters
+    ----------
+    naics : array or series of integer naics codes, which can be of mixed length
+    levels : naics levels to build
+
+    Returns
+    -------
+    hierarchy : df
+        one column per level, -1 where a code is coarser than the level
+        (e.g. 23 has no naics4 or naics3 parent)
+    """
+    index = naics.index if isinstance(naics,pd.Series) else None
+    naics = np.asarray(naics).astype(np.int64)
+    digits = naics_digits(naics)
+
+    hierarchy = pd.DataFrame(index = index if index is not None else np.arange(len(naics)))
+    for ind in levels:
+        level = int(ind[-1])
+        code = np.where(digits < level,-1,naics_prefix(naics,level))
+        if level == 2:
+            code = merge_sectors(code)
+        hierarchy[ind] = code
+
+    return hierarchy
+
+
+def fallback_lookup(hierarchy, aggregates, levels = LEVELS, fallback = True):
+    """
+    Parameters
+    ----------
+    hierarchy : df, output of naics_hierarchy (one row per target industry)
+    aggregates : dictionary of {level: df indexed by naics code at that level},
+        all with the same value columns and unique index
+    levels : order in which levels are tried, finest first
+    fallback : if False, only the finest level each code has is used
+
+    Returns
+    -------
+    values : df
+        value columns for every row of hierarchy, taken from the first level
+        with a non-missing value
+    source : df
+        naics level (4, 3, 2) each value came from, 0 if not found
+    """
+    levels = [x for x in levels if x in aggregates]
+    cols = list(aggregates[levels[0]].columns)
+
+    values = np.full((len(hierarchy),len(cols)),np.nan)
+    source = np.zeros((len(hierarchy),len(cols)),dtype = np.int64)
+    tried = np.zeros(len(hierarchy),dtype = bool)
+
+    for ind in levels:
+        codes = hierarchy[ind].to_numpy()
+        agg = aggregates[ind]
+        if len(agg) == 0:
+            tried |= codes >= 0
+            continue
+        pos = agg.index.get_indexer(codes)
+
+        ## indexed lookup, -1 is not found
+        found = agg[cols].to_numpy(dtype = float)[np.maximum(pos,0)]
+        fill = (pos[:,None] >= 0) & ~np.isnan(found) & np.isnan(values)
+        if not fallback:
+            fill &= ~tried[:,None]
+
+        values[fill] = found[fill]
+        source[fill] = int(ind[-1])
+        tried |= codes >= 0
+
+    values = pd.DataFrame(values,columns = cols,index = hierarchy.index)
+    source = pd.DataFrame(source,columns = cols,index = hierarchy.index)
+
+    return values, source
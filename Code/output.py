@@ -0,0 +1,248 @@
+"""
+Write all measures to one columnar file
+
+write_measures saves the measures (the output of build_measures, at one or
+several naics levels) as one wide parquet file (zstd compressed), one row per
+code of the finest level with every measure column, typed (int codes, float
+measures), and the naics level each value came from ({column}_level, 4 if
+the industry has its own value, 3 or 2 if it falls back to a coarser
+industry, 0 if none, see MeasureStore). Coarser values are those the
+measures were built with at that level. Where a measure wasn't built at a
+level its values there are the (unweighted) means of the finer level, and
+{column}_derived is True. The build (levels, measures, hashes of the input
+files and the stage keys, see Code/artifacts.py) is stored in the file
+metadata. Optionally every level is also written to its own file, and the
+csv's per measure and level are kept as before.
+
+read_measures only reads the columns asked for (memory mapped), so a
+downstream job that needs one measure doesn't parse the others.
+
+jwb
+"""
+
+import os
+import json
+import shutil
+import datetime
+import numpy as np
+import pandas as pd
+from Code.measure_store import MeasureStore, OUT_DIR, level_dfs, value_columns, naics_codes
+from Code.naics import LEVELS, naics_hierarchy, parse_naics
+
+OUTPUT_NAME = 'measures'
+FORMAT_VERSION = 2
+
+## Key of the build information in the parquet metadata
+METADATA_KEY = b'corporate_flexibility'
+
+
+#%%
+
+def write_measures(measures, folder = OUT_DIR, name = OUTPUT_NAME, graph = None, columnar = True,
+                   csv = True, partitions = False, compression = 'zstd'):
+    """
+    Parameters
+    ----------
+    measures : dict of {measure: df} as returned by build_measures, or of
+        {measure: {level: df}} (or lists of dfs) for measures built at several
+        levels, measures that are None are skipped
+    folder : folder to write to
+    name : name of the columnar file ({name}.parquet, or {name}_naics3.parquet
+        if the finest level is naics3)
+    graph : dependency graph the measures were built with (see measure_stages),
+        to store the hashes of its input files and its stage keys in the metadata
+    columnar : write the columnar file (requires pyarrow)
+    csv : also write each measure to {measure}.csv (or {measure}_naics3.csv
+        for each level), as runfile.py did
+    partitions : also write each level to {name}/level={digits}/part-0.parquet
+    compression : parquet compression
+
+    Returns
+    -------
+    list of files written
+    """
+    measures = {x:level_dfs(dfs) for x,dfs in measures.items() if dfs is not None}
+    measures = {x:dfs for x,dfs in measures.items() if dfs}
+    if not measures:
+        raise Exception("no measures to write")
+    levels = _store_levels(measures)
+    ind = levels[0]
+    suffix = '' if ind == 'naics4' else '_{}'.format(ind)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    written = []
+    if csv:
+        for measure, dfs in measures.items():
+            for level, df in dfs.items():
+                path = os.path.join(folder,'{}{}.csv'.format(measure,'' if level == 'naics4' else '_' + level))
+                df.to_csv(path,index = False)
+                written.append(path)
+    if not columnar:
+        return written
+
+    pa, pq = _parquet()
+    store = MeasureStore(measures,levels)
+    info = build_info(measures,graph)
+    info['level'] = int(ind[-1])
+    info['levels'] = {x:[int(y[-1]) for y in dfs] for x,dfs in measures.items()}
+
+    ## Every code of any measure at the finest level, with its title
+    finest = [dfs[ind] for dfs in measures.values() if ind in dfs]
+    codes = np.unique(np.concatenate([naics_codes(df[ind],int(ind[-1])) for df in finest]))
+    titles = [df[[ind,ind + '_title']].assign(**{ind:naics_codes(df[ind],int(ind[-1]))})
+              for df in finest if ind + '_title' in df]
+    wide = pd.DataFrame({ind:codes})
+    if titles:
+        wide = wide.merge(pd.concat(titles).dropna().drop_duplicates(ind),on = ind,how = 'left')
+    path = os.path.join(folder,'{}{}.parquet'.format(name,suffix))
+    _write_table(pa,pq,_level_table(store,wide,ind),path,info,compression)
+    written.append(path)
+
+    if partitions:
+        root = os.path.join(folder,name + suffix)
+        tmp = root + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        for level in store.levels:
+            array = store.arrays[level][:,:-1]
+            codes = pd.DataFrame({'naics':np.flatnonzero(~np.all(np.isnan(array),axis = 0))})
+            part = os.path.join(tmp,'level={}'.format(level[-1]))
+            os.makedirs(part)
+            _write_table(pa,pq,_level_table(store,codes,'naics'),os.path.join(part,'part-0.parquet'),
+                         dict(info,level = int(level[-1])),compression)
+            written.append(os.path.join(root,'level={}'.format(level[-1]),'part-0.parquet'))
+        ## Replace the old partitions only once all levels are written
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        os.replace(tmp,root)
+
+    return written
+
+
+def read_measures(path = os.path.join(OUT_DIR,OUTPUT_NAME + '.parquet'), columns = None, level = None,
+                  memory_map = True):
+    """
+    Parameters
+    ----------
+    path : columnar file written by write_measures
+    columns : columns to read (the naics column is always read), the default
+        None reads all of them
+    level : read the file of this level (4, 3 or 2) written with partitions
+        instead, codes are in the naics column
+    memory_map : memory map the file instead of reading it
+
+    Returns
+    -------
+    df of the measures
+    """
+    pa, pq = _parquet()
+    if level is not None:
+        path = os.path.join(os.path.splitext(path)[0],'level={}'.format(level),'part-0.parquet')
+    if not os.path.exists(path):
+        raise Exception("{} not found, see write_measures".format(path))
+    if columns is not None:
+        ind = [x for x in pq.read_schema(path,memory_map = memory_map).names if x[:5] == 'naics'][:1]
+        columns = ind + [x for x in columns if x not in ind]
+    return pq.read_table(path,columns = columns,memory_map = memory_map).to_pandas()
+
+
+def read_info(path = os.path.join(OUT_DIR,OUTPUT_NAME + '.parquet')):
+    """
+    Returns
+    -------
+    dict of the build information stored in a file written by write_measures
+    """
+    pa, pq = _parquet()
+    metadata = pq.read_schema(path).metadata or {}
+    if METADATA_KEY not in metadata:
+        raise Exception("{} was not written by write_measures".format(path))
+    return json.loads(metadata[METADATA_KEY])
+
+
+def build_info(measures, graph = None):
+    """
+    Parameters
+    ----------
+    measures : dict of {measure: df} or {measure: {level: df}}
+    graph : dependency graph the measures were built with, or None
+
+    Returns
+    -------
+    dict of the measures and their columns, and (with a graph) the sha256 of
+    the input files of each measure (None if missing) and its stage key
+    """
+    info = {'format_version':FORMAT_VERSION,
+            'created':datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'measures':{x:list(dict.fromkeys(y for df in level_dfs(dfs).values() for y in value_columns(df)))
+                        for x,dfs in measures.items()}}
+    if graph is not None:
+        from Code.artifacts import stage_keys, _input_hash
+        from Code.scheduler import _needed, _order
+
+        files = {}
+        keys = stage_keys(graph,_order(graph,_needed(graph,list(measures))),files)
+        info['stage_keys'] = {x:keys[x] for x in measures}
+        info['inputs'] = {x:{path:_input_hash(path,files) for y in sorted(_needed(graph,[x]))
+                             for path in graph[y].inputs} for x in measures}
+    return info
+
+
+#%% Helpers
+
+def _store_levels(measures):
+    """
+    Levels of all measures and the coarser standard LEVELS, finest first
+    """
+    given = {x for dfs in measures.values() for x in dfs}
+    finest = max(int(x[-1]) for x in given)
+    return sorted(given | {x for x in LEVELS if int(x[-1]) < finest},key = lambda x: -int(x[-1]))
+
+
+def _level_table(store, codes, ind):
+    """
+    codes (df with the code column ind) with every measure column (after the
+    fallback to coarser levels), the level each value came from and whether
+    it is a mean of the finer level rather than a built value
+    """
+    naics = codes[ind].to_numpy()
+    values, source = store.lookup(naics)
+    out = pd.concat([codes.reset_index(drop = True),values.reset_index(drop = True),
+                     source.add_suffix('_level').reset_index(drop = True),
+                     _derived(store,naics,source).add_suffix('_derived')],axis = 1)
+    out[ind] = out[ind].astype(np.int64)
+    return out
+
+
+def _derived(store, naics, source):
+    hierarchy = naics_hierarchy(parse_naics(naics,errors = 'coerce'),store.levels)
+    out = {}
+    for col in source.columns:
+        level = source[col].to_numpy()
+        derived = np.zeros(len(level),dtype = bool)
+        for ind in store.levels:
+            rows = level == int(ind[-1])
+            derived[rows] = ~store.built[ind][store.columns.index(col)][hierarchy[ind].to_numpy()[rows]]
+        out[col] = derived
+    return pd.DataFrame(out)
+
+
+def _write_table(pa, pq, df, path, info, compression):
+    table = pa.Table.from_pandas(df,preserve_index = False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[METADATA_KEY] = json.dumps(info).encode()
+    table = table.replace_schema_metadata(metadata)
+    ## Written next to the output first, so a failed write leaves the old file
+    tmp = path + '.tmp'
+    pq.write_table(table,tmp,compression = compression)
+    os.replace(tmp,path)
+
+
+def _parquet():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("writing and reading the columnar output requires pyarrow "
+                        "(or use csv = True, columnar = False)")
+    return pa, pq
@@ -0,0 +1,116 @@
+"""
+Build the industry measures as one dependency graph
+
+The four builds share only read-only NAICS reference data, so they (and the
+stages of build_cust_int) run in parallel, see Code/scheduler.py. Results are
+kept in data/artifacts/ and only rebuilt if their inputs or code changed,
+see Code/artifacts.py
+
+jwb
+"""
+
+from Code.scheduler import Stage, run_graph
+from Code.artifacts import run_incremental, ARTIFACT_DIR
+from Code.helper import get_naics_descr, get_naics_12_17, NAICS_FILES
+from Code.customer_interactions import cust_int_stages
+from Code.workplace_flex import build_workplace_flex, ATUS_FILES
+from Code.fixed_cost_share import build_fixed_cost_share
+from Code.compustat import comp_q_growth, GROWTH_VARS, WINSOR_LIMITS, COMP_Q_FILE
+from Code.investment_flex import build_investment_flex
+from Code.naics import naics_levels
+
+MEASURES = ['workplace_flex','investment_flex','cust_int','fixed_cost_share']
+
+## NAICS levels each measure can be built at (workplace_flex at the levels 
+## of the IND crosswalk, data/ind_data/naics_to_ind.tab)
+MEASURE_LEVELS = {'workplace_flex':[2,3,4,5,6],'investment_flex':[2,3,4],'cust_int':[2,3,4],
+                  'fixed_cost_share':[2,3,4]}
+
+## limits of measure_stages for the growth rates as saved in comp_q_fc.csv
+## (winsorized at WINSOR_LIMITS), None is no winsorization
+SAVED_LIMITS = 'saved'
+
+## Input files of each build (either the ATUS zip or the csv extracted from it is read)
+INPUTS = {'workplace_flex':[x for name in ATUS_FILES for x in ATUS_FILES[name][::2]] +
+                           ['data/nondownloadable/atus_00002.csv','data/ind_data/naics_to_ind.tab'] + NAICS_FILES,
+          'investment_flex':['../investment_flex_raw.csv'] + NAICS_FILES,
+          'fixed_cost_share':['data/fixed_cost_share/comp_q_fc.csv'] + NAICS_FILES}
+
+
+#%%
+
+def measure_stages(indirect_method = 'first_order', level = 4, weight = 'lvwt', scale = 'IM',
+                   yvar = 'xoprq_g', limits = SAVED_LIMITS):
+    """
+    Parameters
+    ----------
+    indirect_method : passed on to build_cust_int
+    level : naics level of the measures, or a list of levels which each
+        measure builds in one run (its result is then a dict of {level: df})
+    weight : ATUS weight of build_workplace_flex
+    scale : O*NET scale of build_cust_int
+    yvar : cost growth rate of build_fixed_cost_share
+    limits : winsorization of each tail of the Compustat growth rates, which
+        are then recomputed from the saved panel in a comp_q stage
+        (comp_q_growth), None for no winsorization. The default SAVED_LIMITS
+        uses the saved growth rates (winsorized at WINSOR_LIMITS), or for a
+        yvar that isn't saved recomputes it winsorized the same way
+
+    Returns
+    -------
+    dependency graph of all measures, with the stages of build_cust_int
+    """
+    graph = cust_int_stages(indirect_method,level,scale)
+    graph['workplace_flex'] = Stage(build_workplace_flex,(),{'level':level,'weight':weight},INPUTS['workplace_flex'])
+    graph['investment_flex'] = Stage(build_investment_flex,(),{'level':level},INPUTS['investment_flex'])
+    if limits == SAVED_LIMITS and yvar in ['{}_g'.format(x) for x in GROWTH_VARS]:
+        graph['fixed_cost_share'] = Stage(build_fixed_cost_share,(),{'ind':level,'yvar':yvar},INPUTS['fixed_cost_share'])
+    else:
+        graph['comp_q'] = Stage(comp_q_growth,(),{'limits':WINSOR_LIMITS if limits == SAVED_LIMITS else limits},
+                                [COMP_Q_FILE])
+        graph['fixed_cost_share'] = Stage(build_fixed_cost_share,{'comp_q':'comp_q'},{'ind':level,'yvar':yvar},
+                                          NAICS_FILES)
+    return graph
+
+
+def load_reference_data(levels = [4]):
+    """
+    Load the NAICS descriptions and 2012-2017 conversions every build uses
+    """
+    for level in levels:
+        get_naics_descr(level)
+        get_naics_12_17(level)
+
+
+def build_measures(measures = MEASURES, workers = None, indirect_method = 'first_order',
+                   store = ARTIFACT_DIR, level = 4):
+    """
+    Parameters
+    ----------
+    measures : list of measures to build
+    workers : number of processes, the default None uses all cores
+    indirect_method : passed on to build_cust_int
+    store : directory of stored results, only stages that are out of date
+        are rebuilt. None rebuilds everything without storing anything
+    level : naics level to build the measures at, or a list of levels, see
+        MEASURE_LEVELS
+
+    Returns
+    -------
+    dict of {measure: df}, the same as calling the build_* functions (a dict 
+    of {level: df} for each measure if level is a list)
+    """
+    levels = [int(x[-1]) for x in naics_levels(level)[0]]
+    unsupported = [x for x in measures if not set(levels) <= set(MEASURE_LEVELS[x])]
+    if unsupported:
+        raise Exception("{} can't be built at naics{}, see MEASURE_LEVELS".format(unsupported,levels))
+
+    ## Reference tables are loaded once before running, worker processes forked from 
+    ## this one inherit them (otherwise they read the parsed copies from the Excel cache)
+    setup = lambda: load_reference_data(levels)
+    if store is None:
+        setup()
+        return run_graph(measure_stages(indirect_method,level),measures,workers)
+
+    return run_incremental(measure_stages(indirect_method,level),measures,workers,store,
+                           setup = setup)
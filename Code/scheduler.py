@@ -0,0 +1,144 @@
+"""
+Run a dependency graph of build stages, independent stages in parallel
+
+A graph is a dict of {name: Stage}. Each stage's function is called with the
+results of its dependencies, positionally if deps is a tuple or by keyword if
+deps is a dict of {argument: dependency}, plus its own keyword arguments.
+A dependency is either a stage name or (name, i) for the i-th element of a
+stage that returns a tuple. inputs lists the data files a stage reads, used
+by Code/artifacts.py to tell if a stored result is still up to date.
+
+jwb
+"""
+
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from Code import instrument
+
+Stage = namedtuple('Stage',['fun','deps','kwargs','inputs'],defaults = [(),{},()])
+
+
+#%%
+
+def run_graph(graph, targets = None, workers = None, done = None):
+    """
+    Parameters
+    ----------
+    graph : dict of {name: Stage}
+    targets : list of stages to return, the default None returns all of them
+        (only the stages the targets depend on are run)
+    workers : number of processes, the default None uses all cores.
+        With workers = 1 stages run one after another in this process
+    done : dict of {name: result} of stages that are already done,
+        they (and what only they depend on) are not run again
+
+    Returns
+    -------
+    dict of {name: result} for the targets
+    """
+    targets = list(graph) if targets is None else list(targets)
+    results = {} if done is None else dict(done)
+    needed = _needed(graph,targets,results)
+    order = _order(graph,needed)
+    workers = os.cpu_count() if workers is None else workers
+
+    if workers == 1:
+        for name in order:
+            with instrument.stage(name):
+                results[name] = _call(graph[name],results)
+        return {x:results[x] for x in targets}
+
+    ## Stages run in worker processes send their trace records back with the result
+    traced = instrument.trace_enabled()
+
+    pending = set(needed)
+    running = {}
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        while pending or running:
+            ## Submit every stage whose dependencies are done
+            for name in sorted(pending):
+                if all(_dep_name(x) in results for x in _deps(graph[name])):
+                    args, kwargs = _args(graph[name],results)
+                    if traced:
+                        future = pool.submit(instrument.call_traced,name,instrument.memory_enabled(),graph[name].fun,*args,**kwargs)
+                    else:
+                        future = pool.submit(graph[name].fun,*args,**kwargs)
+                    running[future] = name
+                    pending.remove(name)
+            done, _ = wait(running,return_when = FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if traced:
+                    results[name], records = future.result()
+                    instrument.add_records(records)
+                else:
+                    results[name] = future.result()
+
+    return {x:results[x] for x in targets}
+
+
+#%% Graph helpers
+
+def _dep_name(dep):
+    return dep[0] if isinstance(dep,tuple) else dep
+
+
+def _dep_value(dep, results):
+    return results[dep[0]][dep[1]] if isinstance(dep,tuple) else results[dep]
+
+
+def _deps(stage):
+    return list(stage.deps.values()) if isinstance(stage.deps,dict) else list(stage.deps)
+
+
+def _args(stage, results):
+    kwargs = dict(stage.kwargs)
+    if isinstance(stage.deps,dict):
+        kwargs.update({k:_dep_value(x,results) for k,x in stage.deps.items()})
+        return [], kwargs
+    return [_dep_value(x,results) for x in stage.deps], kwargs
+
+
+def _call(stage, results):
+    args, kwargs = _args(stage,results)
+    return stage.fun(*args,**kwargs)
+
+
+def _needed(graph, targets, done = {}):
+    needed = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in graph:
+            raise Exception("Unknown stage {}".format(name))
+        if name not in needed and name not in done:
+            needed.add(name)
+            stack.extend(_dep_name(x) for x in _deps(graph[name]))
+    return needed
+
+
+def _order(graph, needed):
+    """
+    Topological order of the needed stages (raises on cycles)
+    """
+    order = []
+    done = set()
+    visiting = set()
+
+    def _visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise Exception("Dependency cycle at stage {}".format(name))
+        visiting.add(name)
+        for dep in _deps(graph[name]):
+            if _dep_name(dep) in needed:
+                _visit(_dep_name(dep))
+        visiting.remove(name)
+        done.add(name)
+        order.append(name)
+
+    for name in sorted(needed):
+        _visit(name)
+    return order
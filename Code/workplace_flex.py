@@ -1,7 +1,13 @@
     
+import os
+import zipfile
 import pandas as pd
 import numpy as np
+from Code.cache import read_cached, read_csv_cached
 from Code.helper import get_naics_descr, get_naics_12_17
+from Code.aggregation import weighted_agg
+from Code.instrument import traced, stage
+from Code.naics import naics_levels
 
 
 """
@@ -52,10 +58,15 @@ from Code.helper import get_naics_descr, get_naics_12_17
  5. Update 2012 NAICS to 2017 NAICS
  """
  
+@traced
 def build_workplace_flex(level = 4, weight = 'lvwt'):
     """
     Parameters
     ----------
+    level : TYPE, int or list
+        DESCRIPTION. naics level, or a list of levels (e.g. [4,3,2]) which are
+        all built from one read of the ATUS data (the levels of naics_to_ind)
+        The default is 4.
     weight : TYPE, str
         DESCRIPTION. Specifies which weight to use for weighting in atus leave module 
         The default is 'lvwt'.
@@ -63,55 +74,68 @@ def build_workplace_flex(level = 4, weight = 'lvwt'):
     Returns
     -------
     wfh_out : df
-        DESCRIPTION. naics4 level workfromhome using ATUS
+        DESCRIPTION. naics4 level workfromhome using ATUS, a dict of
+        {level: df} if level is a list
 
     """
 
+    inds, many = naics_levels(level)
 
-    ## Final ind var
-    ind_var = 'naics{}'.format(level)
-    title_var = 'naics{}_title'.format(level)
-
-    ## Get the necessary data
+    ## Get the necessary data (only the columns we need)
     # Leave module / atus data
-    lvresp_1718 = pd.read_csv('data/workplace_flex/lvresp_1718_final.csv')
-    atusresp_2017 = pd.read_csv('data/workplace_flex/atusresp_2017_final.csv')
-    atusresp_2018 = pd.read_csv('data/workplace_flex/atusresp_2018_final.csv')
-    atusresp = pd.concat([atusresp_2017,atusresp_2018],axis=0)
-    atusweights = pd.read_csv('data/nondownloadable/atus_00002.csv')
-    atusweights.columns = [x.lower() for x in atusweights]
-    # naics data
-    naics_descr = get_naics_descr(level)
-    naics_12_17 = get_naics_12_17(level)
+    with stage('read_atus') as s:
+        lvresp_1718 = _read_atus('lvresp_1718',['tucaseid','lujf_10','lejf_14'])
+        atusresp_2017 = _read_atus('atusresp_2017',['tucaseid','teio1icd'])
+        atusresp_2018 = _read_atus('atusresp_2018',['tucaseid','teio1icd'])
+        atusresp = pd.concat([atusresp_2017,atusresp_2018],axis=0)
+        atusweights = read_csv_cached('data/nondownloadable/atus_00002.csv',
+                                      usecols = ['CASEID',weight.upper()],dtype = {'CASEID':'int64'})
+        atusweights.columns = [x.lower() for x in atusweights]
+        s.rows_out = len(lvresp_1718) + len(atusresp) + len(atusweights)
     
     # ind/naics conversion data
     naics_to_ind  = pd.read_csv('data/ind_data/naics_to_ind.tab',sep = "\t")    
-    naics_to_ind = naics_to_ind.loc[naics_to_ind['naics_digit'] == level]
 
-    ## Merge together atus datasets
-    lvresp = lvresp_1718.merge(atusresp,on = ['tucaseid'], how = 'left')
+    ## Merge together atus datasets (on int64 case ids)
+    with stage('merge_atus',len(lvresp_1718)) as s:
+        lvresp = lvresp_1718.loc[lvresp_1718['lujf_10']!=-2]
+        
+        lvresp = lvresp.merge(atusresp,on = ['tucaseid'], how = 'left')
+        
+        lvresp = lvresp.merge(atusweights,left_on = ['tucaseid'],right_on = ['caseid'], how = 'left')
+        s.rows_out = len(lvresp)
     
-    lvresp['caseid'] = lvresp['tucaseid'].astype(float)
+    ## Define workfromhome variable
+    lvresp['workfromhome'] = ((lvresp['lujf_10'] == 1) & (lvresp['lejf_14'] == 1))**1
     
-    lvresp = lvresp.merge(atusweights,on = ['caseid'], how = 'left')
+    ## Aggregate to industry level (using weight variable as weight), the same for every naics level
+    lvresp_agg = weighted_agg(lvresp,['teio1icd'],['workfromhome'],weight,skipna = False)
+    lvresp_agg = lvresp_agg[['workfromhome']].reset_index()
     
-    lvresp = lvresp.loc[lvresp['lujf_10']!=-2]
+    out = {ind:_ind_to_naics(lvresp_agg,naics_to_ind,int(ind[-1])) for ind in inds}
     
-    ## Define workfromhome variable
-    lvresp['workfromhome'] = ((lvresp['lujf_10'] == 1) & (lvresp['lejf_14'] == 1))**1
+    return out if many else out[inds[0]]
+
+
+def _ind_to_naics(lvresp_agg, naics_to_ind, level):
+    """
+    workfromhome of the IND industries (lvresp_agg) at a naics level, steps 3-5 above
+    """
     
-    ## Aggregate to industry level (using weight variable as weight)
-    lvresp_agg = lvresp.groupby(['teio1icd']).apply(
-                 lambda x: np.average(x['workfromhome'],weights=x[weight])
-                 ).to_frame().rename(columns = {0:'workfromhome'}).reset_index()
+    ## Final ind var
+    ind_var = 'naics{}'.format(level)
+    title_var = 'naics{}_title'.format(level)
     
+    # naics data
+    naics_descr = get_naics_descr(level)
+    naics_12_17 = get_naics_12_17(level)
     
+    naics_to_ind = naics_to_ind.loc[naics_to_ind['naics_digit'] == level]
     
     lvresp_agg = lvresp_agg.merge(naics_to_ind,left_on = ['teio1icd'],right_on = ['ind'],how = 'left')
     
-    wfh_out = lvresp_agg.groupby(['naics']).apply(
-                 lambda x: np.average(x['workfromhome'],weights=x['afactor'])
-                 ).to_frame().rename(columns = {0:'workfromhome'}).reset_index()
+    wfh_out = weighted_agg(lvresp_agg,['naics'],['workfromhome'],'afactor',skipna = False)
+    wfh_out = wfh_out[['workfromhome']].reset_index()
     
     wfh_out = wfh_out.rename(columns = {'naics':'naics2012'})
     
@@ -132,3 +156,55 @@ def build_workplace_flex(level = 4, weight = 'lvwt'):
     
     return wfh_out
 
+
+
+#%% ATUS ingestion
+
+## Zip downloaded by get_workplace_flex, .dat file in it, and the csv extracted from it
+ATUS_FILES = {'lvresp_1718':['data/workplace_flex/raw/lvresp-1718.zip','lvresp_1718.dat',
+                             'data/workplace_flex/lvresp_1718_final.csv'],
+              'atusresp_2017':['data/workplace_flex/raw/atusresp_2017.zip','atusresp_2017.dat',
+                               'data/workplace_flex/atusresp_2017_final.csv'],
+              'atusresp_2018':['data/workplace_flex/raw/atusresp-2018.zip','atusresp_2018.dat',
+                               'data/workplace_flex/atusresp_2018_final.csv']}
+
+## Compact types of the ATUS variables we use (case ids are 14 digits)
+ATUS_DTYPES = {'tucaseid':'int64','teio1icd':'int16','lujf_10':'int8','lejf_14':'int8'}
+
+
+def _read_atus(name, columns):
+    """
+    Parameters
+    ----------
+    name : ATUS file, key of ATUS_FILES
+    columns : list of (lowercase) variables to read
+
+    Returns
+    -------
+    df of the columns, read straight from the downloaded zip if it is there
+    (otherwise from the extracted csv), through the columnar cache
+    """
+    zip_path, member, csv_path = ATUS_FILES[name]
+    dtype = {x:ATUS_DTYPES[x] for x in columns if x in ATUS_DTYPES}
+    if os.path.exists(zip_path):
+        return read_cached(zip_path,_read_atus_dat,{'member':member,'columns':columns,'dtype':dtype})
+    return read_cached(csv_path,_read_atus_dat,{'member':None,'columns':columns,'dtype':dtype})
+
+
+def _read_atus_dat(path, member, columns, dtype):
+    """
+    Read the columns of an ATUS .dat (csv with upper case names) from a zip, 
+    or of a csv if member is None
+    """
+    dtype = dict(dtype,**{x.upper():y for x,y in dtype.items()})
+    
+    def _read(f):
+        df = pd.read_csv(f,usecols = lambda x: x.lower() in columns,dtype = dtype)
+        df.columns = [x.lower() for x in df.columns]
+        return df[columns]
+    
+    if member is None:
+        return _read(path)
+    with zipfile.ZipFile(path,"r") as z:
+        with z.open(member) as f:
+            return _read(f)
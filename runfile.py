@@ -1,52 +1,59 @@
-from Code.download_data import (get_workplace_flex, 
-                                get_customer_interactions,
-                                get_fixed_cost_share, 
-                                get_industry_data)
-
-from Code.customer_interactions import build_cust_int
-
-from Code.workplace_flex import build_workplace_flex
-
-from Code.fixed_cost_share import build_fixed_cost_share
-
-from Code.investment_flex import build_investment_flex
-
-
-#%% Download data
-print("Downloading raw data...")
-## Workplace Flex data - will save raw data in directory data/workplace_flex/
-get_workplace_flex()
-
-## Workplace Flex data - will save raw data in directory data/customer_interactions/
-get_customer_interactions()
-
-## Fixed Cost Share data - will save raw data in directory data/fixed_cost_share/
-## Note - requires active WRDS subscription and wrds package
-get_fixed_cost_share()
-
-## Download naics descriptors, census-naics crosswalk - will save raw data in directory data/ind_data/
-## Note - required pyDataverse package
-get_industry_data()
-
-#%% Create industry measures
-
-print("Building workplace flexibility measure at 4-digit NAICS...",end = '\n\n')
-workplace_flex = build_workplace_flex()
-
-print("""Building investment flexibility measure at 4-digit NAICS...
-(note: raw data not included here as it is proprietary survey data, so function will just exit)""",end = '\n\n')
-investment_flex = build_investment_flex()
-
-print("Building customer interactions measure using direct and indirect customer interactions at 4-digit NAICS...",end = '\n\n')
-cust_int = build_cust_int()
-
-print("Building fixed cost share at 4-digit NAICS...",end = '\n\n')
-fixed_cost_share = build_fixed_cost_share()
-
-## Save data
-# workplace_flex.to_csv("Out_data/workplace_flex.csv",index=False)
-# cust_int.to_csv("Out_data/cust_int.csv",index=False)
-# fixed_cost_share.to_csv("Out_data/fixed_cost_share.csv",index=False)
-# investment_flex.to_csv("Out_data/investment_flex.csv",index=False)
-
-print("Done!")
+from Code.pipeline import build_measures, measure_stages
+from Code.output import write_measures
+from Code.instrument import enable_trace, write_trace
+
+## Set to True to record the time and memory of every stage in data/trace.json
+trace = False
+
+
+## Guard needed so worker processes don't rerun the script when they start
+if __name__ == '__main__':
+
+    #%% Download data
+    print("Downloading raw data...")
+    ## Imported here, so building from already downloaded data doesn't need wrds or pyDataverse
+    ## (or run python -m Code.cli build, see Code/cli.py)
+    from Code.download_data import (get_workplace_flex, 
+                                    get_customer_interactions,
+                                    get_fixed_cost_share, 
+                                    get_industry_data)
+
+    ## Workplace Flex data - will save raw data in directory data/workplace_flex/
+    get_workplace_flex()
+
+    ## Workplace Flex data - will save raw data in directory data/customer_interactions/
+    get_customer_interactions()
+
+    ## Fixed Cost Share data - will save raw data in directory data/fixed_cost_share/
+    ## Note - requires active WRDS subscription and wrds package
+    get_fixed_cost_share()
+
+    ## Download naics descriptors, census-naics crosswalk - will save raw data in directory data/ind_data/
+    ## Note - required pyDataverse package
+    get_industry_data()
+
+    #%% Create industry measures
+
+    print("Building workplace flexibility, investment flexibility, customer interactions "
+          "and fixed cost share measures at 4-digit NAICS (in parallel)...\n"
+          "(note: investment flexibility raw data not included here as it is proprietary survey data, "
+          "so it will be None)",end = '\n\n')
+    ## workers = None uses all cores, set workers = 1 to build one stage at a time
+    ## Only stages whose input files or code changed since the last run are rebuilt
+    ## (stored in data/artifacts/), set store = None to rebuild everything
+    if trace:
+        enable_trace()
+    measures = build_measures(workers = None)
+    if trace:
+        write_trace()
+
+    workplace_flex = measures['workplace_flex']
+    investment_flex = measures['investment_flex']
+    cust_int = measures['cust_int']
+    fixed_cost_share = measures['fixed_cost_share']
+
+    ## Save data - all measures in Out_Data/measures.parquet (read back with 
+    ## Code.output.read_measures), and each measure in Out_Data/{measure}.csv
+    write_measures(measures,'Out_Data',graph = measure_stages())
+
+    print("Done!")
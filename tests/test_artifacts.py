@@ -0,0 +1,13 @@
+import os
+import Code.artifacts as artifacts
+from Code.fixed_cost_share import build_fixed_cost_share
+
+
+def test_code_version_follows_indirect_imports(monkeypatch):
+    before = artifacts.code_version(build_fixed_cost_share)
+
+    ## fixed_cost_share only imports crosswalk through other Code modules
+    file_hash = artifacts.file_hash
+    monkeypatch.setattr(artifacts,'file_hash',lambda path: file_hash(path) + (
+                        'changed' if os.path.basename(path) == 'crosswalk.py' else ''))
+    assert artifacts.code_version(build_fixed_cost_share) != before
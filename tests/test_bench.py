@@ -0,0 +1,31 @@
+import zipfile
+import numpy as np
+import pandas as pd
+import openpyxl
+from Code.bench import make_inputs
+from Code.compustat import comp_q_growth
+
+SIZES = {'firm_quarters':6_000,'atus_respondents':2_000,'io_size':50,
+         'occupations':100,'survey_responses':100}
+
+
+def test_inputs_have_the_real_layouts(tmp_path, monkeypatch):
+    work = make_inputs(str(tmp_path),SIZES)
+    monkeypatch.chdir(work)
+
+    ## The weight is only in the IPUMS extract, not in the leave module file
+    with zipfile.ZipFile('data/workplace_flex/raw/lvresp-1718.zip') as z:
+        assert 'LVWT' not in pd.read_csv(z.open('lvresp_1718.dat'),nrows = 5)
+    assert 'LVWT' in pd.read_csv('data/nondownloadable/atus_00002.csv',nrows = 5)
+
+    ## BEA codes are text cells
+    book = openpyxl.load_workbook('data/customer_interactions/Use_SUT_Framework_2007_2012_DET.xlsx',read_only = True)
+    header = next(book['2012'].iter_rows(min_row = 6,max_row = 6))
+    assert header[0].value == 'Code' and all(x.data_type == 's' for x in header)
+
+    ## Growth rates are saved winsorized, and recomputing them gives them back
+    saved = pd.read_csv('data/fixed_cost_share/comp_q_fc.csv')
+    raw = np.log(saved['saleq']) - np.log(saved['saleq_l'])
+    assert saved['saleq_g'].max() < raw.max()
+    for var in ['xoprq_g','saleq_g']:
+        assert np.allclose(comp_q_growth()[var],saved[var])
@@ -0,0 +1,38 @@
+import os
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from Code.cache import read_csv_cached, clear_cache
+
+
+def test_evict_only_removes_entries(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    os.makedirs(cache_dir)
+    other = os.path.join(cache_dir,'atus.pkl')
+    pd.DataFrame({'a':[1]}).to_pickle(other)
+
+    for i in range(3):
+        path = str(tmp_path / 'in{}.csv'.format(i))
+        pd.DataFrame({'a':[i]}).to_csv(path,index = False)
+        assert read_csv_cached(path,cache_dir = cache_dir,max_entries = 1)['a'].tolist() == [i]
+
+    files = sorted(os.listdir(cache_dir))
+    assert len(files) == 2 and 'atus.pkl' in files
+
+    clear_cache(cache_dir)
+    assert os.listdir(cache_dir) == ['atus.pkl']
+
+
+def test_shared_between_processes(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    read = functools.partial(read_csv_cached,cache_dir = cache_dir,max_entries = 2)
+    paths = [str(tmp_path / 'in{}.csv'.format(i)) for i in range(3)]
+    with ProcessPoolExecutor(max_workers = 4) as pool:
+        for i in range(8):
+            ## Cold reads of the same files, with stale entries and evictions in between
+            for j, path in enumerate(paths):
+                pd.DataFrame({'a':range(i*1000,(i + 1)*1000),'b':j}).to_csv(path,index = False)
+            for df in pool.map(read,paths * 4):
+                assert df['a'].tolist() == list(range(i*1000,(i + 1)*1000))
+
+    assert not [x for x in os.listdir(cache_dir) if x.endswith('.tmp')]
@@ -0,0 +1,29 @@
+import Code.cli as cli
+import Code.download_data as download_data
+from Code.bench import import_times
+
+
+def test_download_everything_by_default(monkeypatch):
+    called = []
+    for name in cli.DOWNLOADS:
+        monkeypatch.setattr(download_data,'get_{}'.format(name),lambda name = name: called.append(name))
+    cli.main(['download'])
+    assert called == cli.DOWNLOADS
+
+    del called[:]
+    cli.main(['download','fixed_cost_share'])
+    assert called == ['fixed_cost_share']
+
+    refreshed = []
+    monkeypatch.setattr(download_data,'get_industry_data',lambda refresh = False: refreshed.append(refresh))
+    cli.main(['download','fixed_cost_share','industry_data','--refresh'])
+    assert called == ['fixed_cost_share'] * 2 and refreshed == [True]
+
+
+def test_import_times():
+    times = import_times(['Code.cli','Code.pipeline','Code.download_data'],repeat = 2).set_index('module')
+
+    ## Parsing the arguments doesn't even import pandas
+    assert times.loc['Code.cli','seconds'] < 0.25
+    ## Only the stages (and downloads) that use them import the heavy modules (pandas itself loads pyarrow)
+    assert all(x in ['','pyarrow'] for x in times['loads'])
@@ -0,0 +1,68 @@
+import re
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from Code.compustat import build_comp_q
+
+FIRST_YEAR, LAST_YEAR = 2000, 2005
+
+
+@pytest.fixture
+def database(tmp_path):
+    """
+    sqlite database with comp.fundq and comp.company, and a connect function
+    that records the fiscal years of every fundq partition pulled
+    """
+    path = str(tmp_path / 'comp.db')
+    rng = np.random.default_rng(0)
+    rows = [(gvkey,year,qtr,'{}-{:02d}-28'.format(year,3*qtr),'C','INDL','STD','D')
+            for gvkey in range(1,41) for year in range(FIRST_YEAR,LAST_YEAR + 1) for qtr in range(1,5)]
+    fundq = pd.DataFrame(rows,columns = ['gvkey','fyearq','fqtr','datadate','consol','indfmt','datafmt','popsrc'])
+    for var in ['xoprq','saleq','cogsq','xsgaq','atq']:
+        fundq[var] = rng.uniform(1,100,len(fundq))
+    company = pd.DataFrame({'gvkey':range(1,41),'conm':'firm',
+                            'naics':['311111','5171','42','7221','334'] * 8})
+    with sqlite3.connect(path) as db:
+        fundq.to_sql('fundq',db,index = False)
+        company.to_sql('company',db,index = False)
+
+    pulled = []
+
+    def connect():
+        db = sqlite3.connect(':memory:',check_same_thread = False)
+        db.execute("attach database '{}' as comp".format(path))
+        db.set_trace_callback(lambda sql: pulled.extend(
+            re.findall(r'select distinct gvkey, fyearq.*?fyearq>=(\d+) and fyearq<=(\d+)',sql,re.S)))
+        return db
+
+    return path, connect, pulled
+
+
+def _build(connect, folder, last_year = LAST_YEAR):
+    return build_comp_q(connect,FIRST_YEAR,last_year,years_per_partition = 2,workers = 2,folder = folder)
+
+
+def test_only_changed_partitions_are_pulled(database, tmp_path):
+    path, connect, pulled = database
+    folder = str(tmp_path / 'fundq')
+
+    comp_q = _build(connect,folder)
+    assert sorted(pulled) == [('2000','2001'),('2002','2003'),('2004','2005')]
+    assert len(comp_q) and comp_q['naics4'].notna().all()
+
+    del pulled[:]
+    pd.testing.assert_frame_equal(_build(connect,folder),comp_q)
+    assert pulled == []
+
+    with sqlite3.connect(path) as db:
+        db.execute("update fundq set xoprq = xoprq*2 where gvkey = 3 and fyearq = 2002 and fqtr = 1")
+    comp_q = _build(connect,folder)
+    assert pulled == [('2002','2003')]
+    ## Same as pulling everything again
+    pd.testing.assert_frame_equal(comp_q,_build(connect,str(tmp_path / 'fresh')))
+
+    del pulled[:]
+    comp_q = _build(connect,folder,LAST_YEAR + 2)
+    assert pulled == [('2006','2007')]
+    assert comp_q['fyearq'].max() == LAST_YEAR
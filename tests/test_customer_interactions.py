@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from Code.customer_interactions import IOTable, _get_indirect
+
+## Commodities (rows) x customer industries (columns), 423A is one of the
+## alphanumeric BEA codes. 5310 has no direct measure, so its purchases don't count
+CODES = np.array(['1110','423A','5310'])
+USE = IOTable(sparse.csr_matrix(np.array([[1.,3.,0.],[2.,0.,2.],[0.,0.,5.]])),CODES,CODES)
+DIRECT = pd.DataFrame({'input_naics':['1110','423A'],'cust_int':[0.2,0.6]})
+CONS_SHARE = pd.DataFrame({'input_naics':['1110','423A'],'cons_share':[0.5,1.]})
+
+
+def test_first_order():
+    indirect = _get_indirect(USE,DIRECT)
+
+    ## 1110 sells 1/4 to 1110 and 3/4 to 423A, 423A only to 1110 (among industries with a measure)
+    assert indirect['input_naics'].tolist() == CODES.tolist()
+    assert np.allclose(indirect['cust_int_indirect'],[0.25*0.2 + 0.75*0.6,0.2,0])
+    assert np.allclose(indirect['value'],[4,2,0])
+
+
+def test_total():
+    indirect = _get_indirect(USE,DIRECT,CONS_SHARE,method = 'total')
+
+    ## 1110 passes on half of its own indirect measure, 423A none of it:
+    ## x_1110 = 0.25*(0.5*0.2 + 0.5*x_1110) + 0.75*0.6, x_423A = 0.5*0.2 + 0.5*x_1110
+    x = 0.475/0.875
+    assert np.allclose(indirect['cust_int_indirect'],[x,0.1 + 0.5*x,0])
@@ -0,0 +1,111 @@
+import os
+import json
+import hashlib
+import threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from Code.downloader import RawFile, DownloadError, download_files
+
+CONTENT = bytes(range(256)) * 400
+
+
+class _Handler(BaseHTTPRequestHandler):
+    ## Set per test: the file served, how many responses to cut off halfway,
+    ## and the Range header of every request
+    content = CONTENT
+    failures = 0
+    ranges = []
+
+    def do_GET(self):
+        handler = type(self)
+        handler.ranges.append(self.headers.get('Range'))
+        offset = int(self.headers['Range'][6:-1]) if self.headers.get('Range') else 0
+        if offset >= len(handler.content):
+            self.send_response(416)
+            self.end_headers()
+            return
+        body = handler.content[offset:]
+        self.send_response(206 if offset else 200)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        if handler.failures:
+            handler.failures -= 1
+            self.wfile.write(body[:len(body)//2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    _Handler.content, _Handler.failures, _Handler.ranges = CONTENT, 0, []
+    httpd = ThreadingHTTPServer(('127.0.0.1',0),_Handler)
+    thread = threading.Thread(target = httpd.serve_forever,daemon = True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/file.bin'.format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _get(url, tmp_path, **kwargs):
+    raw = RawFile(url,str(tmp_path / 'data' / 'file.bin'))
+    manifest = str(tmp_path / 'manifest.json')
+    ## Small chunks, so the part of a cut off response received so far is written
+    info = download_files([raw],manifest = manifest,backoff = 0,timeout = 5,chunk_size = 1024,**kwargs)[raw.dest]
+    return raw.dest, manifest, info
+
+
+def test_retry_resumes_with_range(server, tmp_path):
+    _Handler.failures = 1
+    dest, manifest, info = _get(server,tmp_path)
+
+    with open(dest,'rb') as f:
+        assert f.read() == CONTENT
+    assert _Handler.ranges == [None,'bytes={}-'.format(len(CONTENT)//2)]
+    assert not os.path.exists(dest + '.part')
+    with open(manifest) as f:
+        assert json.load(f)[dest]['sha256'] == hashlib.sha256(CONTENT).hexdigest() == info['sha256']
+
+
+def test_leftover_part_is_resumed(server, tmp_path):
+    os.makedirs(str(tmp_path / 'data'))
+    with open(str(tmp_path / 'data' / 'file.bin.part'),'wb') as f:
+        f.write(CONTENT[:1000])
+    dest, manifest, info = _get(server,tmp_path)
+
+    assert _Handler.ranges == ['bytes=1000-']
+    assert info['size'] == len(CONTENT)
+
+
+def test_retries_exhausted(server, tmp_path):
+    _Handler.failures = 10
+    with pytest.raises(DownloadError):
+        _get(server,tmp_path,retries = 2)
+    assert len(_Handler.ranges) == 3
+
+
+def test_checksum_mismatch(server, tmp_path):
+    dest, manifest, info = _get(server,tmp_path)
+
+    ## The source changed: the manifest entry of the first download no longer matches
+    _Handler.content = CONTENT[::-1]
+    with pytest.raises(DownloadError,match = 'does not match manifest.*refresh'):
+        _get(server,tmp_path)
+    ## Only downloaded again once
+    assert len(_Handler.ranges) == 3
+    with open(dest,'rb') as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(dest + '.part')
+
+    ## Refreshing replaces the entry
+    dest, manifest, info = _get(server,tmp_path,refresh = True)
+    with open(manifest) as f:
+        assert json.load(f)[dest]['sha256'] == hashlib.sha256(CONTENT[::-1]).hexdigest()
+
+    ## Checksums given explicitly are used instead of the manifest
+    with pytest.raises(DownloadError):
+        _get(server,tmp_path,retries = 0,expected = {dest:{'sha256':hashlib.sha256(CONTENT).hexdigest()}})
+    _get(server,tmp_path,expected = {dest:{'size':len(CONTENT)}})
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+from Code.measure_store import MeasureStore
+from Code.enrich import enrich_panel, enrich_chunk
+
+COLUMNS = ['workfromhome','fc_ind']
+
+
+def _store():
+    ## fc_ind was also built at naics3, workfromhome only at naics4
+    wfh = pd.DataFrame({'naics4':[3111,3112,4411],'workfromhome':[0.1,0.3,0.5]})
+    fc4 = pd.DataFrame({'naics4':[3111,4411],'fc_ind':[1.,2.]})
+    fc3 = pd.DataFrame({'naics3':[311,441],'fc_ind':[5.,6.]})
+    return MeasureStore({'workplace_flex':wfh,'fixed_cost_share':{'naics4':fc4,'naics3':fc3}})
+
+
+def test_lookup_fallback():
+    store = _store()
+    naics = pd.Series(['311111',3112.0,'3119','31',None,'abc'],index = list('abcdef'))
+
+    values, source = store.lookup(naics)
+    assert values.index.tolist() == list('abcdef')
+    assert np.allclose(values['workfromhome'],[0.1,0.3,0.2,0.2,np.nan,np.nan],equal_nan = True)
+    assert source['workfromhome'].tolist() == [4,4,3,2,0,0]
+    ## 3112 has no fc_ind of its own, its parent's is the built naics3 one
+    assert np.allclose(values['fc_ind'],[1.,5.,5.,5.,np.nan,np.nan],equal_nan = True)
+    assert source['fc_ind'].tolist() == [4,3,3,2,0,0]
+
+    values, source = store.lookup(naics,['fc_ind'],fallback = False)
+    assert np.allclose(values['fc_ind'],[1.,np.nan,np.nan,5.,np.nan,np.nan],equal_nan = True)
+
+
+def test_enrich_chunk():
+    chunk = pd.DataFrame({'gvkey':[1,2],'naics':['311111','4411']})
+    out = enrich_chunk(chunk,_store(),columns = COLUMNS,levels = True)
+    assert out.columns.tolist() == ['gvkey','naics','workfromhome','workfromhome_level','fc_ind','fc_ind_level']
+    assert out['fc_ind'].tolist() == [1.,2.] and 'workfromhome' not in chunk
+
+
+def test_enrich_panel(tmp_path):
+    ## The naics codes of the second chunk can't all be parsed, so it is read with other types
+    panel = pd.DataFrame({'gvkey':range(6),'naics':['311111','3112','4411','3119','x1','4411'],
+                          'name':['a','b','c','d','e','f']})
+    panel.iloc[:3].assign(naics = panel['naics'][:3].astype(int)).to_csv(str(tmp_path / 'panel.csv'),index = False)
+    with open(str(tmp_path / 'panel.csv'),'a') as f:
+        panel.iloc[3:].to_csv(f,header = False,index = False)
+    expected = enrich_chunk(panel,_store(),columns = COLUMNS)
+
+    for dest in ['out.csv','out.csv.gz','out.parquet']:
+        path = str(tmp_path / dest)
+        assert enrich_panel(str(tmp_path / 'panel.csv'),path,columns = COLUMNS,store = _store(),
+                            chunksize = 3,dtype = {'naics':str}) == 6
+        out = pd.read_parquet(path) if dest.endswith('.parquet') else pd.read_csv(path,dtype = {'naics':str})
+        pd.testing.assert_frame_equal(out,expected)
+
+    ## Chunks of a csv can have different types
+    enrich_panel(str(tmp_path / 'panel.csv'),str(tmp_path / 'out.csv'),columns = COLUMNS,store = _store(),chunksize = 3)
+    with open(str(tmp_path / 'out.csv')) as f:
+        lines = f.read().splitlines()
+    assert lines[1] == '0,311111,a,0.1,1.0' and lines[5] == '4,x1,e,,'
@@ -0,0 +1,20 @@
+from Code.pipeline import measure_stages, SAVED_LIMITS
+from Code.compustat import WINSOR_LIMITS
+from Code.grid import merge_graphs, SPEC_DEFAULTS
+
+
+def test_limits():
+    ## The saved growth rates by default, None is no winsorization
+    assert 'comp_q' not in measure_stages()
+    assert measure_stages(yvar = 'cogsq_g')['comp_q'].kwargs['limits'] == WINSOR_LIMITS
+    assert measure_stages(limits = None)['comp_q'].kwargs['limits'] is None
+    assert measure_stages(limits = (0.05,0.05))['comp_q'].kwargs['limits'] == (0.05,0.05)
+    assert SPEC_DEFAULTS['limits'] == SAVED_LIMITS
+
+
+def test_merge_graphs_shares_stages():
+    graph, names = merge_graphs([measure_stages(limits = x) for x in [SAVED_LIMITS,None,(0.05,0.05)]],
+                                ['cust_int','fixed_cost_share'])
+    assert len({x['cust_int'] for x in names}) == 1
+    assert len({x['fixed_cost_share'] for x in names}) == 3
+    assert sorted(x for x in graph if x.startswith('comp_q')) == ['comp_q','comp_q#1']
@@ -0,0 +1,23 @@
+import numpy as np
+from Code.instrument import enable_trace, disable_trace, stage
+
+
+def test_nested_stage_keeps_peak_of_enclosing_stage():
+    enable_trace(memory = True)
+    try:
+        with stage('outer'):
+            ## 40 MB allocated and freed before the inner stage starts
+            block = np.ones(5_000_000)
+            del block
+            with stage('inner'):
+                small = np.ones(1_000)
+            with stage('after'):
+                block = np.ones(2_500_000)
+                del block
+    finally:
+        records = {x['stage']:x for x in disable_trace()}
+
+    assert records['outer']['mem_peak_mb'] >= 38
+    assert records['inner']['mem_peak_mb'] < 1
+    assert 19 <= records['after']['mem_peak_mb'] < 38
+    assert records['inner']['parent'] == records['after']['parent'] == 'outer'
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+from Code.measure_store import MeasureStore, load_measure_store
+from Code.output import write_measures, read_measures
+
+
+def _measures():
+    ## a was built at naics4 and naics3 (as build_measures(level = [4,3]) returns it), b only at naics4
+    a4 = pd.DataFrame({'naics4':[3111,3112,4411],'a':[1.,3.,5.]})
+    a3 = pd.DataFrame({'naics3':[311,312,441],'a':[10.,20.,50.]})
+    b4 = pd.DataFrame({'naics4':[3111,3112,3121],'b':[2.,4.,6.]})
+    return {'ma':{'naics4':a4,'naics3':a3},'mb':b4}
+
+
+def test_measures_at_several_levels():
+    store = MeasureStore(_measures())
+
+    values, source = store.lookup(np.array([3111,3121,312]))
+    assert values['a'].tolist() == [1.,20.,20.] and source['a'].tolist() == [4,3,3]
+    assert values['b'].tolist() == [2.,6.,6.] and source['b'].tolist() == [4,4,3]
+
+
+def test_saved_store_matches_the_columnar_output(tmp_path):
+    write_measures(_measures(),str(tmp_path))
+    store = load_measure_store(str(tmp_path),['ma','mb'])
+
+    df = read_measures(str(tmp_path / 'measures.parquet'))
+    values, source = store.lookup(df['naics4'])
+    for col in ['a','b']:
+        assert np.allclose(values[col],df[col],equal_nan = True)
+        assert (source[col] == df[col + '_level']).all()
+    ## a of 3121 is the saved naics3 value, not a mean of naics4 ones
+    assert store.lookup(np.array([3121]))[0]['a'].tolist() == [20.]
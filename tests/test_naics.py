@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+from Code.naics import parse_naics
+from Code.compustat import normalize_naics
+
+
+def test_parse_naics():
+    codes = parse_naics(['311111',' 3111 ','31-33',None,4411.0],errors = 'coerce')
+    assert codes.tolist() == [311111,3111,31,-1,4411]
+
+
+def test_parse_naics_leaves_input_unchanged():
+    for naics in [np.array(['311111',' 3111 ','31-33'],dtype = object),
+                  pd.Series(['311111',' 3111 ','31-33'])]:
+        before = list(naics)
+        parse_naics(naics)
+        normalize_naics(naics)
+        assert list(naics) == before
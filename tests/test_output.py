@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+from Code.output import write_measures, read_measures, read_info
+
+
+def _measures():
+    ## a was built at naics4 and naics3, b only at naics4
+    a4 = pd.DataFrame({'naics4':[3111,3112,4411],'naics4_title':['x','y','z'],'a':[1.,3.,5.]})
+    a3 = pd.DataFrame({'naics3':[311,312,441],'a':[10.,20.,50.]})
+    b4 = pd.DataFrame({'naics4':[3111,3112,3121],'b':[2.,4.,6.]})
+    return {'ma':{'naics4':a4,'naics3':a3},'mb':b4}
+
+
+def test_coarser_levels_are_the_built_ones(tmp_path):
+    files = write_measures(_measures(),str(tmp_path),partitions = True)
+    assert sorted(x[len(str(tmp_path)) + 1:] for x in files if x.endswith('.csv')) == [
+           'ma.csv','ma_naics3.csv','mb.csv']
+
+    df = read_measures(str(tmp_path / 'measures.parquet')).set_index('naics4')
+    assert df.index.tolist() == [3111,3112,3121,4411]
+    ## 3121 has no a of its own, it falls back to the built naics3 value (not the mean of naics4 ones)
+    assert df.loc[3121,'a'] == 20. and df.loc[3121,'a_level'] == 3 and not df.loc[3121,'a_derived']
+    assert df.loc[4411,'b_level'] == 0 and np.isnan(df.loc[4411,'b'])
+    assert not df['b_derived'].any()
+
+    ## b wasn't built at naics3, its values there are the means of naics4
+    df = read_measures(str(tmp_path / 'measures.parquet'),level = 3).set_index('naics')
+    assert df.loc[311,'a'] == 10. and not df.loc[311,'a_derived']
+    assert df.loc[311,'b'] == 3. and df.loc[311,'b_derived']
+    assert read_info(str(tmp_path / 'measures.parquet'))['levels'] == {'ma':[4,3],'mb':[4]}